@@ -2,7 +2,14 @@
 import numpy as np
 import pandas as pd
 
-import prepayment_calcs as pc
+import collateral_waterfall as cw
+import default_calcs as dc
+from collateral_cache import waterfall_cache
+
+BOND_COLUMNS = ['Bond_', 'Coupon_', 'Balance_', 'Principal_', 'Writedown_', 'Interest_Due_', 'Interest_Paid_', 'Cashflow_',
+                'Type_']
+
+FLOATER_TYPES = ['floater', 'inverse floater']
 
 
 class CMO:
@@ -14,7 +21,13 @@ class CMO:
                  wam=358,
                  psa_speed=1.0,
                  cpr_description: object = '.2 ramp 6 for 30, 6',
-                 servicing: float = None):
+                 servicing: float = None,
+                 collateral: pd.DataFrame = None,
+                 sda_speed=0.,
+                 cdr_description: object = dc.SDA_DESCRIPTION,
+                 severity=0.35,
+                 recovery_lag=12,
+                 index_rates=None):
 
         print('Initializing...')
         self.original_balance = original_balance
@@ -26,6 +39,15 @@ class CMO:
         self.cpr_description = cpr_description
         self.servicing = servicing
         self.bonds = bonds
+        self.collateral = collateral
+        self.sda_speed = sda_speed
+        self.cdr_description = cdr_description
+        self.severity = severity
+        self.recovery_lag = recovery_lag
+        self.index_rates = index_rates
+
+        if collateral is not None:
+            self.original_balance, self.pass_thru_cpn, self.wac, self.wam = collateral_terms(collateral)
 
         print('Creating collateral waterfall...')
         self.collateral_waterfall = self._create_collateral_waterfall
@@ -67,390 +89,426 @@ class CMO:
         weighted average coupon of underlying loans, weighted average maturity of underlying loans, psa speed multiplier
         for prepayment curve, and constant prepayment rate curve description.
 
-        CPR description is turned into a list of CPRs which are then run through the SMM function for period SMMs."""
-
-        cpr_curve = pc.cpr_curve_creator(self.cpr_description)
-        age = self.original_maturity - self.wam
-
-        index = pd.Index(range(1, self.wam + 1), name='month')
-
-        beg_balance = np.zeros(self.wam)
-        try:
-            smm = np.array([pc.smm(cpr_curve[period - 1] * self.psa_speed[period - 1]) for period in index])
-        except:
-            smm = np.array([pc.smm(cpr_curve[period - 1] * self.psa_speed) for period in index])
-
-        rem_cols = pd.DataFrame({
-            'mortgage_payments': np.zeros(self.wam),
-            'net_interest': np.zeros(self.wam),
-            'scheduled_principal': np.zeros(self.wam),
-            'prepayments': np.zeros(self.wam),
-            'total_principal': np.zeros(self.wam),
-            'cash_flow': np.zeros(self.wam),
-            'servicing': np.zeros(self.wam)
-        }, index=index)
-
-        waterfall = pd.DataFrame(data=[beg_balance, smm]).T
-        waterfall.columns = ['beginning_balance', 'SMM']
-        waterfall.index = index
-        waterfall = waterfall.join(rem_cols)
-
-        for ix, row in waterfall.iterrows():
-            if ix == 1:
-                row['beginning_balance'] = self.original_balance
-            else:
-                row['beginning_balance'] = waterfall['beginning_balance'].ix[ix - 1] - waterfall['total_principal'].ix[
-                    ix - 1]
-
-            # noinspection PyTypeChecker
-            row['mortgage_payments'] = -np.pmt(rate=self.wac / 12.,
-                                               nper=self.wam - ix + 1,
-                                               pv=row['beginning_balance'],
-                                               fv=0.,
-                                               when='end')
+        CPR description is turned into a list of CPRs which are then run through the SMM function for period SMMs.
 
-            row['net_interest'] = row['beginning_balance'] * self.pass_thru_cpn / 12.
-            gross_coupon = row['beginning_balance'] * (self.wac / 12.)
+        Defaults follow the CDR curve in cdr_description scaled by sda_speed, with losses of severity times the
+        defaulted balance recovery_lag months after default. Losses write down the bonds in reverse order.
 
-            row['scheduled_principal'] = row['mortgage_payments'] - gross_coupon
+        Waterfalls are memoized in collateral_cache.waterfall_cache by their normalized inputs.
 
-            row['prepayments'] = row['SMM'] * (row['beginning_balance'] - row['scheduled_principal'])
+        A collateral waterfall passed to the constructor, i.e. from collateral_waterfall.create_loan_level_waterfall,
+        is used as is instead, and original_balance, pass_thru_cpn, wac and wam are read off it with collateral_terms.
+        Analytics that rebuild the collateral from those terms, like oas and risk_analysis, refuse such a CMO."""
 
-            row['total_principal'] = row['scheduled_principal'] + row['prepayments']
+        if self.collateral is not None:
+            return self.collateral.copy()
 
-            if self.servicing is None:
-                row['servicing'] = row['mortgage_payments'] - (row['net_interest'] + row['total_principal'])
-            else:
-                row['servicing'] = row['beginning_balance'] * self.servicing / 12
-
-            row['cash_flow'] = row['net_interest'] + row['total_principal'] + row['servicing']
-
-        return waterfall
-
-    @property
-    def _calc_seq_bond_cfs_directed_cash(self) -> object:
-        self._bond_waterfalls = {}
-        for bond in self.bonds:
-            current_bond = bond['Bond']
-            self._bond_waterfalls[current_bond] = pd.DataFrame(
-                index=self.collateral_waterfall.index.values,
-                columns=['Bond_' + current_bond,
-                         'Coupon_' + current_bond,
-                         'Balance_' + current_bond,
-                         'Principal_' + current_bond,
-                         'Interest_Due_' + current_bond,
-                         'Interest_Paid_' + current_bond,
-                         'Cashflow_' + current_bond,
-                         'Type_' + current_bond])
-            self._bond_waterfalls[current_bond]['Bond_' + current_bond] = current_bond
-            self._bond_waterfalls[current_bond]['Coupon_' + current_bond] = bond['Coupon']
-            self._bond_waterfalls[current_bond].loc[1, 'Balance_' + current_bond] = bond['Balance']
-            # self._bond_waterfalls[current_bond].loc[1, 'Scheduled_Payment_' + current_bond] = np.nan
-            self._bond_waterfalls[current_bond]['Type_' + current_bond] = _bond_type(bond)
+        key = waterfall_cache.key('CMO', self.original_balance, self.pass_thru_cpn, self.wac, self.wam,
+                                  self.original_maturity, self.servicing, self.psa_speed, self.cpr_description,
+                                  self.sda_speed, self.cdr_description, self.severity, self.recovery_lag)
 
-        final_df = pd.DataFrame(index=self.collateral_waterfall.index, columns=['remaining_interest',
-                                                                                'remaining_principal'])
+        return waterfall_cache.get_or_create(key, self._build_collateral_waterfall)
 
-        # for k, v in collateral_waterfall.iterrows():
-        for period in self.collateral_waterfall.index.values:
+    def _build_collateral_waterfall(self):
+        smm = cw.smm_vector(self.cpr_description, self.psa_speed, self.wam)
+        mdr = cw.mdr_vector(self.cdr_description, self.sda_speed, self.wam)
 
-            self._rem_interest_cash = np.float(self.collateral_waterfall.loc[period, 'net_interest'])
-            self._rem_principal_cash = np.float(self.collateral_waterfall.loc[period, 'total_principal'])
+        flows = cw.collateral_cash_flows(self.original_balance, self.pass_thru_cpn, self.wac, self.wam, smm,
+                                         servicing_fee=0 if self.servicing is None else self.servicing,
+                                         mdr=mdr, severity=self.severity, recovery_lag=self.recovery_lag)
 
-            # set new period balances
+        if self.servicing is None:
+            flows['servicing'] = flows['mortgage_payments'] + flows['recoveries'] - (flows['net_interest'] +
+                                                                                     flows['total_principal'])
 
-            for i in range(len(self.bonds)):
-                current_bond = self.bonds[i]['Bond']
-                if period > 1:
-                    new_balance = self._calc_period_beginning_balance(current_bond, period)
-                    self._bond_waterfalls[current_bond].loc[period, 'Balance_' + current_bond] = new_balance
+        flows['cash_flow'] = flows['net_interest'] + flows['total_principal'] + flows['servicing']
 
-                else:
-                    new_balance = self.bonds[i]['Balance']
+        return pd.DataFrame(flows, index=pd.Index(range(1, self.wam + 1), name='month'),
+                            columns=['beginning_balance', 'SMM', 'mortgage_payments', 'net_interest',
+                                     'scheduled_principal', 'prepayments', 'total_principal', 'cash_flow',
+                                     'servicing', 'performing_balance', 'MDR', 'defaults', 'recoveries', 'losses'])
 
-            self._non_accrual_principal = self._calc_non_accrual_principal_balances(period)
+    def run_index_paths(self, index_paths):
+        """ Runs the bonds over many index rate paths at once against this deal's collateral waterfall, i.e. to
+        price floater and inverse floater bonds across hundreds of paths.
 
-            # pay interest
+        :param index_paths: (paths x periods) index rates, with at least as many periods as the collateral waterfall
+        :return: dict of bond flow arrays shaped (paths, periods, bonds) and (paths, periods)
+        """
 
-            for i in range(len(self.bonds)):
-                current_bond = self.bonds[i]['Bond']
-                coupon = self._bond_waterfalls[current_bond].loc[period, 'Coupon_' + current_bond]
-                is_accrual = _bond_type(self.bonds[i]) == 'accrual'
+        index_paths = np.atleast_2d(np.asarray(index_paths, dtype=float))[..., :len(self.collateral_waterfall)]
+        coupons = np.broadcast_to(self._coupons(index_paths), index_paths.shape + (len(self.bonds),))
 
-                # calculate interest due and paid
+        return self._coupon_flows(coupons)
 
-                interest_due, interest_paid = self._calc_interest_payment(period,
-                                                                          self._bond_waterfalls[current_bond].loc[
-                                                                              period, 'Balance_' + current_bond],
-                                                                          coupon,
-                                                                          is_accrual)
+    def _coupons(self, index_rates):
+        """ bond_coupons of the bonds with index rates cut to the collateral waterfall's periods """
 
-                unpaid_interest = interest_paid - interest_due
+        if index_rates is not None and np.ndim(index_rates) > 0:
+            index_rates = np.asarray(index_rates, dtype=float)[..., :len(self.collateral_waterfall)]
 
-                self._bond_waterfalls[current_bond].loc[period, 'Interest_Due_' + current_bond] = interest_due
-                self._bond_waterfalls[current_bond].loc[period, 'Interest_Paid_' + current_bond] = interest_paid
+        return bond_coupons(self.bonds, index_rates)
 
-                self._bond_waterfalls[current_bond].loc[period, 'Principal_' + current_bond] = unpaid_interest
+    def _coupon_flows(self, coupons):
+        """ Bond flows over the collateral waterfall for (bonds,) or (..., periods, bonds) coupons. Subclasses with a
+        different waterfall override this. """
 
-                self._bond_waterfalls[current_bond].loc[period, 'Cashflow_' + current_bond] = interest_paid + \
-                                                                                              unpaid_interest
+        return sequential_pay_cash_flows(self.collateral_waterfall['net_interest'].values,
+                                         self.collateral_waterfall['total_principal'].values,
+                                         [bond['Balance'] for bond in self.bonds],
+                                         coupons,
+                                         [_bond_type(bond) == 'accrual' for bond in self.bonds],
+                                         losses=self.collateral_waterfall['losses'].values
+                                         if 'losses' in self.collateral_waterfall else None)
 
-                # not using...calculate period scheduled payment
+    @property
+    def _calc_seq_bond_cfs_directed_cash(self) -> object:
+        coupons = self._coupons(self.index_rates)
+        flows = self._coupon_flows(coupons)
+        if coupons.ndim > 1:
+            coupons = np.broadcast_to(coupons, flows['balance'].shape)
 
-                # scheduled_payment = round(-np.pmt(coupon / 12, 361 - period, new_balance), 2)
+        index = self.collateral_waterfall.index
 
-                # self._bond_waterfalls[current_bond].loc[period, 'Scheduled_Payment_' + current_bond] = scheduled_payment
+        self._bond_waterfalls = {}
+        for i, bond in enumerate(self.bonds):
+            current_bond = bond['Bond']
+            self._bond_waterfalls[current_bond] = pd.DataFrame({
+                'Bond_' + current_bond: current_bond,
+                'Coupon_' + current_bond: coupons[..., i],
+                'Balance_' + current_bond: flows['balance'][:, i],
+                'Principal_' + current_bond: flows['principal'][:, i],
+                'Writedown_' + current_bond: flows['writedown'][:, i],
+                'Interest_Due_' + current_bond: flows['interest_due'][:, i],
+                'Interest_Paid_' + current_bond: flows['interest_paid'][:, i],
+                'Cashflow_' + current_bond: flows['cashflow'][:, i],
+                'Type_' + current_bond: _bond_type(bond)},
+                index=index.values,
+                columns=[column + current_bond for column in BOND_COLUMNS])
+
+        final_df = pd.DataFrame({'remaining_interest': flows['remaining_interest'],
+                                 'remaining_principal': flows['remaining_principal']},
+                                index=index,
+                                columns=['remaining_interest', 'remaining_principal'])
+
+        return pd.concat([final_df] + [self._bond_waterfalls[bond['Bond']].set_index(index) for bond in self.bonds],
+                         axis=1)
 
-            # pay principal
+    def create_pro_rata_bonds(self, bonds):
 
-            for i in range(len(self.bonds)):
-                current_bond = self.bonds[i]['Bond']
-                if self._rem_principal_cash > 0:
-                    principal_cash_flow = min(
-                        np.float(self._bond_waterfalls[current_bond].loc[period, 'Balance_' + current_bond]),
-                        np.float(self._rem_principal_cash))
+        pro_rata_bonds = {}
+        current_bond = None
 
-                    self._bond_waterfalls[current_bond].loc[period, 'Principal_' + current_bond] += principal_cash_flow
-                    self._bond_waterfalls[current_bond].loc[period, 'Cashflow_' + current_bond] += principal_cash_flow
-                    self._rem_principal_cash -= principal_cash_flow
+        for split in bonds:
+            current_bond = split['source_bond']
+            for child_bond in split['child_bonds']:
+                pro_rata_bonds[child_bond] = self._bond_waterfalls[current_bond].copy()
+                pro_rata_bonds[child_bond].columns = pro_rata_bonds[child_bond].columns.str.replace('_' + current_bond,
+                                                                                                    '_' + child_bond)
+                amounts = [column + child_bond for column in ['Balance_', 'Principal_', 'Writedown_', 'Interest_Due_',
+                                                              'Interest_Paid_', 'Cashflow_']]
+                pro_rata_bonds[child_bond][amounts] = \
+                    pro_rata_bonds[child_bond][amounts] * split['child_bonds'][child_bond]
 
-                else:
-                    self._bond_waterfalls[current_bond].loc[period, 'Principal_' + current_bond] += 0
+                self.waterfall = self.waterfall.merge(pro_rata_bonds[child_bond], left_index=True, right_index=True)
 
-            final_df.loc[period, 'remaining_principal'] = self._rem_principal_cash
-            final_df.loc[period, 'remaining_interest'] = self._rem_interest_cash
+        for key in pro_rata_bonds.keys():
+            self._bond_waterfalls[key] = pro_rata_bonds[key]
 
-        for i in range(len(self.bonds)):
-            current_bond = self.bonds[i]['Bond']
-            final_df = final_df.merge(self._bond_waterfalls[current_bond],
-                                      left_index=True,
-                                      right_index=True)
+        self.waterfall.drop(self.waterfall.columns[self.waterfall.columns.str.contains('_' + current_bond + '$')],
+                            axis=1,
+                            inplace=True)
 
-        return final_df
+    def calc_PAC_and_support(self, collateral_waterfall, lower_band=1, upper_band=3, supports=None):
 
-    def _calc_non_accrual_principal_balances(self, period):
         """
 
-        :param bond_waterfall_df: dataframe for bond waterfalls
-        :return: outstanding balances of non_accrual bonds
+        :param collateral_waterfall: actual waterfall for underlying collateral
+        :param lower_band: psa speed for determining lower_band payment schedule
+        :param upper_band: psa speed for determining upper_band payment schedule
+        :param supports: optional list of support/companion bonds, i.e. [{'Bond': 'S1', 'Balance': 20e6}, ...], paid
+        in order from the principal left after the PAC schedule. By default a single 'Support' bond holds the
+        collateral balance not in the PAC
+        :return: dataframe containing waterfall for PAC and Support bonds
         """
 
-        non_accrual_principal_balances = 0
+        # create collateral principal paydowns at the lower and upper band psa speeds in one two scenario pass
 
-        for bond in self.bonds:
-            current_bond = bond['Bond']
+        band_smm = np.vstack([cw.smm_vector(self.cpr_description, band, self.wam) for band in (lower_band, upper_band)])
+        bands = cw.collateral_cash_flows(self.original_balance, self.pass_thru_cpn, self.wac, self.wam, band_smm)
 
-            if _bond_type(bond) != 'accrual':
-                non_accrual_principal_balances += self._bond_waterfalls[current_bond].loc[period,
-                                                                                          'Balance_' + current_bond]
+        lower_principal, upper_principal = bands['total_principal']
 
-        return non_accrual_principal_balances
+        # PAC bond principal due is the minimum of the scheduled principal payment from the lower and upper band
 
-    def _calc_period_beginning_balance(self, current_bond, period):
+        pac_principal_due = np.minimum(lower_principal, upper_principal)
 
-        """
-        :param bond_df: dataframe for current bond
-        :param current_bond: designation (i.e. 'A', 'B', 'Z') for bond being evaluated
-        :param period: current period in waterfall
-        :param is_accrual: boolean, is the bond of type 'accrual'
-        :return:Calculate current period beginning principal = prior period principal - principal pay down
-        (calculated as total period cash flow less interest paid)
-        """
+        # Principal available to pay down PAC and Support bonds is the total principal from the collateral
 
-        # all values below are taken from the priod period in the waterfall
-        prior_period = period - 1
+        available_principal = collateral_waterfall.total_principal.values.astype(float)
 
-        bond_df = self._bond_waterfalls[current_bond]
+        # PAC initial principal size is the sum of all the scheduled principal payments for the bond
 
-        starting_balance = bond_df.loc[prior_period, 'Balance_' + current_bond]
+        pac_initial_balance = pac_principal_due.sum()
 
-        # interest_due = bond_df.loc[prior_period, 'Interest_Due_' + current_bond]
-        # interest_paid = bond_df.loc[prior_period, 'Interest_Paid_' + current_bond]
+        # Support bond initial principal size is the balance remaining from the underlying collateral and the PAC bond
 
-        # interest_due_unpaid = interest_due - interest_paid
-        principal_paid = bond_df.loc[prior_period, 'Principal_' + current_bond]
+        if supports is None:
+            supports = [{'Bond': 'Support',
+                         'Balance': collateral_waterfall.loc[1, 'beginning_balance'] - pac_initial_balance}]
 
-        return starting_balance - principal_paid
+        periods = len(available_principal)
 
-    def _calc_interest_payment(self, period, balance, coupon, is_accrual):
-        """
+        pac_balance = np.empty(periods)
+        pac_principal_paid = np.empty(periods)
+        pac_unpaid_principal = np.empty(periods)
+        support_balance = np.empty((periods, len(supports)))
+        support_principal_paid = np.empty((periods, len(supports)))
 
-        :param bond_df: dataframe for current bond
-        :param period: int, current period in waterfall
-        :param current_bond: str, bond identifier (i.e. 'A', 'B', 'Z')
-        :param cash_available: float, cash available for interest payment
-        :param is_accrual: boolean, is the bond being evaluated of type accrual
-        :return: floats, the amount of interest due and the interest payment as a two values => due, payment
-        """
+        pac_new_balance = pac_initial_balance
+        support_new_balance = np.array([support['Balance'] for support in supports], dtype=float)
 
-        interest_due = balance * (coupon / 12)
-        interest_cash_redirected_to_principal = 0
+        # running totals of scheduled and paid PAC principal
 
-        if is_accrual == False:
-            interest_paid = min(interest_due, self._rem_interest_cash)
+        pac_cumulative_due = 0.
+        pac_cumulative_paid = 0.
+        pac_accrued_unpaid = 0.
 
-        else:
+        for period in range(periods):
+            pac_balance[period] = pac_new_balance
+            support_balance[period] = support_new_balance
 
-            # calculate non-accrual bond principal balance not completely covered by available cash for principal
-            non_accrual_rem_principal = max(self._non_accrual_principal - self._rem_principal_cash, 0)
+            # current period PAC principal due is the scheduled principal for the period + any accrued unpaid
+            # principal if there wasn't enough principal cash flow in earlier periods to cover the scheduled payment;
+            # the PAC can not be paid more principal than available from the collateral
 
-            # redirect necessary amount of cash to pay down as much non-accrual principal as possible
-            interest_cash_redirected_to_principal = min(interest_due,
-                                                        non_accrual_rem_principal)
+            principal_available = available_principal[period]
+            paid = min(pac_principal_due[period] + pac_accrued_unpaid, principal_available)
+            remaining = principal_available - paid
 
-            # interest paid to accrual bond is the remaining balance after paying down non-accrual bond principal to 0
-            interest_paid = interest_due - interest_cash_redirected_to_principal
+            # Support bonds receive remaining principal in order after necessary PAC payment is met
 
-        # remaining interest cash is reduced by the interest paid out
-        self._rem_interest_cash -= (interest_paid + interest_cash_redirected_to_principal)
-        self._rem_principal_cash += interest_cash_redirected_to_principal
+            for i in range(len(supports)):
+                support_paid = max(min(support_new_balance[i], remaining), 0)
+                support_principal_paid[period, i] = support_paid
+                remaining -= support_paid
 
-        return interest_due, interest_paid
+            # once the supports are retired the PAC receives all remaining principal
 
-    def create_pro_rata_bonds(self, bonds):
+            paid += remaining
 
-        pro_rata_bonds = {}
-        current_bond = None
+            pac_cumulative_due += pac_principal_due[period]
+            pac_cumulative_paid += paid
+            pac_accrued_unpaid = max(pac_cumulative_due - pac_cumulative_paid, 0)
 
-        for split in bonds:
-            current_bond = split['source_bond']
-            for child_bond in split['child_bonds']:
-                pro_rata_bonds[child_bond] = self._bond_waterfalls[current_bond].copy()
-                pro_rata_bonds[child_bond].columns = pro_rata_bonds[child_bond].columns.str.replace('_' + current_bond,
-                                                                                                    '_' + child_bond)
-                pro_rata_bonds[child_bond].loc[:, ['Balance_' + child_bond,
-                                                   'Principal_' + child_bond,
-                                                   'Interest_Due_' + child_bond,
-                                                   'Interest_Paid_' + child_bond,
-                                                   'Cashflow_' + child_bond]] = \
-                    pro_rata_bonds[child_bond].loc[:, ['Balance_' + child_bond,
-                                                       'Principal_' + child_bond,
-                                                       'Interest_Due_' + child_bond,
-                                                       'Interest_Paid_' + child_bond,
-                                                       'Cashflow_' + child_bond]].applymap(
-                        lambda x: x * split['child_bonds'][child_bond])
+            pac_principal_paid[period] = paid
+            pac_unpaid_principal[period] = pac_accrued_unpaid
 
-                self.waterfall = self.waterfall.merge(pro_rata_bonds[child_bond], left_index=True, right_index=True)
+            pac_new_balance -= paid
+            support_new_balance = support_new_balance - support_principal_paid[period]
 
-        for key in pro_rata_bonds.keys():
-            self._bond_waterfalls[key] = pro_rata_bonds[key]
+        support_names = [support['Bond'] for support in supports]
 
-        self.waterfall.drop(self.waterfall.columns[self.waterfall.columns.str.contains('_' + current_bond + '$')],
-                            axis=1,
-                            inplace=True)
+        columns = [('PAC_lower_' + str(int(lower_band * 100)), lower_principal),
+                   ('PAC_upper_' + str(int(upper_band * 100)), upper_principal),
+                   ('PAC_principal_due', pac_principal_due),
+                   ('available_principal', available_principal),
+                   ('PAC_balance', pac_balance)]
+        columns += [(name + '_balance', support_balance[:, i]) for i, name in enumerate(support_names)]
+        columns += [('PAC_unpaid_principal', pac_unpaid_principal),
+                    ('PAC_principal_paid', pac_principal_paid)]
+        columns += [(name + '_principal_paid', support_principal_paid[:, i]) for i, name in enumerate(support_names)]
 
-    def calc_PAC_and_support(self, collateral_waterfall, lower_band=1, upper_band=3):
+        return pd.DataFrame(dict(columns), index=collateral_waterfall.index, columns=[name for name, _ in columns])
 
+    @staticmethod
+    def return_PAC_Support_avg_life(waterfall):
         """
 
-        :param collateral_waterfall: actual waterfall for underlying collateral
-        :param lower_band: psa speed for determining lower_band payment schedule
-        :param upper_band: psa speed for determining upper_band payment schedule
-        :return: dataframe containing waterfall for PAC and Support bonds
+        :param waterfall: dataframe containing waterfalls for PAC and Support bonds, i.e. from calc_PAC_and_support
+        :return: [weighted average life PAC bond, weighted average life of each support bond in order]
         """
 
-        # create collateral waterfall at psa speed for the lower band
-
-        lower_df = self._create_collateral_waterfall
-
-        # create collateral waterfall at psa speed for the higher band
-
-        upper_df = self._create_collateral_waterfall
+        paid_columns = ['PAC_principal_paid'] + [column for column in waterfall.columns
+                                                 if column.endswith('_principal_paid') and
+                                                 column != 'PAC_principal_paid']
 
-        # copy principal paydown schedules for the two bands to a new dataframe we will work in
+        return [(waterfall.index.values * waterfall[column]).sum() / waterfall[column].sum() / 12
+                for column in paid_columns]
 
-        pac_df = pd.DataFrame(data=[lower_df.total_principal.values,
-                                    upper_df.total_principal.values],
-                              ).T
-        pac_df.columns = ['PAC_lower_' + str(int(lower_band * 100)), 'PAC_upper_' + str(int(upper_band * 100))]
-        pac_df.index = collateral_waterfall.index
 
-        # PAC bond principal due is the minimum of the scheduled principal payment from the lower and upper band
+def collateral_terms(collateral):
+    """ Original balance, pass-thru coupon, WAC and WAM of a collateral waterfall, i.e. from
+    collateral_waterfall.create_loan_level_waterfall, read off its first period and its length """
 
-        pac_df['PAC_principal_due'] = pac_df.apply(
-            min, axis=1)
+    first = collateral.iloc[0]
 
-        # Principal available to pay down PAC and Support bond is the total principal from the collateral
+    paying_balance = float(first['beginning_balance'])
+    if 'performing_balance' in collateral and 'defaults' in collateral:
+        paying_balance = float(first['performing_balance'] - first['defaults'])
 
-        pac_df['available_principal'] = collateral_waterfall.total_principal
+    pass_thru_cpn = float(first['net_interest']) / paying_balance * 12
+    wac = pass_thru_cpn
+    if 'mortgage_payments' in collateral:
+        wac = float(first['mortgage_payments'] - first['scheduled_principal']) / paying_balance * 12
 
-        # PAC initial principal size is the sum of all the scheduled principal payments for the bond
+    return float(first['beginning_balance']), pass_thru_cpn, wac, len(collateral)
 
-        pac_initial_balance = pac_df.PAC_principal_due.sum()
-        pac_new_balance = pac_initial_balance
-
-        # Support bond initial principal size is the balance remaining from the underlying collateral and the PAC bond
 
-        support_initial_balance = collateral_waterfall.loc[1, 'beginning_balance'] - pac_initial_balance
-        support_new_balance = support_initial_balance
+def bond_coupons(bonds, index_rates=None):
+    """ Coupon of each bond, fixed or reset off an index every period.
 
-        pac_df.loc[1, 'PAC_balance'] = pac_initial_balance
-        pac_df.loc[1, 'Support_balance'] = support_initial_balance
+    Fixed bonds pay their 'Coupon'. A 'floater' pays 'Margin' + 'Leverage' * index and an 'inverse floater' pays
+    'Margin' - 'Leverage' * index, both bounded by 'Floor' (0 by default) and 'Cap' (no cap by default), with a
+    'Leverage' of 1 by default, i.e. {'Bond': 'IF', 'Balance': 25e6, 'Type': 'inverse floater', 'Margin': 0.27,
+    'Leverage': 3., 'Cap': 0.27}. Bonds whose 'Type' is their credit class, like the senior/subordinate bonds of
+    subordination.py, give the floater type as 'Coupon_Type' instead. Every bond, period and path is evaluated in one
+    broadcast.
 
-        pac_df['PAC_unpaid_principal'] = 0
-        pac_df['PAC_principal_paid'] = 0
-        pac_df['Support_principal_paid'] = 0
+    :param bonds: CMO bond list
+    :param index_rates: index rate each period, last axis is the period, i.e. (paths, periods) rate paths
+    :return: (bonds,) coupons when no bond floats, otherwise (..., periods, bonds) coupons
+    """
 
-        for period, values in pac_df.loc[1:].iterrows():
+    types = [bond.get('Coupon_Type', _bond_type(bond)) for bond in bonds]
+    floating = np.array([bond_type in FLOATER_TYPES for bond_type in types])
 
-            # iterate through periods and determine values for each row
+    if not floating.any():
+        return np.array([bond['Coupon'] for bond in bonds], dtype=float)
 
-            pac_accrued_unpaid = 0
+    if index_rates is None:
+        raise ValueError('Floater and inverse floater bonds need index rates')
 
-            if period > 1:
-                pac_accrued_unpaid = pac_df.loc[period - 1, 'PAC_unpaid_principal']
+    margin = np.array([bond.get('Margin', 0.) if floats else bond['Coupon'] for bond, floats in zip(bonds, floating)],
+                      dtype=float)
+    leverage = np.array([{'floater': 1., 'inverse floater': -1.}.get(bond_type, 0.) * bond.get('Leverage', 1.)
+                         for bond, bond_type in zip(bonds, types)], dtype=float)
+    floor = np.array([bond.get('Floor', 0.) if floats else -np.inf for bond, floats in zip(bonds, floating)],
+                     dtype=float)
+    cap = np.array([bond.get('Cap', np.inf) if floats else np.inf for bond, floats in zip(bonds, floating)],
+                   dtype=float)
 
-                # updated balances are the prior period balance less any principal payments during that period
+    index_rates = np.asarray(index_rates, dtype=float)[..., np.newaxis]
 
-                pac_new_balance = pac_df.loc[period - 1, 'PAC_balance'] - pac_df.loc[period - 1, 'PAC_principal_paid']
-                support_new_balance = pac_df.loc[period - 1, 'Support_balance'] - pac_df.loc[
-                    period - 1, 'Support_principal_paid']
+    return np.clip(margin + leverage * index_rates, floor, cap)
 
-                pac_df.loc[period, 'PAC_balance'] = pac_new_balance
-                pac_df.loc[period, 'Support_balance'] = support_new_balance
 
-            # current period PAC principal due is the scheduled principal for the period + any accrued unpaid principal
-            # if there wasn't enough principal cash flow in earlier periods to cover the scheduled PAC principal payment
+def sequential_pay_cash_flows(net_interest, total_principal, balances, coupons, is_accrual, losses=None):
+    """ Sequential pay waterfall with accrual (Z) bond interest directed to the non-accrual bonds' principal.
+    Collateral losses write down the bonds in reverse order of priority after principal is paid.
 
-            pac_principal_due = values['PAC_principal_due'] + pac_accrued_unpaid
-            principal_available = values['available_principal']
+    Tranche state lives in float64 arrays of shape (..., bonds) and the period loop only touches those arrays.
+    Collateral flows may carry leading scenario or path axes, i.e. (paths, periods), and every path is run at once.
 
-            # PAC principal payment is the min. of PAC principal due including accrued or available principal from
-            # collateral, since we can not pay more principal than available from the collateral
+    :param net_interest: collateral interest available each period, last axis is the period
+    :param total_principal: collateral principal available each period, same shape as net_interest
+    :param balances: original balance of each bond, in payment priority order
+    :param coupons: annual coupon of each bond, or (..., periods, bonds) coupons each period from bond_coupons whose
+    leading path axes broadcast against the collateral flows
+    :param is_accrual: boolean for each bond, True for accrual bonds
+    :param losses: optional collateral losses each period, same shape as net_interest
+    :return: dict of arrays shaped (..., periods, bonds) for 'balance', 'principal', 'writedown', 'interest_due',
+    'interest_paid' and 'cashflow', plus (..., periods) arrays for 'remaining_interest' and 'remaining_principal'. 'principal' nets
+    accreted interest against principal paid; 'principal_paid' is the principal cash actually paid to each bond.
+    """
 
-            pac_principal_paid = min(pac_principal_due, principal_available)
+    net_interest = np.asarray(net_interest, dtype=float)
+    total_principal = np.asarray(total_principal, dtype=float)
+    coupons = np.asarray(coupons, dtype=float)
+    is_accrual = np.asarray(is_accrual, dtype=bool)
 
-            # Support bond receives remaining principal after necessary PAC payment is met
+    periods = net_interest.shape[-1]
+    nbonds = coupons.shape[-1]
 
-            support_principal_paid = max(min(support_new_balance, principal_available - pac_principal_paid), 0)
+    if coupons.ndim > 1:
+        shape = np.broadcast(net_interest[..., 0], coupons[..., 0, 0]).shape + (periods,)
+        net_interest = np.broadcast_to(net_interest, shape)
+        total_principal = np.broadcast_to(total_principal, shape)
+        coupons = np.broadcast_to(coupons, shape + (nbonds,))
 
-            pac_principal_paid += (principal_available - pac_principal_paid - support_principal_paid)
+    if losses is not None:
+        losses = np.broadcast_to(np.asarray(losses, dtype=float), net_interest.shape)
 
-            unpaid_principal = max(pac_df.loc[:period, 'PAC_principal_due'].sum() -
-                                   (pac_df.loc[:period, 'PAC_principal_paid'].sum() + pac_principal_paid), 0)
+    paths = net_interest.shape[:-1]
 
-            pac_df.loc[period, ['PAC_principal_paid',
-                                'PAC_unpaid_principal',
-                                'Support_principal_paid']] = [pac_principal_paid,
-                                                              unpaid_principal,
-                                                              support_principal_paid]
+    balance = np.empty(paths + (periods, nbonds))
+    principal = np.empty(paths + (periods, nbonds))
+    interest_due = np.empty(paths + (periods, nbonds))
+    interest_paid = np.empty(paths + (periods, nbonds))
+    principal_paid = np.empty(paths + (periods, nbonds))
+    writedown = np.zeros(paths + (periods, nbonds))
+    remaining_interest = np.empty(paths + (periods,))
+    remaining_principal = np.empty(paths + (periods,))
 
-        return pac_df
+    current_balance = np.broadcast_to(np.asarray(balances, dtype=float), paths + (nbonds,)).copy()
 
-    @staticmethod
-    def return_PAC_Support_avg_life(waterfall):
-        """
+    for period in range(periods):
+        rem_interest_cash = net_interest[..., period].copy()
+        rem_principal_cash = total_principal[..., period].copy()
 
-        :param waterfall: dataframe containing waterfalls for PAC and Support bonds
-        :return: [weighted average life PAC bond, weighted average life Support bond]
-        """
+        non_accrual_principal = current_balance[..., ~is_accrual].sum(axis=-1)
 
-        pac = (waterfall.index.values * waterfall.PAC_principal_paid).sum() / (waterfall.PAC_principal_paid.sum()) / 12
+        due = current_balance * ((coupons[..., period, :] if coupons.ndim > 1 else coupons) / 12)
+        paid = np.empty_like(due)
 
-        support = (waterfall.index.values * waterfall.Support_principal_paid).sum() / (
-            waterfall.Support_principal_paid.sum()) / 12
+        # pay interest
 
-        return [pac, support]
+        for i in range(nbonds):
+            if is_accrual[i]:
+                # redirect the accrual bond's interest to pay down as much non-accrual principal as possible
+                non_accrual_rem_principal = np.maximum(non_accrual_principal - rem_principal_cash, 0)
+                redirected = np.minimum(due[..., i], non_accrual_rem_principal)
+                paid[..., i] = due[..., i] - redirected
+
+                rem_interest_cash -= due[..., i]
+                rem_principal_cash += redirected
+            else:
+                paid[..., i] = np.minimum(due[..., i], rem_interest_cash)
+                rem_interest_cash -= paid[..., i]
+
+        # unpaid interest accretes to the bond balance
+
+        period_principal = paid - due
+
+        # pay principal
+
+        for i in range(nbonds):
+            principal_cash_flow = np.where(rem_principal_cash > 0,
+                                           np.minimum(current_balance[..., i], rem_principal_cash),
+                                           0.)
+            period_principal[..., i] += principal_cash_flow
+            principal_paid[..., period, i] = principal_cash_flow
+            rem_principal_cash -= principal_cash_flow
+
+        # write down the most junior bonds first
+
+        if losses is not None:
+            rem_loss = losses[..., period].copy()
+            for i in reversed(range(nbonds)):
+                written_down = np.clip(current_balance[..., i] - period_principal[..., i], 0, rem_loss)
+                writedown[..., period, i] = written_down
+                rem_loss -= written_down
+
+        balance[..., period, :] = current_balance
+        principal[..., period, :] = period_principal
+        interest_due[..., period, :] = due
+        interest_paid[..., period, :] = paid
+        remaining_interest[..., period] = rem_interest_cash
+        remaining_principal[..., period] = rem_principal_cash
+
+        current_balance = current_balance - period_principal - writedown[..., period, :]
+
+    return {
+        'balance': balance,
+        'principal': principal,
+        'interest_due': interest_due,
+        'interest_paid': interest_paid,
+        'principal_paid': principal_paid,
+        'writedown': writedown,
+        'cashflow': interest_paid + principal,
+        'remaining_interest': remaining_interest,
+        'remaining_principal': remaining_principal
+    }
 
 
 def _bond_type(bond: dict) -> object:
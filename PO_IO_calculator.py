@@ -1,23 +1,125 @@
+""" Splits note rate cohorts into principal only (PO), WAC interest only (IO) and pass-through security strips.
+
+Cohorts with a net note rate above the security coupon strip their excess interest into the WAC IO on their full
+balance. Cohorts below the coupon give up the fraction (coupon - net note rate) / coupon of their balance to the PO
+so the rest pays the security coupon. """
+
+import numpy as np
+import pandas as pd
+
+import collateral_waterfall as cw
 from PoolCohorts import pool
 
+STRIP_COLUMNS = ['po_balance', 'po_cash_flow', 'io_notional', 'io_cash_flow', 'security_balance',
+                 'security_principal', 'security_interest']
+
+
+def strip_splits(note_rate, base_servicing=0.0025, trustee_fee=0.00009, security_coupon=0.0575):
+    """ Vectorized PO/IO split of note rates
+
+    :param note_rate: array of cohort note rates
+    :return: net note rates, WAC IO strip rates (net note rate above the coupon) and PO percents of balance
+    """
+
+    net_note_rate = np.asarray(note_rate, dtype=float) - base_servicing - trustee_fee
+
+    io_strip = np.maximum(net_note_rate - security_coupon, 0.)
+    po_percent = np.maximum((security_coupon - net_note_rate) / security_coupon, 0.)
+
+    return net_note_rate, io_strip, po_percent
+
 
 def calc_po_and_io(df=pool, base_servicing=0.0025, trustee_fee=0.00009, security_coupon=0.0575, print_summary=False):
-    df['net_note_rate'] = pool.Note_Rate - base_servicing - trustee_fee
-    df['diff_nn_cpn'] = pool.net_note_rate - security_coupon
-    df['net_contr_to_WAC'] = [max(0, diff) for diff in pool.diff_nn_cpn]
-    df['po_percent'] = [max(0.0, (security_coupon - rate) / security_coupon) for rate in pool.net_note_rate]
-    df['po_balance'] = pool.po_percent * pool.Balance
-    df['io_face'] = pool.Balance[pool.diff_nn_cpn > 0]
-    df.fillna(0, inplace=True)
+    """ Returns a copy of the cohort table df (Balance and Note_Rate columns) with its PO and IO splits added. df is
+    not modified, so the function is safe to call repeatedly or concurrently on a shared table. """
+
+    net_note_rate, io_strip, po_percent = strip_splits(df['Note_Rate'].values, base_servicing, trustee_fee,
+                                                       security_coupon)
+    balance = df['Balance'].values.astype(float)
+
+    df = df.copy()
+    df['net_note_rate'] = net_note_rate
+    df['diff_nn_cpn'] = net_note_rate - security_coupon
+    df['net_contr_to_WAC'] = io_strip
+    df['po_percent'] = po_percent
+    df['po_balance'] = po_percent * balance
+    df['io_face'] = np.where(net_note_rate > security_coupon, balance, 0.)
 
     if print_summary:
         print("""
             Total Pool: ${0:,.0f}
             PO balance: ${1:,.0f}
-            IO face:    ${2:,.0f}""".format(pool.Balance.sum(), pool.po_balance.sum(), pool.io_face.sum()))
+            IO face:    ${2:,.0f}""".format(balance.sum(), df['po_balance'].sum(), df['io_face'].sum()))
 
     return df
 
 
+def po_io_cash_flows(df=pool, base_servicing=0.0025, trustee_fee=0.00009, security_coupon=0.0575, wam=360, age=0,
+                     psa_speed=1.0, cpr_description='.2 ramp 6 for 30, 6', chunk_size=1000):
+    """ Projects every cohort through the collateral engine and aggregates the cash flows by strip.
+
+    Cash flows are linear in balance, so cohorts sharing a note rate, term, age and speed are merged and projected
+    once. The merged cohorts are projected chunk_size rows at a time with collateral_waterfall.create_batch_waterfalls
+    at their net note rate and summed into running totals, so memory depends on chunk_size rather than the number of
+    cohorts.
+
+    :param df: cohort table with Balance and Note_Rate columns
+    :param wam: remaining term of each cohort, or one term for all cohorts
+    :param age: age of each cohort, or one age for all cohorts
+    :param psa_speed: prepayment speed of each cohort, or one speed for all cohorts
+    :return: dataframe indexed by month with STRIP_COLUMNS: PO balance and cash flow, WAC IO notional and cash flow,
+    and the security balance, principal and interest
+    """
+
+    # merge cohorts with the same projection inputs
+
+    inputs = np.column_stack(np.broadcast_arrays(*[np.asarray(x, dtype=float) for x in
+                                                   [df['Note_Rate'].values, wam, age, psa_speed]]))
+    inputs, cohort = np.unique(inputs, axis=0, return_inverse=True)
+    balance = np.bincount(cohort.ravel(), weights=df['Balance'].values.astype(float), minlength=len(inputs))
+
+    note_rate, wam, age, psa_speed = inputs.T
+    ncohorts = len(inputs)
+    months = int(np.max(wam))
+
+    totals = {column: np.zeros(months) for column in STRIP_COLUMNS}
+
+    for start in range(0, ncohorts, chunk_size):
+        stop = min(start + chunk_size, ncohorts)
+
+        net_note_rate, io_strip, po_percent = strip_splits(note_rate[start:stop], base_servicing, trustee_fee,
+                                                           security_coupon)
+
+        flows = cw.create_batch_waterfalls(original_balance=balance[start:stop],
+                                           wac=note_rate[start:stop],
+                                           pass_thru_cpn=net_note_rate,
+                                           wam=wam[start:stop],
+                                           age=age[start:stop],
+                                           psa_speed=psa_speed[start:stop],
+                                           cpr_description=cpr_description,
+                                           servicing_fee=base_servicing)
+
+        paying_balance = flows['performing_balance'] - flows['defaults']
+        po_percent, io_strip = po_percent[:, np.newaxis], io_strip[:, np.newaxis]
+
+        io_cash_flow = paying_balance * io_strip / 12.
+        po_cash_flow = flows['total_principal'] * po_percent
+
+        chunk = {'po_balance': flows['beginning_balance'] * po_percent,
+                 'po_cash_flow': po_cash_flow,
+                 'io_notional': np.where(io_strip > 0, paying_balance, 0.),
+                 'io_cash_flow': io_cash_flow,
+                 'security_balance': flows['beginning_balance'] * (1. - po_percent),
+                 'security_principal': flows['total_principal'] - po_cash_flow,
+                 'security_interest': flows['net_interest'] - io_cash_flow}
+
+        for column, total in totals.items():
+            chunk_total = chunk[column].sum(axis=0)
+            total[:len(chunk_total)] += chunk_total
+
+    return pd.DataFrame(totals, index=pd.Index(range(1, months + 1), name='month'), columns=STRIP_COLUMNS)
+
+
 if __name__ == "__main__":
     calc_po_and_io(print_summary=True)
+    print(po_io_cash_flows().head())
@@ -0,0 +1,292 @@
+""" Offline benchmark harness for the pricing engine entry points.
+
+Times each entry point over a set of sizes, records the best and mean time of several runs and the peak memory
+allocated by one run, and writes the results as JSON. When given a baseline file from an earlier run, exits with a
+non-zero status if any benchmark is slower, or allocates more memory at its peak, than the baseline by more than the
+threshold.
+
+    python benchmarks.py --output results.json
+    python benchmarks.py --baseline results.json --threshold 0.25 --memory-threshold 0.1
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import collateral_waterfall as cw
+import prepayment_calcs as pc
+from bond_pricing import BondPricing
+from CMO_waterfall import CMO
+from collateral_cache import waterfall_cache
+
+BENCHMARKS = []
+
+
+def benchmark(name, sizes):
+    """ Registers a benchmark. The decorated function takes the keyword arguments of one entry of sizes, does any
+    setup, and returns the callable that is timed. """
+
+    def register(setup):
+        BENCHMARKS.append((name, sizes, setup))
+        return setup
+
+    return register
+
+
+def _clear_caches():
+    waterfall_cache.clear()
+    pc.parse_cpr_description.cache_clear()
+    pc._compile_cpr_curve.cache_clear()
+
+
+def _bonds(tranches, zbond=False, balance=100e6):
+    bonds = [{'Bond': 'T{0}'.format(i), 'Balance': balance / tranches, 'Coupon': 0.05 + 0.002 * i}
+             for i in range(tranches)]
+    if zbond:
+        bonds[-1]['Type'] = 'accrual'
+
+    return bonds
+
+
+def _cmo(wam, tranches, zbond=False):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return CMO(bonds=_bonds(tranches, zbond), original_balance=100e6, pass_thru_cpn=0.055, wac=0.06,
+                   wam=wam, original_maturity=max(wam, 360), psa_speed=1.5)
+
+
+@benchmark('create_waterfall', [{'wam': 120}, {'wam': 360}])
+def _create_waterfall(wam):
+    return lambda: cw.create_waterfall(original_balance=100e6, wam=wam, psa_speed=1.5)
+
+
+@benchmark('create_batch_waterfalls', [{'pools': 20}, {'pools': 1000}])
+def _create_batch_waterfalls(pools):
+    random_state = np.random.RandomState(0)
+    wac = random_state.uniform(0.04, 0.08, pools)
+    balance = random_state.uniform(1e6, 50e6, pools)
+    age = random_state.randint(0, 60, pools)
+
+    return lambda: cw.create_batch_waterfalls(balance, wac, wac - 0.005, 360, age, 1.5)
+
+
+@benchmark('CMO', [{'wam': 360, 'tranches': 3, 'zbond': False},
+                   {'wam': 360, 'tranches': 3, 'zbond': True},
+                   {'wam': 360, 'tranches': 10, 'zbond': False},
+                   {'wam': 360, 'tranches': 10, 'zbond': True},
+                   {'wam': 120, 'tranches': 3, 'zbond': True}])
+def _cmo_construction(wam, tranches, zbond):
+    return lambda: _cmo(wam, tranches, zbond)
+
+
+@benchmark('create_pro_rata_bonds', [{'tranches': 3}, {'tranches': 10}])
+def _create_pro_rata_bonds(tranches):
+    def run():
+        struct = _cmo(360, tranches)
+        struct.create_pro_rata_bonds([{'source_bond': 'T0', 'child_bonds': {'T0a': 0.4, 'T0b': 0.6}}])
+
+    return run
+
+
+@benchmark('calc_PAC_and_support', [{'wam': 120}, {'wam': 360}])
+def _calc_pac_and_support(wam):
+    struct = _cmo(wam, 3)
+    return lambda: struct.calc_PAC_and_support(struct.collateral_waterfall, lower_band=1, upper_band=3)
+
+
+@benchmark('cpr_curve_creator', [{'periods': 360}, {'periods': 720}])
+def _cpr_curve_creator(periods):
+    return lambda: pc.cpr_curve_creator('0 for 20, .2 ramp 6 for 30, 9 for 15, 9 ramp 8 for 35, 2 ramp 7 for 70, 6',
+                                        periods=periods)
+
+
+@benchmark('prepayment_curve_from_passive_active_composition', [{'periods': 120}, {'periods': 360}])
+def _passive_active_composition(periods):
+    return lambda: pc.prepayment_curve_from_passive_active_composition(0.05, 0.5, 0.005, 0.5, periods)
+
+
+@benchmark('population_prepayments', [{'pools': 1, 'populations': 2}, {'pools': 1000, 'populations': 4}])
+def _population_prepayments(pools, populations):
+    random_state = np.random.RandomState(0)
+    smm = random_state.uniform(0., 0.05, (pools, populations, 360))
+    amounts = random_state.uniform(0., 1., (pools, populations))
+
+    return lambda: pc.population_prepayments(smm, amounts, 360)
+
+
+@benchmark('BondPricing', [{'maturities': 4}, {'maturities': 30}])
+def _bond_pricing(maturities):
+    years = np.arange(1., maturities + 1)
+    bonds = pd.DataFrame({'Face': 100., 'Maturity': years, 'Coupon': 2. + 0.1 * years, 'Price': 100.,
+                          'coupon_freq': 1})
+
+    return lambda: BondPricing(bonds.copy())
+
+
+@benchmark('spot_from_par', [{'maturities': 4}, {'maturities': 30}])
+def _spot_from_par(maturities):
+    years = np.arange(1., maturities + 1)
+    par_bonds = pd.DataFrame({'Maturity': years, 'Yield': 2. + 0.1 * years})
+
+    return lambda: BondPricing.spot_from_par(par_bonds.copy())
+
+
+@benchmark('calc_po_and_io', [{'pools': 20}, {'pools': 10000}])
+def _calc_po_and_io(pools):
+    from PO_IO_calculator import calc_po_and_io
+
+    random_state = np.random.RandomState(0)
+    cohorts = pd.DataFrame({'Balance': random_state.uniform(1e6, 50e6, pools),
+                            'Note_Rate': random_state.choice(np.arange(5., 7.5, 0.125) / 100, pools)})
+
+    return lambda: calc_po_and_io(df=cohorts.copy())
+
+
+def run_benchmarks(repeat=5, names=None):
+    """
+    :param repeat: number of timed runs of each benchmark
+    :param names: optional list of benchmark names to run
+    :return: list of result dicts with name, params, best and mean seconds and peak traced memory in bytes, or the
+    error raised by the entry point
+    """
+
+    results = []
+
+    for name, sizes, setup in BENCHMARKS:
+        if names and name not in names:
+            continue
+
+        for params in sizes:
+            result = {'name': name, 'params': params}
+
+            try:
+                run = setup(**params)
+
+                timings = []
+                for _ in range(repeat):
+                    _clear_caches()
+                    start = time.perf_counter()
+                    run()
+                    timings.append(time.perf_counter() - start)
+
+                _clear_caches()
+                tracemalloc.start()
+                run()
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+                result.update({'seconds': min(timings), 'mean_seconds': sum(timings) / len(timings),
+                               'peak_bytes': peak})
+            except Exception as error:
+                if tracemalloc.is_tracing():
+                    tracemalloc.stop()
+                result['error'] = '{0}: {1}'.format(type(error).__name__, error)
+
+            results.append(result)
+
+    return results
+
+
+def _result_key(result):
+    return result['name'], json.dumps(result['params'], sort_keys=True)
+
+
+def compare_to_baseline(results, baseline, threshold=0.25, metric='seconds'):
+    """ Returns a list of (name, params, baseline value, value) for results whose metric is above the matching
+    baseline result's by more than threshold, i.e. 0.25 for 25%
+
+    :param metric: result field to compare, 'seconds', 'mean_seconds' or 'peak_bytes'
+    """
+
+    key = _result_key
+    previous = {key(result): result for result in baseline['results'] if metric in result}
+
+    regressions = []
+    for result in results:
+        old = previous.get(key(result))
+        if old is not None and metric in result and result[metric] > old[metric] * (1 + threshold):
+            regressions.append((result['name'], result['params'], old[metric], result[metric]))
+
+    return regressions
+
+
+def missing_from_baseline(results, baseline):
+    """ Returns (name, params) of the timed results without a timed baseline result and of the timed baseline
+    results of the benchmarks that were run but are missing from results """
+
+    timed = set(_result_key(result) for result in results if 'seconds' in result)
+    errored = set(_result_key(result) for result in results if 'error' in result)
+    previous = set(_result_key(result) for result in baseline['results'] if 'seconds' in result)
+    run = set(result['name'] for result in results)
+
+    missing = sorted(timed - previous) + sorted(key for key in previous - timed - errored if key[0] in run)
+
+    return [(name, json.loads(params)) for name, params in missing]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', help='write results as JSON to this file instead of stdout')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed slowdown against the baseline as a fraction, default 0.25')
+    parser.add_argument('--memory-threshold', type=float,
+                        help='allowed growth of peak memory against the baseline as a fraction, default --threshold')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per benchmark, default 5')
+    parser.add_argument('--only', nargs='*', help='names of benchmarks to run')
+    args = parser.parse_args(argv)
+
+    report = {'python': platform.python_version(),
+              'numpy': np.__version__,
+              'pandas': pd.__version__,
+              'repeat': args.repeat,
+              'results': run_benchmarks(args.repeat, args.only)}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    failed = False
+
+    for result in report['results']:
+        if 'error' in result:
+            print('ERROR {0} {1}: {2}'.format(result['name'], result['params'], result['error']), file=sys.stderr)
+            failed = True
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = compare_to_baseline(report['results'], baseline, args.threshold)
+
+        for name, params, old, new in regressions:
+            print('REGRESSION {0} {1}: {2:.6f}s -> {3:.6f}s ({4:+.0%})'.format(name, params, old, new, new / old - 1),
+                  file=sys.stderr)
+
+        memory_threshold = args.threshold if args.memory_threshold is None else args.memory_threshold
+        memory_regressions = compare_to_baseline(report['results'], baseline, memory_threshold, 'peak_bytes')
+
+        for name, params, old, new in memory_regressions:
+            print('REGRESSION {0} {1}: {2:,} -> {3:,} peak bytes ({4:+.0%})'.format(name, params, old, new,
+                                                                                    new / old - 1), file=sys.stderr)
+
+        for name, params in missing_from_baseline(report['results'], baseline):
+            print('MISSING {0} {1}: no timing to compare against'.format(name, params), file=sys.stderr)
+            failed = True
+
+        failed = failed or bool(regressions) or bool(memory_regressions)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
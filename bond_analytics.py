@@ -0,0 +1,134 @@
+""" Vectorized price, yield, average life and duration analytics for every tranche of a CMO waterfall.
+
+Cash flows are (tranches x periods) matrices of monthly payments and prices are (tranches x points) grids, so a
+full price/yield table for a deal is a handful of array operations. Yields are mortgage equivalent (monthly
+compounded) unless converted with utils.bey_from_mey, and durations are in years."""
+
+import numpy as np
+import pandas as pd
+
+import utils
+from yield_curve import monthly_yields
+
+
+def tranche_cash_flows(waterfall, bonds=None):
+    """ Extracts the cash received and principal received by each tranche from a CMO waterfall.
+
+    Cashflow_ and Principal_ net the interest an accrual bond accretes, so the accreted interest
+    (Interest_Due_ less Interest_Paid_) is added back to get the cash actually paid.
+
+    :param waterfall: CMO.waterfall dataframe
+    :param bonds: bond names to extract, every bond with a Cashflow_ column by default
+    :return: bond names, (tranches x periods) cash flows, (tranches x periods) principal, original balances
+    """
+
+    if bonds is None:
+        bonds = [column[len('Cashflow_'):] for column in waterfall.columns if column.startswith('Cashflow_')]
+
+    def matrix(prefix):
+        return waterfall[[prefix + bond for bond in bonds]].values.astype(float).T
+
+    accreted = matrix('Interest_Due_') - matrix('Interest_Paid_')
+    cash_flows = matrix('Cashflow_') + accreted
+    principal = matrix('Principal_') + accreted
+    balances = matrix('Balance_')[:, 0]
+
+    return bonds, cash_flows, principal, balances
+
+
+def price_from_yield(cash_flows, yields):
+    """
+    :param cash_flows: (tranches x periods) monthly cash flows
+    :param yields: (tranches x points) mortgage equivalent yields, or anything broadcasting to it
+    :return: (tranches x points) prices in the units of the cash flows
+    """
+
+    months = np.arange(1, cash_flows.shape[1] + 1)
+    yields = np.asarray(yields, dtype=float)
+    discount = (1 + yields[..., np.newaxis] / 12.) ** -months
+
+    return (cash_flows[:, np.newaxis, :] * discount).sum(axis=-1)
+
+
+def yield_from_price(cash_flows, prices, guess=0.06):
+    """ Solves yields for every tranche and price point at once with Newton's method
+
+    :param cash_flows: (tranches x periods) monthly cash flows
+    :param prices: (tranches x points) prices in the units of the cash flows
+    :return: (tranches x points) mortgage equivalent yields
+    """
+
+    prices = np.asarray(prices, dtype=float)
+    points = prices.shape[1]
+
+    rates = monthly_yields(np.repeat(cash_flows, points, axis=0),
+                           prices.ravel(),
+                           np.full(prices.size, guess / 12.))
+
+    return rates.reshape(prices.shape) * 12.
+
+
+def weighted_average_life(principal):
+    """ Weighted average life in years of each row of a (tranches x periods) principal matrix """
+
+    months = np.arange(1, principal.shape[1] + 1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (principal * months).sum(axis=1) / principal.sum(axis=1) / 12.
+
+
+def macaulay_duration(cash_flows, yields):
+    """ (tranches x points) Macaulay durations in years at mortgage equivalent yields """
+
+    months = np.arange(1, cash_flows.shape[1] + 1)
+    discounted = cash_flows[:, np.newaxis, :] * (1 + np.asarray(yields, dtype=float)[..., np.newaxis] / 12.) ** -months
+
+    return (discounted * months).sum(axis=-1) / discounted.sum(axis=-1) / 12.
+
+
+def modified_duration(cash_flows, yields):
+    """ (tranches x points) modified durations in years at mortgage equivalent yields """
+
+    return macaulay_duration(cash_flows, yields) / (1 + np.asarray(yields, dtype=float) / 12.)
+
+
+def convexity(cash_flows, yields):
+    """ (tranches x points) convexities in years squared at mortgage equivalent yields """
+
+    months = np.arange(1, cash_flows.shape[1] + 1)
+    growth = 1 + np.asarray(yields, dtype=float)[..., np.newaxis] / 12.
+    discounted = cash_flows[:, np.newaxis, :] * growth ** -months
+
+    return (discounted * months * (months + 1)).sum(axis=-1) / (growth[..., 0] ** 2 * discounted.sum(axis=-1)) / 144.
+
+
+def price_yield_table(waterfall, prices, bonds=None):
+    """ Price/yield table for every tranche of a CMO waterfall at every price point.
+
+    :param waterfall: CMO.waterfall dataframe
+    :param prices: price points as a percent of each tranche's original balance, one list shared by all tranches or
+    a (tranches x points) array
+    :param bonds: bond names to include, all by default
+    :return: long format dataframe with one row per bond and price: Price, Yield (mortgage equivalent), BEY, WAL,
+    Macaulay_Duration, Modified_Duration and Convexity
+    """
+
+    bonds, cash_flows, principal, balances = tranche_cash_flows(waterfall, bonds)
+
+    prices = np.broadcast_to(np.asarray(prices, dtype=float), (len(bonds), np.shape(prices)[-1]))
+    yields = yield_from_price(cash_flows, prices / 100. * balances[:, np.newaxis])
+
+    wal = np.broadcast_to(weighted_average_life(principal)[:, np.newaxis], prices.shape)
+
+    columns = [('Price', prices),
+               ('Yield', yields),
+               ('BEY', utils.bey_from_mey(yields)),
+               ('WAL', wal),
+               ('Macaulay_Duration', macaulay_duration(cash_flows, yields)),
+               ('Modified_Duration', modified_duration(cash_flows, yields)),
+               ('Convexity', convexity(cash_flows, yields))]
+
+    table = pd.DataFrame({name: values.ravel() for name, values in columns}, columns=[name for name, _ in columns])
+    table.insert(0, 'Bond', np.repeat(bonds, prices.shape[1]))
+
+    return table
@@ -20,67 +20,80 @@ class BondPricing:
 
         return par / (1 + ytm) ** time
 
-    def _bond_intermediate_coupon_npv(self, coupon, frequency, periods):
-        coupon_amt = coupon / frequency
-
-        coupon_npv = 0
-
-        for i in range(1, periods):
-            # range is exclusive of the end so this will give us the first and second
-            # coupons which is what we need to discount; the final coupon will be
-            # evaluated with the principal payment to determine the spot rate for that
-            # period.
-
-            # determine which period we are evaluating
-            period = i / frequency
-
-            # get the spot rate for the period from dataframe
-            period_spot = self.bonds.loc[self.bonds['Maturity'] ==
-                                           period, 'spot_rate'].values
-
-            discounted_value = coupon_amt / np.exp(period_spot * period)
-
-            coupon_npv += discounted_value[0]
-
-        return coupon_npv
-
-
-    def _spot_rate(self, par, price, maturity, coupon=0, frequency=2):
-        coupon_npv = 0
+    def _append_spot_rate(self):
+        self.bonds['spot_rate'] = self.bootstrap_spot_rates(self.bonds['Face'].values,
+                                                            self.bonds['Price'].values,
+                                                            self.bonds['Maturity'].values,
+                                                            self.bonds['Coupon'].values,
+                                                            self.bonds['coupon_freq'].values)
 
-        if coupon != 0:
-            try:
-                coupon_npv = self._bond_intermediate_coupon_npv(
-                    coupon,
-                    frequency,
-                    periods=np.int(maturity * frequency))
-            except:
-                coupon_npv = coupon
+    @staticmethod
+    def bootstrap_spot_rates(face, price, maturity, coupon=0, frequency=2):
+        """ Bootstraps continuously compounded spot rates from bond prices.
+
+        Bonds are sorted by maturity once and the discount factor of each maturity is kept in an array. A bond's
+        intermediate coupons are discounted with the discount factors of the bonds maturing on its coupon dates; when
+        the maturities so far are exactly its coupon dates, i.e. a regular annual or monthly grid, that is the running
+        sum of the discount factors so far.
+
+        :param face: face value of each bond
+        :param price: price of each bond, or a (curves x bonds) array to bootstrap many curves at once
+        :param maturity: maturity in years of each bond
+        :param coupon: annual coupon of each bond in the same units as face
+        :param frequency: coupon payments per year of each bond
+        :return: spot rates in the shape of price and the order of the input bonds
+        """
+
+        maturity = np.asarray(maturity, dtype=float)
+        nbonds = len(maturity)
+        face, coupon, frequency = [np.broadcast_to(np.asarray(x, dtype=float), (nbonds,))
+                                   for x in (face, coupon, frequency)]
+        price = np.asarray(price, dtype=float)
+
+        order = np.argsort(maturity, kind='mergesort')
+        sorted_maturity = maturity[order]
+
+        # is every maturity so far on the coupon grid of a bond paying at the common frequency
+
+        if np.all(frequency == frequency[0]):
+            on_grid = np.isclose(sorted_maturity * frequency[0], np.arange(1, nbonds + 1))
+            grid_so_far = np.logical_and.accumulate(on_grid)
+        else:
+            grid_so_far = np.zeros(nbonds, dtype=bool)
 
+        discount = np.empty(price.shape[:-1] + (nbonds,))
+        spots = np.empty(price.shape)
+        running_discount = np.zeros(price.shape[:-1])
 
-        # add the final coupon to final cash flow if it
-        # falls on a coupon payment period
+        for k, bond in enumerate(order):
+            coupon_amt = coupon[bond] / frequency[bond]
+            coupon_periods = maturity[bond] * frequency[bond]
+            periods = int(np.floor(coupon_periods + 1e-9))
+            coupon_npv = 0.
 
-        final_flow = par + coupon / frequency if maturity % (1 / frequency) == 0 else par
+            # discount the intermediate coupons; the final coupon is evaluated with the principal payment to
+            # determine the spot rate for this maturity
 
-        # reduce the present value cost of the bond by the present value of
-        # intermediate coupon payments, if any
+            if coupon_amt != 0 and periods > 1:
+                if periods - 1 == k and grid_so_far[k - 1]:
+                    coupon_npv = coupon_amt * running_discount
+                else:
+                    times = np.arange(1, periods) / frequency[bond]
+                    position = np.minimum(np.searchsorted(sorted_maturity[:k], times - 1e-9), max(k - 1, 0))
+                    if k == 0 or not np.allclose(sorted_maturity[position], times):
+                        raise ValueError('Unable to bootstrap bond maturing in {0} years, no bond matures on each of '
+                                         'its coupon dates'.format(maturity[bond]))
+                    coupon_npv = coupon_amt * discount[..., position].sum(axis=-1)
 
-        final_price = price - coupon_npv
+            # add the final coupon to final cash flow if it falls on a coupon payment period
 
-        total_interest_earned = final_flow / final_price
-        spot = ((1 / maturity) * np.log(total_interest_earned))
-        total_interest_earned = total_interest_earned - 1
+            final_flow = face[bond] + coupon_amt if abs(coupon_periods - round(coupon_periods)) < 1e-9 else face[bond]
 
-        return spot, total_interest_earned
+            discount[..., k] = (price[..., bond] - coupon_npv) / final_flow
+            spots[..., bond] = np.log(1. / discount[..., k]) / maturity[bond]
+            running_discount = running_discount + discount[..., k]
 
-    def _append_spot_rate(self):
-        for k, v in self.bonds.iterrows():
-            self.bonds.set_value(k, 'spot_rate', self._spot_rate(v['Face'],
-                                                             v['Price'],
-                                                             v['Maturity'],
-                                                             v['Coupon'],
-                                                             v['coupon_freq'])[0])
+        return spots
 
     @staticmethod
     def spot_from_par(par_bonds=None):
@@ -93,22 +106,32 @@ class BondPricing:
                 {'Maturity': 4., 'Yield': 10.},
             ])
 
-        par_bonds.loc[0, 'spot_rate'] = par_bonds.loc[0, 'Yield']
-        for i in np.arange(1, len(par_bonds)):
-            result = 0
-            for j in range(i):
-                # print(i,j)
-                # print('{0:.10f} / ( 1 + {1:.10f}/100)**({2:.0f})'.format(par_bonds.loc[i, 'Yield'],
-                #                                                          par_bonds.loc[j, 'spot_rate'],
-                #                                                          j + 1))
-                a = par_bonds.loc[i, 'Yield'] / (1. + par_bonds.loc[j, 'spot_rate'] / 100.) ** (j + 1.)
-                result += a
-            par_bonds.loc[i, 'spot_rate'] = (((100. + par_bonds.loc[i, 'Yield']) / (100. - result)) ** (
-            1. / (i + 1.)) - 1.) * 100
+        par_bonds['spot_rate'] = BondPricing.spot_rates_from_par_yields(par_bonds['Yield'].values)
 
         par_bonds.set_index('Maturity', inplace=True)
         return par_bonds
 
+    @staticmethod
+    def spot_rates_from_par_yields(par_yields):
+        """ Annually compounded spot rates in percent from par yields in percent of annual pay bonds maturing in
+        consecutive years.
+
+        Each spot rate only needs the running sum of the discount factors of the earlier years, so the curve is built
+        in one pass. par_yields may be a (curves x maturities) array, i.e. the rows of a history file, to bootstrap
+        every curve at once.
+        """
+
+        par_yields = np.asarray(par_yields, dtype=float)
+        spots = np.empty(par_yields.shape)
+        running_discount = np.zeros(par_yields.shape[:-1])
+
+        for i in range(par_yields.shape[-1]):
+            par_yield = par_yields[..., i]
+            spots[..., i] = (((100. + par_yield) / (100. - par_yield * running_discount)) ** (1. / (i + 1.)) - 1.) * 100
+            running_discount = running_discount + (1. + spots[..., i] / 100.) ** -(i + 1.)
+
+        return spots
+
     @staticmethod
     def forward_rate(r1, t1, r2, t2, continuous=True):
         if continuous:
@@ -0,0 +1,147 @@
+""" Content addressed cache of collateral waterfalls keyed by their normalized inputs """
+
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# format of cached waterfalls, bump whenever the columns or their meaning change so older cached waterfalls are
+# missed instead of served; 2 added the default, recovery and loss columns
+
+CACHE_VERSION = 2
+
+
+class CollateralCache:
+    '''
+    Least recently used in-memory cache of waterfall dataframes bounded by total memory use, with an optional
+    on-disk tier of pickled waterfalls that survives between sessions.
+
+    Waterfalls are copied going in and coming out so callers can modify what they get back.
+    '''
+
+    def __init__(self, max_bytes=256 * 2 ** 20, directory=None):
+        """
+        :param max_bytes: memory bound for cached waterfalls, 0 disables the in-memory tier
+        :param directory: folder for the on-disk tier, None to keep the cache in memory only
+        """
+
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(kind, original_balance, pass_thru_cpn, wac, wam, original_maturity, servicing, psa_speed,
+            cpr_description, sda_speed=0., cdr_description=None, severity=None, recovery_lag=None):
+        """ Normalized cache key. Speed vectors are reduced to a hash of their values over the wam and the CPR and
+        CDR descriptions are reduced to their comma separated instructions with single spaces. Default inputs are
+        left out of the key when sda_speed is 0, since they do not change the waterfall. The key starts with
+        CACHE_VERSION. """
+
+        def speed(values):
+            values = np.asarray(values, dtype=float)
+            if values.ndim:
+                return hashlib.sha1(np.ascontiguousarray(values[:int(wam)]).tobytes()).hexdigest()
+            return float(values)
+
+        def description(text):
+            return ','.join(' '.join(part.split()) for part in str(text).lower().split(','))
+
+        key = (CACHE_VERSION, kind, float(original_balance), float(pass_thru_cpn), float(wac), int(wam), int(original_maturity),
+               None if servicing is None else float(servicing), speed(psa_speed), description(cpr_description))
+
+        if np.any(sda_speed):
+            key += (speed(sda_speed), description(cdr_description), float(severity), int(recovery_lag))
+
+        return key
+
+    def get_or_create(self, key, create):
+        """ Returns the cached waterfall for key, calling create() to build and store it on a miss """
+
+        waterfall = self.get(key)
+        if waterfall is None:
+            waterfall = create()
+            self.put(key, waterfall)
+
+        return waterfall
+
+    def get(self, key):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key].copy()
+
+        path = self._path(key)
+        if path is not None and os.path.exists(path):
+            payload = pd.read_pickle(path)
+            if isinstance(payload, dict) and payload.get('version') == CACHE_VERSION:
+                waterfall = payload['waterfall']
+                self._store(key, waterfall)
+                self.disk_hits += 1
+                return waterfall.copy()
+
+        self.misses += 1
+        return None
+
+    def put(self, key, waterfall):
+        waterfall = waterfall.copy()
+        self._store(key, waterfall)
+
+        path = self._path(key)
+        if path is not None:
+            pd.to_pickle({'version': CACHE_VERSION, 'waterfall': waterfall}, path)
+
+    def clear(self, disk=False):
+        """ Empties the in-memory tier and resets the statistics, and the on-disk tier when disk is True """
+
+        self._entries.clear()
+        self._bytes = 0
+        self.hits = self.disk_hits = self.misses = 0
+
+        if disk and self.directory is not None:
+            for name in os.listdir(self.directory):
+                if name.endswith('.pkl'):
+                    os.remove(os.path.join(self.directory, name))
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+
+        return {'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.}
+
+    def _store(self, key, waterfall):
+        size = int(waterfall.memory_usage(index=True).sum())
+        if size > self.max_bytes:
+            return
+
+        if key in self._entries:
+            self._bytes -= int(self._entries.pop(key).memory_usage(index=True).sum())
+
+        self._entries[key] = waterfall
+        self._bytes += size
+
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= int(evicted.memory_usage(index=True).sum())
+
+    def _path(self, key):
+        if self.directory is None:
+            return None
+
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest() + '.pkl')
+
+
+waterfall_cache = CollateralCache()
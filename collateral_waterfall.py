@@ -1,113 +1,447 @@
 """ Module for producing waterfall tables based on input collateral criteria. AKA amortization table."""
 
+from collections import namedtuple
+
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
+import default_calcs as dc
 import prepayment_calcs as pc
+from collateral_cache import waterfall_cache
+
+
+WATERFALL_COLUMNS = ['beginning_balance', 'SMM', 'ending_balance', 'mortgage_payments', 'net_interest',
+                     'scheduled_principal', 'prepayments', 'total_principal', 'cash_flow', 'servicing', 'other_fees',
+                     'performing_balance', 'MDR', 'defaults', 'recoveries', 'losses']
 
 
 def create_waterfall(original_balance=400e6, pass_thru_cpn=0.055, wac=0.06, wam=358, psa_speed=1.0,
-                     cpr_description='.2 ramp 6 for 30, 6', servicing_fee=0):
+                     cpr_description='.2 ramp 6 for 30, 6', servicing_fee=0, sda_speed=0.,
+                     cdr_description=dc.SDA_DESCRIPTION, severity=0.35, recovery_lag=12):
     """ Takes collateral summary inputs based on aggregations equaling total original balance, average pass-thru-coupon,
     weighted average coupon of underlying loans, weighted average maturity of underlying loans, psa speed multiplier
     for prepayment curve, and constant prepayment rate curve description.
 
-    CPR description is turned into a list of CPRs which are then run through the SMM function for period SMMs."""
+    CPR description is turned into a list of CPRs which are then run through the SMM function for period SMMs.
 
-    cpr_curve = pc.cpr_curve_creator(cpr_description)
-    age = 360 - wam
+    Defaults follow the CDR curve described by cdr_description, 100 SDA by default, scaled by sda_speed; the default
+    sda_speed of 0 models voluntary prepayments only. Defaulted balances are liquidated recovery_lag months later
+    with a loss of severity times the defaulted balance.
 
-    index = pd.Index(range(1, wam + 1), name='month')
+    Waterfalls are memoized in collateral_cache.waterfall_cache by their normalized inputs."""
 
-    beg_balance = np.zeros(wam)
+    def build():
+        smm = smm_vector(cpr_description, psa_speed, wam)
+        mdr = mdr_vector(cdr_description, sda_speed, wam)
 
-    try:
-        smm = np.array([pc.smm(cpr_curve[period - 1] * psa_speed[period - 1]) for period in index])
-    except:
-        smm = np.array([pc.smm(cpr_curve[period - 1] * psa_speed) for period in index])
+        flows = collateral_cash_flows(original_balance, pass_thru_cpn, wac, wam, smm, servicing_fee,
+                                      mdr=mdr, severity=severity, recovery_lag=recovery_lag)
 
-    rem_cols = pd.DataFrame({
-        'ending_balance': np.zeros(wam),
-        'mortgage_payments': np.zeros(wam),
-        'net_interest': np.zeros(wam),
-        'scheduled_principal': np.zeros(wam),
-        'prepayments': np.zeros(wam),
-        'total_principal': np.zeros(wam),
-        'cash_flow': np.zeros(wam),
-        'servicing': np.zeros(wam),
-        'other_fees': np.zeros(wam)
-    }, index=index)
+        return pd.DataFrame(flows, index=pd.Index(range(1, wam + 1), name='month'), columns=WATERFALL_COLUMNS)
 
-    waterfall = pd.DataFrame(data=[beg_balance, smm]).T
-    waterfall.columns = ['beginning_balance', 'SMM']
-    waterfall.index = index
-    waterfall = waterfall.join(rem_cols)
+    key = waterfall_cache.key('create_waterfall', original_balance, pass_thru_cpn, wac, wam, 360, servicing_fee,
+                              psa_speed, cpr_description, sda_speed, cdr_description, severity, recovery_lag)
 
-    for ix, row in waterfall.iterrows():
+    return waterfall_cache.get_or_create(key, build)
 
-        if ix == 1:
-            beginning_balance = original_balance
-        else:
-            beginning_balance = waterfall['beginning_balance'].ix[ix - 1] - waterfall['total_principal'].ix[
-                ix - 1]
 
-        row['beginning_balance'] = beginning_balance
+def smm_vector(cpr_description, psa_speed, nperiods):
+    """ Returns the period SMMs for the first nperiods of the CPR curve described by cpr_description, scaled by
+    psa_speed. psa_speed can be a single multiplier, a vector of per period multipliers, or an array of them with the
+    period on the last axis."""
+
+    cpr_curve = pc.cpr_curve_creator(cpr_description, periods=nperiods)
+
+    psa_speed = np.asarray(psa_speed, dtype=float)
+    if psa_speed.ndim:
+        psa_speed = psa_speed[..., :nperiods]
+
+    return pc.smm(cpr_curve * psa_speed)
+
+
+def mdr_vector(cdr_description, sda_speed, nperiods):
+    """ Returns the period MDRs for the first nperiods of the CDR curve described by cdr_description, in the CPR
+    description format, scaled by sda_speed. sda_speed can be a single multiplier, a vector of per period
+    multipliers, or an array of them with the period on the last axis, i.e. a (paths, 1) column of path speeds."""
+
+    cdr_curve = pc.cpr_curve_creator(cdr_description, periods=nperiods)
+
+    sda_speed = np.asarray(sda_speed, dtype=float)
+    if sda_speed.ndim:
+        sda_speed = sda_speed[..., :nperiods]
+
+    return dc.mdr(cdr_curve * sda_speed)
+
+
+def collateral_cash_flows(original_balance, pass_thru_cpn, wac, wam, smm, servicing_fee=0, mdr=0., severity=0.,
+                          recovery_lag=0):
+    """ Array engine behind create_waterfall. Computes every period at once instead of walking the table row by row.
+
+    The performing balance at the start of a period is the original balance scaled by the cumulative survival factor
+    from prepayments and defaults, the product of (1 - SMM) * (1 - MDR) over prior periods, and the scheduled balance
+    percent from schedule_of_ending_balances. Defaults are MDR times the performing balance; the rest of the
+    performing balance pays interest, amortizes by the drop in the scheduled balance percent, and prepays at SMM.
+
+    Defaulted balances are liquidated recovery_lag periods later, or at the end of the wam if that comes first, paying
+    (1 - severity) of the defaulted balance as principal and writing off the rest as losses. The beginning balance is
+    the performing balance plus the balance awaiting liquidation.
+
+    Collateral inputs may also be column vectors of pools, shape (pools, 1), with smm shaped (pools, months) to
+    project many pools at once. Pools with a wam shorter than the number of months pay nothing after maturity.
+
+    :param smm: period SMMs, the last axis is the month
+    :param mdr: period monthly default rates, broadcasting against smm
+    :param severity: loss as a fraction of the defaulted balance
+    :param recovery_lag: whole months from default to liquidation
+    :return: dict of numpy arrays keyed by the create_waterfall column names
+    """
+
+    smm, mdr = np.broadcast_arrays(np.asarray(smm, dtype=float), np.asarray(mdr, dtype=float))
+    months = smm.shape[-1]
+
+    bal_percent = scheduled_balance_percent(wac, wam, np.arange(months + 1))
+    survival = np.concatenate((np.ones(smm.shape[:-1] + (1,)),
+                               np.cumprod((1. - smm[..., :-1]) * (1. - mdr[..., :-1]), axis=-1)), axis=-1)
+
+    performing_balance = original_balance * survival * bal_percent[..., :-1]
+    defaults = performing_balance * mdr
+    paying_balance = performing_balance - defaults
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scheduled_factor = np.where(bal_percent[..., :-1] > 0, bal_percent[..., 1:] / bal_percent[..., :-1], 0.)
 
-        mortgage_payments = -np.pmt(rate=wac / 12.,
-                                    nper=wam - ix + 1,
-                                    pv=row['beginning_balance'],
-                                    fv=0.,
-                                    when='end')
-        row['mortgage_payments'] = mortgage_payments
+    liquidations = _liquidations(defaults, int(recovery_lag), wam)
+    recoveries = liquidations * (1. - severity)
+    losses = liquidations * severity
 
-        net_interest = beginning_balance * pass_thru_cpn / 12.
-        row['net_interest'] = net_interest
+    awaiting_liquidation = np.concatenate((np.zeros(smm.shape[:-1] + (1,)),
+                                           np.cumsum(defaults - liquidations, axis=-1)[..., :-1]), axis=-1)
+    beginning_balance = performing_balance + awaiting_liquidation
 
-        gross_coupon = beginning_balance * (wac / 12.)
+    scheduled_principal = paying_balance * (1. - scheduled_factor)
+    gross_coupon = paying_balance * (wac / 12.)
+    mortgage_payments = scheduled_principal + gross_coupon
+    net_interest = paying_balance * pass_thru_cpn / 12.
+    prepayments = smm * (paying_balance - scheduled_principal)
+    total_principal = scheduled_principal + prepayments + recoveries
+    cash_flow = net_interest + total_principal
+    servicing = paying_balance * servicing_fee / 12
+    other_fees = mortgage_payments + prepayments + recoveries - total_principal - net_interest - servicing
 
-        scheduled_principal = mortgage_payments - gross_coupon
-        row['scheduled_principal'] = scheduled_principal
+    _check_cash_sufficiency(total_principal, gross_coupon, mortgage_payments, prepayments + recoveries, cash_flow)
 
-        prepayments = row['SMM'] * (beginning_balance - scheduled_principal)
-        row['prepayments'] = prepayments
+    return {
+        'beginning_balance': beginning_balance,
+        'SMM': smm,
+        'ending_balance': beginning_balance - total_principal - losses,
+        'mortgage_payments': mortgage_payments,
+        'net_interest': net_interest,
+        'scheduled_principal': scheduled_principal,
+        'prepayments': prepayments,
+        'total_principal': total_principal,
+        'cash_flow': cash_flow,
+        'servicing': servicing,
+        'other_fees': other_fees,
+        'performing_balance': performing_balance,
+        'MDR': mdr,
+        'defaults': defaults,
+        'recoveries': recoveries,
+        'losses': losses
+    }
 
-        total_principal = scheduled_principal + prepayments
-        row['total_principal'] = total_principal
 
-        cash_flow = net_interest + total_principal
-        row['cash_flow'] = cash_flow
+def _liquidations(defaults, recovery_lag, wam):
+    """ Defaulted balance liquidated each period, shifting defaults recovery_lag periods along the last axis and
+    liquidating whatever is still outstanding in the last period of each pool's wam """
 
-        servicing = beginning_balance * servicing_fee / 12
-        row['servicing'] = servicing
+    if recovery_lag <= 0:
+        return defaults
 
-        other_fees = mortgage_payments + prepayments \
-                     - total_principal - net_interest - servicing
-        row['other_fees'] = other_fees
+    months = defaults.shape[-1]
+    cumulative_defaults = np.cumsum(defaults, axis=-1)
+
+    lagged = np.zeros_like(cumulative_defaults)
+    lagged[..., recovery_lag:] = cumulative_defaults[..., :max(months - recovery_lag, 0)]
 
-        row['ending_balance'] = beginning_balance - total_principal
+    final = np.arange(months) >= np.asarray(wam) - 1
+    cumulative_liquidations = np.where(final, cumulative_defaults[..., -1:], lagged)
 
-        # checks
+    return np.diff(np.concatenate((np.zeros(cumulative_liquidations.shape[:-1] + (1,)), cumulative_liquidations),
+                                  axis=-1), axis=-1)
 
-        if round(total_principal, 2) + round(gross_coupon, 2) > \
-                                round(mortgage_payments, 2) + round(prepayments, 2) + 1:
-            print("""
+
+def _check_cash_sufficiency(total_principal, gross_coupon, mortgage_payments, prepayments, cash_flow):
+    """ Raises if any period pays out more than the collateral brings in, with recoveries counted in prepayments """
+
+    inflows = np.round(mortgage_payments, 2) + np.round(prepayments, 2) + 1
+    shortfall = (np.round(total_principal, 2) + np.round(gross_coupon, 2) > inflows) | (cash_flow > inflows)
+
+    if shortfall.any():
+        first = tuple(np.argwhere(shortfall)[0])
+        print("""
 total_principal:\t{0:.2f}\ngross_coupon:\t\t{1:.2f}
 mortgage_payments:\t{2:.2f}\nprepayments:\t\t{3:.2f}""".format(
-                total_principal, gross_coupon, mortgage_payments, prepayments
-            ))
-            raise ValueError("""Unable to computer waterfall table
-                             Not enough inflow cash available for outflows
-                             (i.e. total principal + gross coupon >
-                                mortgage _payments + prepayments)""")
+            total_principal[first], gross_coupon[first], mortgage_payments[first], prepayments[first]
+        ))
+        raise ValueError("""Unable to computer waterfall table in period {0}
+                         Not enough inflow cash available for outflows
+                         (i.e. total principal + gross coupon or cash_flow >
+                            mortgage _payments + prepayments)""".format(first[-1] + 1))
+
+
+def create_batch_waterfalls(original_balance, wac, pass_thru_cpn, wam, age=0, psa_speed=1.0,
+                            cpr_description='.2 ramp 6 for 30, 6', servicing_fee=0, sda_speed=0.,
+                            cdr_description=dc.SDA_DESCRIPTION, severity=0.35, recovery_lag=12):
+    """ Projects many pools in one pass. Each input is either a single value shared by all pools or an array with
+    one entry per pool, i.e. the Balance and Note_Rate columns of a cohort table. recovery_lag is shared by all pools.
+
+    Pools pick up the CPR and CDR curves at their age, so a pool with age 0 matches create_waterfall. Pools amortize
+    over their wam and the matrices run to the longest wam in the batch.
+
+    :return: dict of (pools x months) numpy arrays keyed by the create_waterfall column names
+    """
+
+    original_balance, wac, pass_thru_cpn, wam, age, psa_speed, servicing_fee, sda_speed, severity = [
+        a[:, np.newaxis] for a in np.broadcast_arrays(*[np.atleast_1d(np.asarray(x, dtype=float)) for x in
+                                                        [original_balance, wac, pass_thru_cpn, wam, age, psa_speed,
+                                                         servicing_fee, sda_speed, severity]])]
+
+    wam = wam.astype(int)
+    months = np.arange(wam.max())
+    seasoned = age.astype(int) + months
+
+    cpr_curve = pc.cpr_curve_creator(cpr_description, periods=int(age.max()) + len(months))
+    smm = np.where(months < wam, pc.smm(cpr_curve[seasoned] * psa_speed), 0.)
+
+    if np.any(sda_speed):
+        cdr_curve = pc.cpr_curve_creator(cdr_description, periods=int(age.max()) + len(months))
+        mdr = np.where(months < wam, dc.mdr(cdr_curve[seasoned] * sda_speed), 0.)
+    else:
+        mdr = np.zeros_like(smm)
+
+    return collateral_cash_flows(original_balance, pass_thru_cpn, wac, wam, smm, servicing_fee,
+                                 mdr=mdr, severity=severity, recovery_lag=recovery_lag)
+
+
+def aggregate_batch_waterfalls(flows):
+    """ Rolls create_batch_waterfalls output up into a single pool level waterfall with the create_waterfall columns.
+    Dollar columns are summed across pools and SMM and MDR are recomputed from the aggregate prepayments and
+    defaults."""
+
+    return _waterfall_from_totals({column: values.sum(axis=0) for column, values in flows.items()
+                                   if column not in ('SMM', 'MDR')})
+
+
+def create_loan_level_waterfall(balance, note_rate, remaining_term, age=0, servicing=0, psa_speed=1.0,
+                                cpr_description='.2 ramp 6 for 30, 6', chunk_size=1000, sda_speed=0.,
+                                cdr_description=dc.SDA_DESCRIPTION, severity=0.35, recovery_lag=12):
+    """ Projects a loan level tape and streams the results into pool level period totals.
+
+    Loans are read chunk_size rows at a time from columnar arrays (numpy arrays, memory mapped arrays or pandas
+    Series), projected together with create_batch_waterfalls, and summed into running totals, so peak memory depends
+    on chunk_size and the longest remaining term rather than the number of loans. Each loan passes through its
+    note rate less its servicing.
+
+    :param balance: current balance of each loan
+    :param note_rate: note rate of each loan
+    :param remaining_term: remaining term in months of each loan
+    :param age: age in months of each loan, or one age for all loans
+    :param servicing: servicing fee of each loan, or one fee for all loans
+    :param sda_speed: default speed of each loan, or one speed for all loans
+    :param severity: loss severity of each loan, or one severity for all loans
+    :return: dataframe with the create_waterfall columns, usable as the collateral of a CMO
+    """
+
+    def rows(values, start, stop):
+        return np.asarray(values[start:stop], dtype=float) if np.ndim(values) else values
+
+    nloans = len(balance)
+    months = int(np.max(remaining_term))
+
+    totals = {column: np.zeros(months) for column in WATERFALL_COLUMNS if column not in ('SMM', 'MDR')}
+
+    for start in range(0, nloans, chunk_size):
+        stop = min(start + chunk_size, nloans)
+        rate = rows(note_rate, start, stop)
+        fee = rows(servicing, start, stop)
+
+        flows = create_batch_waterfalls(original_balance=rows(balance, start, stop),
+                                        wac=rate,
+                                        pass_thru_cpn=rate - fee,
+                                        wam=rows(remaining_term, start, stop),
+                                        age=rows(age, start, stop),
+                                        psa_speed=rows(psa_speed, start, stop),
+                                        cpr_description=cpr_description,
+                                        servicing_fee=fee,
+                                        sda_speed=rows(sda_speed, start, stop),
+                                        cdr_description=cdr_description,
+                                        severity=rows(severity, start, stop),
+                                        recovery_lag=recovery_lag)
+
+        for column, total in totals.items():
+            chunk_total = flows[column].sum(axis=0)
+            total[:len(chunk_total)] += chunk_total
+
+    return _waterfall_from_totals(totals)
+
+
+def _waterfall_from_totals(totals):
+    """ Builds a pool level waterfall from summed dollar columns, recomputing SMM and MDR from the aggregate
+    prepayments and defaults """
+
+    paying = totals['performing_balance'] - totals['defaults']
+    prepayable = paying - totals['scheduled_principal']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        totals['SMM'] = np.where(prepayable > 0, totals['prepayments'] / prepayable, 0.)
+        totals['MDR'] = np.where(totals['performing_balance'] > 0,
+                                 totals['defaults'] / totals['performing_balance'], 0.)
+
+    return pd.DataFrame(totals, index=pd.Index(range(1, len(prepayable) + 1), name='month'),
+                        columns=WATERFALL_COLUMNS)
+
+
+# Point a projection can resume from: the performing balance, the loan age in months, the months left to amortize,
+# and the defaulted balance awaiting liquidation in each of the next recovery_lag months
+
+CollateralState = namedtuple('CollateralState', ['balance', 'age', 'remaining_term', 'pending_liquidations'])
+CollateralState.__new__.__defaults__ = ((),)
+
+
+class CollateralProjection:
+    '''
+    Incremental projection of a pool that computes its waterfall lazily, one block of periods at a time, and can stop
+    at a horizon or once the pool pays off.
+
+    state holds where the projection stands after the last block yielded. It can be saved and handed to a new
+    CollateralProjection to continue, i.e. from the factor reported in a monthly remittance, with the same results as
+    an uninterrupted projection from origination.
+
+        projection = CollateralProjection(CollateralState(400e6, 0, 360), pass_thru_cpn=0.055, wac=0.06)
+        for block in projection.blocks(block_size=12, horizon=36):
+            ...
+        saved = projection.state
+    '''
+
+    def __init__(self, state, pass_thru_cpn, wac, psa_speed=1.0, cpr_description='.2 ramp 6 for 30, 6',
+                 servicing_fee=0, sda_speed=0., cdr_description=dc.SDA_DESCRIPTION, severity=0.35, recovery_lag=12):
+        """
+        :param state: CollateralState to start from, i.e. CollateralState(balance, age, remaining_term)
+        :param psa_speed: single multiplier or a vector of multipliers indexed by loan age in months
+        :param sda_speed: single multiplier or a vector of multipliers indexed by loan age in months
+
+        The other inputs are those of create_waterfall.
+        """
+
+        self.state = CollateralState(*state)
+        self.pass_thru_cpn = pass_thru_cpn
+        self.wac = wac
+        self.psa_speed = psa_speed
+        self.cpr_description = cpr_description
+        self.servicing_fee = servicing_fee
+        self.sda_speed = sda_speed
+        self.cdr_description = cdr_description
+        self.severity = severity
+        self.recovery_lag = int(recovery_lag)
+
+    def blocks(self, block_size=12, horizon=None, tolerance=0.005):
+        """ Yields waterfall dataframes of up to block_size periods with the create_waterfall columns, indexed by loan
+        age, until horizon periods are projected, the remaining term runs out, or the balance falls below tolerance.
+        state is updated before each block is yielded. """
+
+        projected = 0
+
+        while self.state.remaining_term > 0 and (horizon is None or projected < horizon):
+            if self.state.balance <= tolerance and sum(self.state.pending_liquidations) <= tolerance:
+                return
+
+            periods = min(block_size, self.state.remaining_term)
+            if horizon is not None:
+                periods = min(periods, horizon - projected)
+
+            block = self._project(int(periods))
+            projected += periods
+
+            outstanding = block['beginning_balance'].values > tolerance
+            if not outstanding.all():
+                if outstanding[0]:
+                    yield block.iloc[:int(np.argmin(outstanding))]
+                return
+
+            yield block
+
+    def periods(self, horizon=None, block_size=12, tolerance=0.005):
+        """ Yields one (month, record) pair per period, where record is a dict keyed by the create_waterfall columns.
+        Periods are still computed block_size at a time. """
+
+        for block in self.blocks(block_size, horizon, tolerance):
+            for month, record in zip(block.index, block.to_dict('records')):
+                yield month, record
+
+    def to_frame(self, horizon=None, block_size=60):
+        """ Projects up to horizon periods, or to payoff, into a single waterfall dataframe """
+
+        frames = list(self.blocks(block_size, horizon))
+        if not frames:
+            return pd.DataFrame(columns=WATERFALL_COLUMNS, index=pd.Index([], name='month'))
+
+        return pd.concat(frames)
+
+    def _speeds(self, speed, ages):
+        speed = np.asarray(speed, dtype=float)
+        return speed[ages] if speed.ndim else speed
+
+    def _project(self, periods):
+        balance, age, remaining_term, pending = self.state
+        age, remaining_term = int(age), int(remaining_term)
+        ages = age + np.arange(periods)
+
+        cpr_curve = pc.cpr_curve_creator(self.cpr_description, periods=age + periods)
+        smm = pc.smm(cpr_curve[ages] * self._speeds(self.psa_speed, ages))
+
+        if np.any(self.sda_speed):
+            cdr_curve = pc.cpr_curve_creator(self.cdr_description, periods=age + periods)
+            mdr = dc.mdr(cdr_curve[ages] * self._speeds(self.sda_speed, ages))
+        else:
+            mdr = np.zeros(periods)
+
+        flows = collateral_cash_flows(balance, self.pass_thru_cpn, self.wac, remaining_term, smm, self.servicing_fee,
+                                      mdr=mdr, severity=self.severity, recovery_lag=self.recovery_lag)
+
+        # liquidate the balance that defaulted before this block, everything left at the end of the term
+
+        pending = np.asarray(pending, dtype=float)
+        final = periods == remaining_term
+        earlier = np.zeros(periods)
+        earlier[:min(len(pending), periods)] = pending[:periods]
+        if final:
+            earlier[-1] += pending[periods:].sum()
+
+        awaiting = pending.sum() - np.concatenate(([0.], np.cumsum(earlier)[:-1]))
+
+        flows['recoveries'] = flows['recoveries'] + earlier * (1. - self.severity)
+        flows['losses'] = flows['losses'] + earlier * self.severity
+        flows['total_principal'] = flows['total_principal'] + earlier * (1. - self.severity)
+        flows['cash_flow'] = flows['cash_flow'] + earlier * (1. - self.severity)
+        flows['beginning_balance'] = flows['beginning_balance'] + awaiting
+        flows['ending_balance'] = flows['beginning_balance'] - flows['total_principal'] - flows['losses']
+
+        # carry defaults that liquidate after this block into the next state
+
+        later = np.zeros(max(self.recovery_lag, 0))
+        if not final and self.recovery_lag > 0:
+            carried = pending[periods:]
+            later[:len(carried)] += carried
+            for period in range(max(periods - self.recovery_lag, 0), periods):
+                later[period + self.recovery_lag - periods] += flows['defaults'][period]
 
-        if cash_flow > round(mortgage_payments, 2) + round(prepayments, 2) + 1:
-            raise ValueError("""Unable to computer waterfall table
-                                 Not enough inflow cash available for outflows
-                                 (i.e. cash_flow >
-                                    mortgage _payments + prepayments)""")
+        ending_performing = (flows['performing_balance'][-1] - flows['defaults'][-1] -
+                             flows['scheduled_principal'][-1] - flows['prepayments'][-1])
 
-    return waterfall
+        self.state = CollateralState(float(ending_performing), age + periods, remaining_term - periods,
+                                     tuple(later.tolist()))
+
+        return pd.DataFrame(flows, index=pd.Index(ages + 1, name='month'), columns=WATERFALL_COLUMNS)
 
 
 def schedule_of_ending_balances(rate, nper, pv):
@@ -118,14 +452,30 @@ def schedule_of_ending_balances(rate, nper, pv):
                       index=[np.arange(0, nper + 1)])
     df.loc[0, 'scheduled_balance'] = pv
 
-    df['bal_percent'] = (1. - (((1. + rate / 12.) ** np.array(df.index) - 1.) /
-                               ((1. + rate / 12.) ** nper - 1.)))
+    df['bal_percent'] = scheduled_balance_percent(rate, nper, np.arange(0, nper + 1))
 
     df.loc[:, 'scheduled_balance'] = df['bal_percent'] * df.loc[0, 'scheduled_balance']
 
     return df
 
 
+def scheduled_balance_percent(rate, nper, periods):
+    """ Returns the scheduled balance as a % of the original balance after each of periods, for an annual rate
+    amortizing over nper months. The balance is zero after nper. rate and nper may be arrays that broadcast
+    against periods."""
+
+    periods = np.asarray(periods, dtype=float)
+    rate = np.asarray(rate, dtype=float)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bal_percent = np.where(rate == 0,
+                               1. - periods / nper,
+                               1. - (((1. + rate / 12.) ** periods - 1.) /
+                                     ((1. + rate / 12.) ** nper - 1.)))
+
+    return np.maximum(bal_percent, 0.)
+
+
 def schedule_of_ending_balance_percent_for_period(rate, nper, age):
     return (1. - ((((1 + rate) ** age) - 1.) /
                   (((1 + rate) ** nper) - 1.)))
@@ -143,20 +493,150 @@ def arm_coupons(rate_curve,
                 total_fees,
                 initial_coupon,
                 periodic_cap):
-    df = pd.DataFrame(index=pd.Index(range(len(rate_curve))),
-                      columns=['rates', 'Gross', 'Net'])
-    df.rates = rate_curve
-    df.loc[0, 'Gross'] = initial_coupon
-
-    for i in range(1, df.index.max() + 1):
-        if df.rates[i] + gross_margin <= df.Gross[i - 1] + periodic_cap:
-            df.loc[i, 'Gross'] = df.rates[i] + gross_margin
-        else:
-            df.loc[i, 'Gross'] = df.Gross[i - 1] + periodic_cap
+    """ Monthly resetting gross and net coupons for a single rate curve, where each month's gross coupon is the rate
+    plus the gross margin, but no more than periodic_cap above the prior month. The first rate is not used. """
 
-    df.loc[:, 'Net'] = df.Gross - total_fees
+    rates = np.array([np.nan if rate is None else rate for rate in rate_curve], dtype=float)
 
-    return df
+    gross = arm_coupon_paths(rates, gross_margin, initial_coupon, first_reset=2, reset_frequency=1,
+                             periodic_cap=periodic_cap, periodic_floor=np.inf, initial_floor=np.inf)
+
+    return pd.DataFrame({'rates': rate_curve, 'Gross': gross, 'Net': gross - total_fees},
+                        index=pd.Index(range(len(rate_curve))), columns=['rates', 'Gross', 'Net'])
+
+
+def arm_coupon_paths(index_rates, margin, initial_coupon, first_reset=61, reset_frequency=12, periodic_cap=0.02,
+                     periodic_floor=None, initial_cap=None, initial_floor=None, lifetime_cap=np.inf,
+                     lifetime_floor=-np.inf, rounding=None):
+    """ Gross coupons of adjustable rate loans across rate paths.
+
+    At each reset the coupon moves to the index plus the margin, limited to periodic_cap above and periodic_floor below
+    the prior coupon (initial_cap and initial_floor at the first reset) and to the lifetime floor and cap, and holds until the next
+    reset. The caps make each coupon depend on the one before, so the engine scans reset by reset, for every loan and
+    path at once, and then spreads the reset coupons over the months between resets.
+
+    Loan inputs broadcast against index_rates without its last axis, i.e. (loans, 1) columns against (paths, periods)
+    index paths.
+
+    :param index_rates: index rate each month, the last axis is the month
+    :param margin: gross margin over the index
+    :param initial_coupon: coupon before the first reset
+    :param first_reset: month of the first reset, 1 for the first month; the reset uses that month's index
+    :param reset_frequency: months between resets
+    :param periodic_cap: largest increase at a reset after the first
+    :param periodic_floor: largest decrease at a reset, periodic_cap by default
+    :param initial_cap: largest increase at the first reset, periodic_cap by default
+    :param initial_floor: largest decrease at the first reset, periodic_floor by default
+    :param lifetime_cap: highest coupon
+    :param lifetime_floor: lowest coupon
+    :param rounding: round the index plus margin to the nearest multiple of rounding, i.e. 0.00125
+    :return: coupons shaped like the broadcast inputs with the month on the last axis
+    """
+
+    index_rates = np.asarray(index_rates, dtype=float)
+    periods = index_rates.shape[-1]
+
+    periodic_floor = periodic_cap if periodic_floor is None else periodic_floor
+    initial_cap = periodic_cap if initial_cap is None else initial_cap
+    initial_floor = periodic_floor if initial_floor is None else initial_floor
+
+    margin, initial_coupon, first_reset, reset_frequency, periodic_cap, periodic_floor, initial_cap, initial_floor, \
+        lifetime_cap, lifetime_floor = np.broadcast_arrays(*[np.asarray(x, dtype=float) for x in
+                                                             [margin, initial_coupon, first_reset, reset_frequency,
+                                                              periodic_cap, periodic_floor, initial_cap, initial_floor,
+                                                              lifetime_cap, lifetime_floor]])
+
+    shape = np.broadcast(margin, index_rates[..., 0]).shape
+    first_reset = np.broadcast_to(first_reset, shape).astype(int)
+    reset_frequency = np.broadcast_to(reset_frequency, shape).astype(int)
+    index_rates = np.broadcast_to(index_rates, shape + (periods,))
+
+    resets = int(np.max(np.maximum(periods - first_reset, -1) // reset_frequency)) + 1
+
+    # coupon after each reset, with the coupon before the first reset in front
+
+    coupons = np.empty(shape + (resets + 1,))
+    coupons[..., 0] = initial_coupon
+    coupon = np.broadcast_to(initial_coupon, shape).copy()
+
+    for reset in range(resets):
+        month = first_reset + reset * reset_frequency
+        happens = month <= periods
+
+        target = np.take_along_axis(index_rates, np.clip(month - 1, 0, periods - 1)[..., np.newaxis],
+                                    axis=-1)[..., 0] + margin
+        if rounding:
+            target = np.round(target / rounding) * rounding
+
+        up, down = (initial_cap, initial_floor) if reset == 0 else (periodic_cap, periodic_floor)
+        reset_coupon = np.clip(np.clip(target, coupon - down, coupon + up), lifetime_floor, lifetime_cap)
+
+        coupon = np.where(happens, reset_coupon, coupon)
+        coupons[..., reset + 1] = coupon
+
+    # number of resets on or before each month
+
+    months = np.arange(1, periods + 1)
+    elapsed = np.where(months >= first_reset[..., np.newaxis],
+                       (months - first_reset[..., np.newaxis]) // reset_frequency[..., np.newaxis] + 1, 0)
+
+    return np.take_along_axis(coupons, np.minimum(elapsed, resets), axis=-1)
+
+
+def arm_cash_flows(original_balance, coupons, remaining_term, smm=0., servicing_fee=0.):
+    """ Amortizes adjustable rate loans whose payment is recast to the level payment over the remaining term
+    whenever the coupon resets.
+
+    Recasting every month at the current coupon gives the same payment as recasting at resets only, so the scheduled
+    principal of each month is the closed form fraction r / ((1 + r)^n - 1) of the balance, for monthly coupon r and n
+    months left, and balances are cumulative products like collateral_cash_flows.
+
+    :param original_balance: balance of each loan, broadcasting against coupons without its last axis
+    :param coupons: annual gross coupons each month from arm_coupon_paths, the last axis is the month
+    :param remaining_term: months left to amortize for each loan
+    :param smm: period SMMs broadcasting against coupons
+    :param servicing_fee: annual fee deducted from the gross coupon for net interest
+    :return: dict of arrays keyed by beginning_balance, coupon, payment, interest, net_interest, scheduled_principal,
+    prepayments, total_principal and ending_balance
+    """
+
+    coupons = np.asarray(coupons, dtype=float)
+    periods = coupons.shape[-1]
+
+    rate = coupons / 12.
+    remaining_term = np.asarray(remaining_term, dtype=float)[..., np.newaxis]
+    months_left = remaining_term - np.arange(periods)
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        principal_fraction = np.where(rate == 0, 1. / months_left, rate / ((1. + rate) ** months_left - 1.))
+    principal_fraction = np.where(months_left > 0, np.minimum(principal_fraction, 1.), 0.)
+
+    smm = np.broadcast_to(np.asarray(smm, dtype=float), np.broadcast(principal_fraction, smm).shape)
+    principal_fraction = np.broadcast_to(principal_fraction, smm.shape)
+    active = np.broadcast_to(months_left > 0, smm.shape)
+
+    survival = np.cumprod((1. - principal_fraction) * (1. - smm), axis=-1)
+    survival = np.concatenate((np.ones(survival.shape[:-1] + (1,)), survival[..., :-1]), axis=-1)
+
+    beginning_balance = np.asarray(original_balance, dtype=float)[..., np.newaxis] * survival
+    beginning_balance = np.where(active, beginning_balance, 0.)
+
+    interest = beginning_balance * rate
+    scheduled_principal = beginning_balance * principal_fraction
+    prepayments = (beginning_balance - scheduled_principal) * smm
+    total_principal = scheduled_principal + prepayments
+
+    return {
+        'beginning_balance': beginning_balance,
+        'coupon': np.broadcast_to(coupons, beginning_balance.shape),
+        'payment': interest + scheduled_principal,
+        'interest': interest,
+        'net_interest': beginning_balance * (coupons - servicing_fee) / 12.,
+        'scheduled_principal': scheduled_principal,
+        'prepayments': prepayments,
+        'total_principal': total_principal,
+        'ending_balance': beginning_balance - total_principal
+    }
 
 
 def example_matrix_of_balance_outstanding_by_age_and_coupon():
@@ -192,10 +672,41 @@ def example_waterfalls_at_different_prepays():
     plt.show()
 
 
+def example_cohort_waterfalls():
+    from PoolCohorts import pool
+
+    flows = create_batch_waterfalls(original_balance=pool.Balance.values,
+                                    wac=pool.Note_Rate.values,
+                                    pass_thru_cpn=pool.Note_Rate.values - 0.0025,
+                                    wam=360,
+                                    psa_speed=1.5)
+
+    return aggregate_batch_waterfalls(flows)
+
+
 def example_arm_coupon_determinations():
     rates = [None, 8.2, 5., 5.75, 4.]
     df = arm_coupons(rates, 1.75, 0.65, 5.1, 1)
 
+    return df
+
+
+def example_arm_book():
+    """ 5/1 ARMs with 2/2/5 caps across simulated index paths """
+
+    random_state = np.random.RandomState(0)
+    loans, paths = 2000, 20
+
+    index_rates = 0.03 + np.cumsum(random_state.normal(0, 0.002, (paths, 360)), axis=-1)
+    margin = random_state.choice([0.0225, 0.0250, 0.0275], loans)[:, np.newaxis]
+    initial_coupon = random_state.uniform(0.035, 0.05, loans)[:, np.newaxis]
+
+    coupons = arm_coupon_paths(index_rates, margin, initial_coupon, first_reset=61, reset_frequency=12,
+                               periodic_cap=0.02, initial_cap=0.02, lifetime_cap=initial_coupon + 0.05,
+                               lifetime_floor=margin, rounding=0.00125)
+
+    return arm_cash_flows(random_state.uniform(1e5, 1e6, loans)[:, np.newaxis], coupons, 360)
+
 # if __name__ == "__main__":
 #     cw = create_waterfall()
 #
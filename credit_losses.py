@@ -0,0 +1,195 @@
+""" Vasicek (one factor Gaussian copula) loss distribution of large homogeneous pools, evaluated for whole grids of
+default probabilities, correlations and loss severities in one broadcast.
+
+The conditional default rate given the common risk factor x is default_calcs.default_rate_normal_dist,
+
+    d = N[ (N.inv(pi) - x*sqrt(p)) / sqrt(1-p) ]
+
+and the loss rate is d times the loss given default. N.inv(pi), sqrt(p) and sqrt(1-p) are computed once per grid
+point when the distribution is created and reused by every evaluation and every Monte Carlo batch."""
+
+import numpy as np
+import scipy.stats as stats
+
+
+class VasicekLoss:
+    '''
+    Loss rate distribution of a large homogeneous pool for a grid of parameters.
+
+    pd, correlation and lgd broadcast together to the grid shape. Every method takes its evaluation points (loss
+    rates, confidence levels or draws) on trailing axes, so results have shape grid shape + points shape.
+    '''
+
+    def __init__(self, pd, correlation, lgd=1.):
+        """
+        :param pd: unconditional probability of default of each asset
+        :param correlation: asset correlation, strictly between 0 and 1
+        :param lgd: loss given default as a fraction of balance
+        """
+
+        pd, correlation, lgd = np.broadcast_arrays(np.asarray(pd, dtype=float),
+                                                   np.asarray(correlation, dtype=float),
+                                                   np.asarray(lgd, dtype=float))
+
+        if np.any((pd < 0) | (pd > 1)):
+            raise ValueError('Probabilities of default must be between 0 and 1')
+        if np.any((correlation <= 0) | (correlation >= 1)):
+            raise ValueError('Correlations must be strictly between 0 and 1')
+        if np.any((lgd <= 0) | (lgd > 1)):
+            raise ValueError('Loss given default must be greater than 0 and at most 1')
+
+        self.pd = pd
+        self.correlation = correlation
+        self.lgd = lgd
+
+        self._threshold = stats.norm.ppf(pd)
+        self._sqrt_rho = np.sqrt(correlation)
+        self._sqrt_1_rho = np.sqrt(1 - correlation)
+
+    @property
+    def shape(self):
+        return self.pd.shape
+
+    def _expand(self, values, ndim):
+        """ Adds ndim trailing axes to grid values so they broadcast against evaluation points """
+
+        return values.reshape(values.shape + (1,) * ndim)
+
+    def _terms(self, points):
+        points = np.asarray(points, dtype=float)
+        return (points,) + tuple(self._expand(values, points.ndim)
+                                 for values in (self._threshold, self._sqrt_rho, self._sqrt_1_rho, self.lgd))
+
+    def conditional_loss(self, factor):
+        """ Loss rate given the common risk factor, default_calcs.default_rate_normal_dist times the lgd """
+
+        factor, threshold, sqrt_rho, sqrt_1_rho, lgd = self._terms(factor)
+        return lgd * stats.norm.cdf((threshold - factor * sqrt_rho) / sqrt_1_rho)
+
+    def cdf(self, loss):
+        """ P(loss rate <= loss), one minus default_calcs.inv_default_rate_normal_dist at loss / lgd """
+
+        loss, threshold, sqrt_rho, sqrt_1_rho, lgd = self._terms(loss)
+        default = stats.norm.ppf(np.clip(loss / lgd, 0., 1.))
+
+        return stats.norm.cdf((sqrt_1_rho * default - threshold) / sqrt_rho)
+
+    def pdf(self, loss):
+        """ Density of the loss rate, zero outside (0, lgd) """
+
+        loss, threshold, sqrt_rho, sqrt_1_rho, lgd = self._terms(loss)
+        rate = loss / lgd
+        inside = (rate > 0) & (rate < 1)
+        default = stats.norm.ppf(np.where(inside, rate, 0.5))
+
+        density = sqrt_1_rho / sqrt_rho * np.exp(0.5 * default ** 2 -
+                                                 0.5 * ((sqrt_1_rho * default - threshold) / sqrt_rho) ** 2) / lgd
+
+        return np.where(inside, density, 0.)
+
+    def quantile(self, confidence):
+        """ Loss rate not exceeded with probability confidence, i.e. the value at risk """
+
+        confidence, threshold, sqrt_rho, sqrt_1_rho, lgd = self._terms(confidence)
+        return lgd * stats.norm.cdf((threshold + sqrt_rho * stats.norm.ppf(confidence)) / sqrt_1_rho)
+
+    value_at_risk = quantile
+
+    def expected_shortfall(self, confidence, nodes=64):
+        """ Mean loss rate beyond the quantile at confidence, integrating the quantile function over
+        [confidence, 1] with Gauss-Legendre quadrature
+
+        :param nodes: number of quadrature nodes
+        """
+
+        confidence = np.asarray(confidence, dtype=float)
+        abscissas, weights = np.polynomial.legendre.leggauss(nodes)
+
+        # nodes on a trailing axis with u = 1 - (1 - confidence) * s^2, which removes the steep end of the quantile
+        # function at u = 1 from the integrand
+
+        s = (abscissas + 1) / 2.
+        levels = 1 - (1 - confidence[..., np.newaxis]) * s ** 2
+
+        return self.quantile(levels).dot(weights * s)
+
+    def expected_tranche_loss(self, attachment, detachment, nodes=64):
+        """ Expected loss of a tranche as a fraction of its size, integrating the probability that the pool loss
+        exceeds each point of [attachment, detachment] with Gauss-Legendre quadrature
+
+        :param attachment: tranche attachment points as pool loss rates
+        :param detachment: tranche detachment points, broadcasting with attachment
+        """
+
+        attachment, detachment = np.broadcast_arrays(np.asarray(attachment, dtype=float),
+                                                     np.asarray(detachment, dtype=float))
+        if np.any(detachment <= attachment):
+            raise ValueError('Detachment points must be above attachment points')
+
+        abscissas, weights = np.polynomial.legendre.leggauss(nodes)
+        points = attachment[..., np.newaxis] + (detachment - attachment)[..., np.newaxis] * (abscissas + 1) / 2.
+
+        return (1 - self.cdf(points)).dot(weights) / 2.
+
+    def simulate(self, ndraws, batch_size=100000, seed=None, antithetic=False, dtype=np.float32):
+        """ Monte Carlo loss rates from draws of the common risk factor, generated in batches so memory is bounded
+        by batch_size draws per grid point
+
+        :param ndraws: total number of draws
+        :param antithetic: pair every factor draw with its negative
+        :param dtype: float type of the yielded loss rates, float32 by default to halve memory
+        :return: generator of (grid shape + (batch,)) loss rate arrays
+        """
+
+        random_state = np.random.RandomState(seed)
+        drawn = 0
+
+        while drawn < ndraws:
+            size = min(batch_size, ndraws - drawn)
+
+            if antithetic:
+                half = random_state.standard_normal((size + 1) // 2)
+                factor = np.concatenate((half, -half))[:size]
+            else:
+                factor = random_state.standard_normal(size)
+
+            yield self.conditional_loss(factor).astype(dtype, copy=False)
+            drawn += size
+
+
+def tranche_losses(losses, attachment, detachment):
+    """ Allocates pool loss rates to tranches
+
+    :param losses: array of pool loss rates of any shape, i.e. a batch from VasicekLoss.simulate
+    :param attachment: (tranches,) attachment points as pool loss rates
+    :param detachment: (tranches,) detachment points
+    :return: losses shape + (tranches,) loss of each tranche as a fraction of its size, in the dtype of losses
+    """
+
+    losses = np.asarray(losses)
+    attachment = np.asarray(attachment, dtype=losses.dtype)
+    detachment = np.asarray(detachment, dtype=losses.dtype)
+
+    if np.any(detachment <= attachment):
+        raise ValueError('Detachment points must be above attachment points')
+
+    return np.clip(losses[..., np.newaxis] - attachment, 0, detachment - attachment) / (detachment - attachment)
+
+
+if __name__ == '__main__':
+    pd_grid = np.array([0.005, 0.01, 0.02, 0.05])[:, np.newaxis]
+    correlation_grid = np.array([0.05, 0.12, 0.24])
+
+    distribution = VasicekLoss(pd_grid, correlation_grid, lgd=0.4)
+
+    print(distribution.quantile([0.99, 0.999]))
+    print(distribution.expected_shortfall(0.99))
+    print(distribution.expected_tranche_loss([0., 0.03, 0.07], [0.03, 0.07, 1.]))
+
+    attachment, detachment = np.array([0., 0.03, 0.07]), np.array([0.03, 0.07, 1.])
+    total, count = 0., 0
+    for batch in distribution.simulate(200000, batch_size=50000, seed=0):
+        total = total + tranche_losses(batch, attachment, detachment).sum(axis=-2)
+        count += batch.shape[-1]
+
+    print(total / count)
@@ -2,6 +2,11 @@
 import numpy as np
 import scipy.stats as stats
 
+# 100 SDA: CDR rises .02 a month to .6 in month 30, holds through month 60, falls .0095 a month to .03 in month 120
+# and stays at .03, in the cpr_curve_creator description format
+
+SDA_DESCRIPTION = '.02 ramp .6 for 30, .6 for 30, .5905 ramp .03 for 60, .03'
+
 
 def hazard(beginning_balance, period_defaults):
     """Returns the % of loans that defaulted in a period based on the periods original balance"""
@@ -9,6 +14,12 @@ def hazard(beginning_balance, period_defaults):
     return float(period_defaults) / float(beginning_balance)
 
 
+def mdr(cdr):
+    """ Monthly default rate from an annual constant default rate, the default analogue of prepayment_calcs.smm """
+
+    return 1 - (1 - cdr) ** (1 / 12)
+
+
 def default_rate_normal_dist(x, p, pi):
     """ calculate periodic default rate where
     
@@ -20,7 +31,9 @@ def default_rate_normal_dist(x, p, pi):
     
     default rate = d = N[ (N.inv(pi) - x*sqrt(p)) / sqrt(1-p) ]
     
-    assuming the distribution of common risk factors is normally distributed"""
+    assuming the distribution of common risk factors is normally distributed
+
+    x, p and pi may be arrays that broadcast together"""
 
     return stats.norm.cdf(
         (stats.norm.ppf(pi) - (x * np.sqrt(p))) /
@@ -32,11 +45,13 @@ def inv_default_rate_normal_dist(pi, p, default_rate):
     
     1 - CDF = w = N[ (N.inv(pi) - sqrt(1-p) * N.inv(d)) / sqrt(p) ]
     
-    assuming the distribution of common risk factors is normally distributed"""
-    result = []
-    return [stats.norm.cdf(
-        (stats.norm.ppf(pi) - (np.sqrt(1 - p) * stats.norm.ppf(d))) /
-        np.sqrt(p)) for d in default_rate]
+    assuming the distribution of common risk factors is normally distributed
+
+    default_rate may be an array; pi and p may be arrays that broadcast against it"""
+
+    return stats.norm.cdf(
+        (stats.norm.ppf(pi) - (np.sqrt(1 - p) * stats.norm.ppf(np.asarray(default_rate)))) /
+        np.sqrt(p))
 
 
 def default_rate(x, p, pi, M):
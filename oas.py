@@ -0,0 +1,222 @@
+""" Monte Carlo interest rate paths and option adjusted spread (OAS) calculations for CMO bonds.
+
+Short rates follow a monthly Hull-White model fitted to a spot curve from BondPricing.spot_from_par. Each path is
+turned into a vector of SMMs by a rate sensitive prepayment function, the collateral and CMO waterfalls are run for
+all paths of a chunk at once, and the OAS of each bond is the spread over the path rates that reprices the bond."""
+
+import numpy as np
+import pandas as pd
+
+import collateral_waterfall as cw
+import prepayment_calcs as pc
+from CMO_waterfall import sequential_pay_cash_flows, bond_coupons, _bond_type
+
+
+class HullWhite:
+    '''
+    Monthly Hull-White short rate model dr = (theta(t) - a * r) dt + sigma dW.
+
+    The drift is fitted so the expected discount factor of the simulated paths reproduces the discount factors of
+    the input spot curve for every month.
+    '''
+
+    def __init__(self, spot_curve, mean_reversion=0.03, volatility=0.01, periods=360):
+        """
+        :param spot_curve: dataframe from BondPricing.spot_from_par, indexed by maturity in years with annually
+        compounded 'spot_rate' in percent
+        :param mean_reversion: speed of mean reversion, a
+        :param volatility: annual volatility of the short rate, sigma
+        :param periods: number of months to simulate
+        """
+
+        self.mean_reversion = mean_reversion
+        self.volatility = volatility
+        self.periods = periods
+        self.dt = 1 / 12.
+
+        maturities = np.asarray(spot_curve.index, dtype=float)
+        spots = np.log(1. + np.asarray(spot_curve['spot_rate'], dtype=float) / 100.)
+
+        times = np.arange(periods + 1) * self.dt
+        self.discount_factors = np.exp(-np.interp(times, maturities, spots) * times)
+
+        self._decay = np.exp(-mean_reversion * self.dt)
+        self._step_std = volatility * np.sqrt((1. - self._decay ** 2) / (2. * mean_reversion))
+
+        self.drift = self._fit_drift()
+
+    def _fit_drift(self):
+        """ Deterministic part of the short rate for each month, chosen so E[exp(-sum(r dt))] matches the curve.
+
+        The stochastic part x follows x[0] = 0, x[i + 1] = b * x[i] + s * Z[i], so the variance of dt * sum(x[:i])
+        is (s * dt / (1 - b))**2 * sum((1 - b**m)**2 for m in 1..i-1), accumulated here with a cumulative sum."""
+
+        b = self._decay
+        m = np.arange(self.periods + 1)
+        terms = np.concatenate(([0.], (1. - b ** m[:-1]) ** 2))
+        variance = (self._step_std * self.dt / (1. - b)) ** 2 * np.cumsum(terms)
+
+        log_discount = -np.log(self.discount_factors) + 0.5 * variance
+
+        return np.diff(log_discount) / self.dt
+
+    def simulate(self, npaths, seed=None, antithetic=True):
+        """
+        :param npaths: number of paths, rounded up to an even number when antithetic
+        :param seed: seed or numpy RandomState for reproducible paths
+        :param antithetic: pair every draw with its mirror image to reduce variance
+        :return: (paths x periods) array of annual short rates applying over each month
+        """
+
+        random_state = seed if isinstance(seed, np.random.RandomState) else np.random.RandomState(seed)
+
+        if antithetic:
+            half = random_state.standard_normal(((npaths + 1) // 2, self.periods - 1))
+            shocks = np.concatenate((half, -half))
+        else:
+            shocks = random_state.standard_normal((npaths, self.periods - 1))
+
+        x = np.zeros((len(shocks), self.periods))
+        for i in range(1, self.periods):
+            x[:, i] = self._decay * x[:, i - 1] + self._step_std * shocks[:, i - 1]
+
+        return x + self.drift
+
+
+def refinance_cpr(base_cpr, wac, mortgage_rates, slope=1.5, max_multiplier=4., min_multiplier=0.4):
+    """ Scales a base CPR curve by an arctangent S-curve of the refinance incentive, wac - mortgage rate.
+
+    :param base_cpr: CPR for each period
+    :param wac: weighted average coupon of the collateral
+    :param mortgage_rates: (paths x periods) prevailing mortgage rates
+    :param slope: steepness of the S-curve per 1% of incentive
+    :param max_multiplier: multiplier on base_cpr for deeply in the money collateral
+    :param min_multiplier: multiplier on base_cpr for deeply out of the money collateral
+    :return: (paths x periods) CPRs
+    """
+
+    incentive = (wac - mortgage_rates) * 100.
+    s_curve = 0.5 + np.arctan(slope * incentive) / np.pi
+
+    return np.clip(base_cpr * (min_multiplier + (max_multiplier - min_multiplier) * s_curve), 0., 1.)
+
+
+def path_smm(short_rates, wac, cpr_description='.2 ramp 6 for 30, 6', psa_speed=1.0, mortgage_spread=0.015,
+             prepayment_function=refinance_cpr):
+    """ Maps short rate paths to per-path SMM vectors.
+
+    :param short_rates: (paths x periods) short rates from HullWhite.simulate
+    :param mortgage_spread: spread of the prevailing mortgage rate over the short rate
+    :param prepayment_function: callable(base_cpr, wac, mortgage_rates) returning (paths x periods) CPRs
+    :return: (paths x periods) SMMs
+    """
+
+    periods = short_rates.shape[-1]
+    base_cpr = pc.cpr(cw.smm_vector(cpr_description, psa_speed, periods))
+
+    return pc.smm(prepayment_function(base_cpr, wac, short_rates + mortgage_spread))
+
+
+def expected_discounted_cash_flows(cmo, model, npaths=1000, chunk_size=250, seed=None, **prepayment_kwargs):
+    """ Runs the collateral and CMO waterfalls of cmo over Monte Carlo paths in chunks and returns the path average of
+    each bond's cash received discounted along its path. Only one chunk of paths is held in memory at a time.
+    Floater and inverse floater coupons reset off the short rate of each path.
+
+    :param cmo: CMO instance whose collateral and bonds are simulated
+    :param model: HullWhite model with at least cmo.wam periods
+    :param chunk_size: number of paths per chunk, kept even so antithetic pairs stay together
+    :return: (bonds x periods) array
+    """
+
+    if cmo.collateral is not None:
+        raise ValueError('Monte Carlo paths rebuild the collateral from the CMO terms, not a supplied collateral '
+                         'waterfall')
+
+    random_state = np.random.RandomState(seed)
+    chunk_size += chunk_size % 2
+
+    balances = [bond['Balance'] for bond in cmo.bonds]
+    is_accrual = [_bond_type(bond) == 'accrual' for bond in cmo.bonds]
+
+    mdr = cw.mdr_vector(cmo.cdr_description, cmo.sda_speed, cmo.wam)
+    servicing_fee = 0 if cmo.servicing is None else cmo.servicing
+
+    total = np.zeros((len(cmo.bonds), cmo.wam))
+    simulated = 0
+
+    while simulated < npaths:
+        short_rates = model.simulate(min(chunk_size, npaths - simulated), seed=random_state)[:, :cmo.wam]
+
+        smm = path_smm(short_rates, cmo.wac, cmo.cpr_description, cmo.psa_speed, **prepayment_kwargs)
+        collateral = cw.collateral_cash_flows(cmo.original_balance, cmo.pass_thru_cpn, cmo.wac, cmo.wam, smm,
+                                              servicing_fee=servicing_fee, mdr=mdr, severity=cmo.severity,
+                                              recovery_lag=cmo.recovery_lag)
+        bonds = sequential_pay_cash_flows(collateral['net_interest'], collateral['total_principal'],
+                                          balances, bond_coupons(cmo.bonds, short_rates), is_accrual,
+                                          losses=collateral['losses'])
+
+        discount = np.exp(-np.cumsum(short_rates, axis=1) * model.dt)
+        total += np.einsum('ptb,pt->bt', bonds['interest_paid'] + bonds['principal_paid'], discount)
+        simulated += len(short_rates)
+
+    return total / simulated
+
+
+def calc_oas(cmo, prices, model, npaths=1000, chunk_size=250, seed=None, tolerance=1e-10, max_iterations=50,
+             **prepayment_kwargs):
+    """ Solves the option adjusted spread of every bond in cmo.
+
+    :param cmo: CMO instance
+    :param prices: dict of bond name to price as a percent of the bond's original balance
+    :param model: HullWhite model
+    :return: dataframe indexed by bond with the input price, the model value at zero spread and the OAS in decimal
+    """
+
+    expected = expected_discounted_cash_flows(cmo, model, npaths, chunk_size, seed, **prepayment_kwargs)
+
+    names = [bond['Bond'] for bond in cmo.bonds]
+    balances = np.array([bond['Balance'] for bond in cmo.bonds], dtype=float)
+    price = np.array([prices[name] for name in names], dtype=float)
+    target = price / 100. * balances
+
+    times = np.arange(1, cmo.wam + 1) * model.dt
+    oas = np.zeros(len(names))
+
+    # Newton's method on all bonds at once; PV(s) = sum(expected * exp(-s * t))
+    for _ in range(max_iterations):
+        weighted = expected * np.exp(-oas[:, np.newaxis] * times)
+        error = weighted.sum(axis=1) - target
+        slope = -(weighted * times).sum(axis=1)
+        step = error / slope
+        oas -= step
+
+        if np.all(np.abs(step) < tolerance):
+            break
+
+    return pd.DataFrame({'Price': price,
+                         'Model_Value': expected.sum(axis=1) / balances * 100.,
+                         'OAS': oas},
+                        index=pd.Index(names, name='Bond'),
+                        columns=['Price', 'Model_Value', 'OAS'])
+
+
+if __name__ == '__main__':
+    from bond_pricing import BondPricing
+    from CMO_waterfall import CMO
+
+    curve = BondPricing.spot_from_par(pd.DataFrame([
+        {'Maturity': 1., 'Yield': 2.},
+        {'Maturity': 2., 'Yield': 2.5},
+        {'Maturity': 3., 'Yield': 3.},
+        {'Maturity': 4., 'Yield': 3.5},
+    ]))
+
+    struct = CMO(original_balance=100e6,
+                 pass_thru_cpn=0.05,
+                 wac=0.055,
+                 wam=360,
+                 bonds=[{'Bond': 'A', 'Balance': 40e6, 'Coupon': 0.04},
+                        {'Bond': 'B', 'Balance': 30e6, 'Coupon': 0.05},
+                        {'Bond': 'Z', 'Balance': 30e6, 'Coupon': 0.055, 'Type': 'accrual'}])
+
+    print(calc_oas(struct, {'A': 100., 'B': 99., 'Z': 95.}, HullWhite(curve), npaths=1000, seed=0))
@@ -8,6 +8,10 @@ PSA benchmark => PSA = $month * 0.002 if month <= 30 else 6$
 
 Also contains function to produce CPR curves based on text descriptions, i.e. PSA benchmark = '0.2 ramp 6 for 30, 6'"""
 
+import re
+from collections import namedtuple
+from functools import lru_cache
+
 import numpy as np
 import pandas as pd
 from bokeh.io import output_file
@@ -22,107 +26,251 @@ def cpr(smm):
 
 
 def psa(month):
-    return month * 0.002 if month <= 30 else .06
+    """ PSA benchmark CPR for a month or an array of months """
+
+    return np.minimum(np.asarray(month) * 0.002, .06)
+
 
+CurveSegment = namedtuple('CurveSegment', ['start_cpr', 'end_cpr', 'duration'])
 
-def cpr_curve_creator(description='.2 ramp 6 for 30, 6'):
-    """ Produces a 360 period CPR curve described by a text input string. Acceptable input is of the form
+_SEGMENT = re.compile(r"""^\s*(?P<start>[-+]?(?:\d+\.?\d*|\.\d+))
+                          (?:\s+ramp\s+(?P<end>[-+]?(?:\d+\.?\d*|\.\d+)))?
+                          (?:\s+for\s+(?P<duration>\d+(?:\.\d*)?))?\s*$""", re.IGNORECASE | re.VERBOSE)
+
+
+def cpr_curve_creator(description='.2 ramp 6 for 30, 6', periods=360):
+    """ Produces a CPR curve of length periods described by a text input string. Acceptable input is of the form
     '<start cpr> ramp <end cpr> for <duration>'.
     
     Periods are separated by commas ','
     
-    Only <start cpr> is required. If no <duration> is provided, the final instruction will carry to 360 periods, i.e. 
-    '6' as the input will produce a CPR curve of 6 through period 360; 
+    Only <start cpr> is required. Only the final instruction may leave out <duration>, and only when it holds one CPR;
+    it then carries to the end of the curve, i.e. '6' as the input will produce a CPR curve of 6 through period 360.
+    The final CPR also carries forward if the durations add up to less than periods. Segment lengths come from the
+    description alone, so a curve of any length is the same curve padded or cut at the tail.
     
     To produce 100 PSA, the input string is '.2 ramp 6 for 30, 6'
     
-    Returns PSA by default
+    Returns PSA by default. Compiled curves are cached and returned as read-only numpy arrays.
     """
 
-    periods = str(description).split(',')
-    nperiods = 360
-    end_period = False
+    return _compile_cpr_curve(parse_cpr_description(description), int(periods))
+
 
-    cpr_curve = []
+@lru_cache(maxsize=256)
+def parse_cpr_description(description):
+    """ Parses a CPR curve description into a tuple of CurveSegments with CPRs in decimal and duration in periods,
+    None for a final segment without a duration """
 
-    current_period = 1
+    segments = []
+    instructions = str(description).split(',')
 
-    for period in periods:
-        start_cpr = 0
-        end_cpr = 0
-        period_duration = 0
-        cpr_increment = 0
-        period_curve = None
+    for i, instruction in enumerate(instructions):
+        match = _SEGMENT.match(instruction)
+        if match is None:
+            raise ValueError('Unable to parse CPR curve instruction "{0}" in "{1}"'.format(instruction.strip(),
+                                                                                            description))
 
-        if period == periods[-1]:
-            end_period = True
+        start_cpr = float(match.group('start')) / 100.
+        end_cpr = float(match.group('end')) / 100. if match.group('end') is not None else start_cpr
+        duration = int(float(match.group('duration'))) if match.group('duration') is not None else None
 
-        period_duration = nperiods + current_period
-        words = period.strip().split(' ')
+        if duration is None and i != len(instructions) - 1:
+            raise ValueError('Only the final CPR curve instruction may leave out "for <duration>": "{0}"'.format(
+                description))
+        if duration is None and end_cpr != start_cpr:
+            raise ValueError('A ramp needs "for <duration>", or its slope would depend on the curve length: '
+                             '"{0}"'.format(description))
 
-        for i in range(len(words)):
-            if i == 0:
-                start_cpr = float(words[i]) / 100.
-                end_cpr = float(words[i]) / 100.
-            elif words[i] == 'ramp':
-                end_cpr = float(words[i + 1]) / 100.
-            elif words[i] == 'for':
-                period_duration = float(words[i + 1])
+        segments.append(CurveSegment(start_cpr, end_cpr, duration))
 
-        period_curve = np.linspace(start_cpr, end_cpr, period_duration)
+    return tuple(segments)
 
-        cpr_curve.extend(list(period_curve))
-        current_period += period_duration
 
-    return cpr_curve
+@lru_cache(maxsize=256)
+def _compile_cpr_curve(segments, periods):
+    pieces = []
+    filled = 0
+
+    # an open ended final segment holds one CPR and is the tail padding below
+
+    for segment in segments:
+        if segment.duration is None:
+            break
+        pieces.append(np.linspace(segment.start_cpr, segment.end_cpr, segment.duration))
+        filled += segment.duration
+
+    pieces.append(np.full(max(periods - filled, 0), segments[-1].end_cpr))
+
+    curve = np.concatenate(pieces)[:periods]
+    curve.flags.writeable = False
+
+    return curve
 
 
 def prepayment_curve_from_passive_active_composition(fast_smm, fast_amount, slow_smm, slow_amount, periods):
     """ Produces a CPR curve from a heterogenous composition of a pool fast/active prepayers and slow/passive prepayers.
-    Inputs are speed of prepayment for each group and their starting composition"""
+    Inputs are speed of prepayment for each group and their starting composition. Speeds may be single SMMs or
+    vectors of per period SMMs.
+
+    Two population case of population_prepayments."""
 
-    df = pd.DataFrame(0, index=np.arange(periods), columns=['fast_amount', 'fast_smm', 'slow_amount', 'slow_smm',
-                                                            'pool_smm', 'pool_cpr'])
+    smms = np.array([np.broadcast_to(fast_smm, (periods,)), np.broadcast_to(slow_smm, (periods,))], dtype=float)
+    pool_smm, shares = population_prepayments(smms, [fast_amount, slow_amount], periods)
+    total = float(fast_amount) + float(slow_amount)
 
-    df.loc[0, 'fast_amount'] = fast_amount
-    df['fast_smm'] = fast_smm
+    return pd.DataFrame({'fast_amount': shares[0] * total,
+                         'fast_smm': smms[0],
+                         'slow_amount': shares[1] * total,
+                         'slow_smm': smms[1],
+                         'pool_smm': pool_smm,
+                         'pool_cpr': cpr(pool_smm)},
+                        index=np.arange(periods),
+                        columns=['fast_amount', 'fast_smm', 'slow_amount', 'slow_smm', 'pool_smm', 'pool_cpr'])
 
-    df.loc[0, 'slow_amount'] = slow_amount
-    df['slow_smm'] = slow_smm
 
-    df.loc[0, 'pool_smm'] = (df.loc[0, 'fast_amount'] * df.loc[0, 'fast_smm']) + \
-                            (df.loc[0, 'slow_amount'] * df.loc[0, 'slow_smm'])
+def population_prepayments(smm, amounts, periods):
+    """ Burnout of a pool made of prepayer populations that each prepay at their own SMM.
 
-    for i in range(1, len(df.index)):
-        df.loc[i, 'fast_amount'] = df.loc[i - 1, 'fast_amount'] * ((1 - df.loc[i - 1, 'fast_smm']) /
-                                                                   (1 - df.loc[i - 1, 'pool_smm']))
+    Each population's balance survives at the cumulative product of (1 - its SMM), so the faster populations leave
+    the pool first and the pool SMM, the balance weighted average of the population SMMs, burns out over time.
 
-        df.loc[i, 'slow_amount'] = df.loc[i - 1, 'slow_amount'] * ((1 - df.loc[i - 1, 'slow_smm']) /
-                                                                   (1 - df.loc[i - 1, 'pool_smm']))
+    :param smm: population SMMs broadcasting to (..., populations, periods), i.e. a (populations, 1) column of single
+    SMMs, a (populations, periods) matrix of time-varying SMMs, or (pools, populations, periods) for a batch of pools
+    :param amounts: starting composition of each population, broadcasting to (..., populations); only the relative
+    amounts matter
+    :param periods: number of periods
+    :return: (..., periods) pool SMMs and (..., populations, periods) share of the pool balance in each population
+    """
+
+    amounts = np.asarray(amounts, dtype=float)
+    smm = np.asarray(smm, dtype=float)
+
+    shape = np.broadcast(smm, amounts[..., np.newaxis]).shape[:-1] + (periods,)
+    smm = np.broadcast_to(smm, shape)
 
-        df.loc[i, 'pool_smm'] = (df.loc[i, 'fast_amount'] * df.loc[i, 'fast_smm']) + \
-                                (df.loc[i, 'slow_amount'] * df.loc[i, 'slow_smm'])
+    survival = np.concatenate((np.ones(shape[:-1] + (1,)), np.cumprod(1. - smm[..., :-1], axis=-1)), axis=-1)
+    balances = amounts[..., np.newaxis] * survival
+    total = balances.sum(axis=-2, keepdims=True)
 
-    df['pool_cpr'] = df['pool_smm'].apply(cpr)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shares = np.where(total > 0, balances / total, 0.)
 
-    return df
+    return (shares * smm).sum(axis=-2), shares
 
 
 def age_perc(age, e=30):
     '''
     Calculate age factor for prepayment speed determination
-    :param age: current month of seasoning
+    :param age: current month of seasoning, a single age or an array
     :param e: age divisor, max age, i.e. if e = 30 and current month >= 30 then 1
     :return: percent seasoning factor for prepayment calc
     '''
-    return min(age / e, 1)
+    return np.minimum(np.asarray(age) / e, 1)
 
 
 def burn_perc(factor, f=0.7):
     '''
     Calculates factor input for prepayment speed determination of the amount of burnout
-    return 1 - f * (1 - factor)
+    :param factor: pool factor, current balance over original balance, a single factor or an array
+    :param f: burnout at a pool factor of 0
+    :return: 1 - f * (1 - factor)
+    '''
+    return 1 - f * (1 - np.asarray(factor))
+
+
+# month of year prepayment multipliers, January first, averaging 1
+
+SEASONALITY = np.array([0.94, 0.76, 0.74, 0.95, 0.98, 0.92, 0.98, 1.10, 1.18, 1.22, 1.23, 1.00])
+
+
+def seasonality_perc(calendar_month, seasonality=SEASONALITY):
+    '''
+    Month of year factor for prepayment speed determination
+    :param calendar_month: month of year, 1 for January; months past 12 wrap around
+    :param seasonality: 12 multipliers starting with January
+    '''
+    return np.asarray(seasonality, dtype=float)[(np.asarray(calendar_month, dtype=int) - 1) % 12]
+
+
+def refi_perc(wac, mortgage_rate, slope=1.5, max_multiplier=4., min_multiplier=0.4):
+    '''
+    Refinance incentive factor for prepayment speed determination, an arctangent S-curve of the incentive
+    wac - mortgage rate in percent that runs from min_multiplier to max_multiplier and equals 1 at no incentive
+    :param slope: steepness of the S-curve per 1% of incentive
     '''
+    incentive = (np.asarray(wac) - np.asarray(mortgage_rate)) * 100.
+
+    # shift the S-curve so it passes through 1 at zero incentive
+
+    center = -np.tan(np.pi * ((1. - min_multiplier) / (max_multiplier - min_multiplier) - 0.5)) / slope
+
+    return min_multiplier + (max_multiplier - min_multiplier) * (0.5 + np.arctan(slope * (incentive - center)) / np.pi)
+
+
+def multi_factor_smm(wac, mortgage_rates, age=0, factor=1., wam=None, original_term=360, calendar_month=1,
+                     base_cpr=0.06, slope=1.5, max_multiplier=4., min_multiplier=0.4, e=30, f=0.7,
+                     seasonality=SEASONALITY):
+    """ Projects SMMs from a multi-factor prepayment model,
+
+        CPR = base_cpr * refi_perc * age_perc * burn_perc * seasonality_perc
+
+    with the refinance incentive from the wac over the prevailing mortgage rate, seasoning from the loan age, burnout
+    from the pool factor, and month of year seasonality. At zero incentive, full seasoning, no burnout and average
+    seasonality the CPR is base_cpr, so base_cpr = 0.06 follows 100 PSA for a new pool.
+
+    Pool inputs broadcast against mortgage_rates without its last axis, i.e. (pools, 1) columns against
+    (pools, paths, periods) or (paths, periods) rate paths; the last axis is the period. Everything but burnout is
+    computed for all periods at once. Burnout depends on the pool factor, which depends on earlier prepayments, so the
+    factor is rolled forward one period at a time across all pools and paths together.
+
+    :param wac: weighted average coupon of each pool
+    :param mortgage_rates: prevailing mortgage rate each period
+    :param age: loan age of each pool at the start of the projection, in months
+    :param factor: pool factor of each pool at the start of the projection
+    :param wam: months remaining for each pool, original_term - age by default; SMMs are 0 after it
+    :param calendar_month: month of year of the first period, 1 for January
+    :return: SMMs shaped like the broadcast inputs, usable as the smm of collateral_waterfall.collateral_cash_flows
+    """
+
+    from collateral_waterfall import scheduled_balance_percent
+
+    mortgage_rates = np.asarray(mortgage_rates, dtype=float)
+    periods = mortgage_rates.shape[-1]
+
+    def column(values):
+        return np.asarray(values, dtype=float)[..., np.newaxis]
+
+    wac, age, factor, original_term, calendar_month = [column(x) for x in
+                                                       [wac, age, factor, original_term, calendar_month]]
+    wam = original_term - age if wam is None else column(wam)
+
+    months = np.arange(periods)
+    loan_age = age + months
+
+    static_cpr = (base_cpr * refi_perc(wac, mortgage_rates, slope, max_multiplier, min_multiplier) *
+                  age_perc(loan_age + 1, e) * seasonality_perc(calendar_month + months, seasonality))
+
+    bal_percent = scheduled_balance_percent(wac, original_term, np.concatenate((loan_age, loan_age[..., -1:] + 1),
+                                                                               axis=-1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scheduled_factor = np.where(bal_percent[..., :-1] > 0, bal_percent[..., 1:] / bal_percent[..., :-1], 0.)
+
+    shape = np.broadcast(static_cpr, scheduled_factor, factor, wam).shape
+    static_cpr = np.broadcast_to(static_cpr, shape)
+    scheduled_factor = np.broadcast_to(scheduled_factor, shape)
+    active = np.broadcast_to(months < wam, shape)
+
+    smm_paths = np.empty(shape)
+    pool_factor = np.broadcast_to(factor[..., 0], shape[:-1]).copy()
+
+    for period in range(periods):
+        cpr_period = np.clip(static_cpr[..., period] * burn_perc(pool_factor, f), 0., 1.)
+        smm_paths[..., period] = np.where(active[..., period], smm(cpr_period), 0.)
+        pool_factor = pool_factor * (1. - smm_paths[..., period]) * scheduled_factor[..., period]
+
+    return smm_paths
+
 
 if __name__ == '__main__':
     # output_file('psa.html')
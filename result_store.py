@@ -0,0 +1,249 @@
+""" Columnar on-disk store of collateral and CMO waterfalls partitioned by deal and scenario.
+
+Each waterfall is written to its own deal=<deal>/scenario=<scenario> folder. The default 'npy' format keeps every
+column in its own .npy file, so reads open only the requested columns and memory map them instead of parsing the
+whole table. The 'parquet' format writes one compressed Parquet file per partition with pyarrow, when it is installed,
+and reads only the requested column chunks.
+
+    store = ResultStore('results', dtype=np.float32)
+    store.write('CMO-1', 'psa_150', struct.waterfall)
+    cash = store.read('CMO-1', 'psa_150', columns=['Cashflow_A', 'Cashflow_B'])
+"""
+
+import fnmatch
+import json
+import os
+import shutil
+from urllib.parse import quote, unquote
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+STORE_FORMATS = ['npy', 'parquet']
+
+INDEX_COLUMN = '__index__'
+SCHEMA_FILE = 'schema.json'
+PARQUET_FILE = 'waterfall.parquet'
+
+
+class ResultStore:
+    '''
+    Waterfall dataframes stored column by column under directory/deal=<deal>/scenario=<scenario>.
+
+    Numeric columns are stored as float32 or float64. Columns that hold one text value per waterfall, like the
+    Bond_ and Type_ columns of CMO.waterfall, are kept in the partition schema instead of as arrays.
+
+    Partitions are written to a temporary folder. The partition being replaced is renamed aside before the new one is
+    renamed into place, and only then removed, so readers never see a partly written waterfall. Between the two
+    renames, or after a crash between them, reads fall back to the set aside copy, and the next write of the
+    partition cleans it up.
+    '''
+
+    def __init__(self, directory, dtype=np.float64, store_format='npy', compression=None):
+        """
+        :param directory: root folder of the store, created if missing
+        :param dtype: float type numeric columns are stored as, np.float32 halves the size on disk
+        :param store_format: one of STORE_FORMATS
+        :param compression: Parquet codec, i.e. 'snappy' or 'zstd'. 'npy' partitions are stored uncompressed so they
+        can be memory mapped
+        """
+
+        if store_format not in STORE_FORMATS:
+            raise ValueError('Unknown store format {0}, expected one of {1}'.format(store_format, STORE_FORMATS))
+        if store_format == 'parquet' and pq is None:
+            raise ValueError('The parquet store format needs pyarrow installed')
+        if store_format == 'npy' and compression is not None:
+            raise ValueError('npy partitions are memory mapped and cannot be compressed, use the parquet format')
+        if np.dtype(dtype) not in (np.dtype(np.float32), np.dtype(np.float64)):
+            raise ValueError('Columns are stored as float32 or float64, got {0}'.format(np.dtype(dtype)))
+
+        self.directory = directory
+        self.dtype = np.dtype(dtype)
+        self.store_format = store_format
+        self.compression = compression
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def write(self, deal, scenario, waterfall, dtype=None):
+        """ Writes a waterfall dataframe as the partition of deal and scenario, replacing any existing one
+
+        :param dtype: float type for this waterfall's numeric columns, the store's dtype by default
+        :return: partition folder
+        """
+
+        dtype = self.dtype if dtype is None else np.dtype(dtype)
+
+        arrays, constants = {}, {}
+        for column in waterfall.columns:
+            series = waterfall[column]
+            if pd.api.types.is_numeric_dtype(series) or pd.api.types.is_bool_dtype(series):
+                arrays[str(column)] = series.to_numpy(dtype=dtype)
+            elif series.nunique(dropna=False) <= 1:
+                constants[str(column)] = None if series.empty or pd.isnull(series.iloc[0]) else str(series.iloc[0])
+            else:
+                raise ValueError('Column {0} is neither numeric nor constant'.format(column))
+
+        index = np.asarray(waterfall.index.values)
+        schema = {'columns': [str(column) for column in waterfall.columns],
+                  'constants': constants,
+                  'index_name': waterfall.index.name,
+                  'dtype': dtype.name,
+                  'rows': len(waterfall),
+                  'format': self.store_format}
+
+        path = self._partition(deal, scenario)
+        temporary = path + '.tmp'
+        if os.path.isdir(temporary):
+            shutil.rmtree(temporary)
+        os.makedirs(temporary)
+
+        if self.store_format == 'npy':
+            np.save(os.path.join(temporary, quote(INDEX_COLUMN, safe='') + '.npy'), index)
+            for column, values in arrays.items():
+                np.save(os.path.join(temporary, quote(column, safe='') + '.npy'), values)
+        else:
+            table = pa.Table.from_pydict(dict([(INDEX_COLUMN, index)] + list(arrays.items())))
+            pq.write_table(table, os.path.join(temporary, PARQUET_FILE), compression=self.compression or 'NONE')
+
+        with open(os.path.join(temporary, SCHEMA_FILE), 'w') as schema_file:
+            json.dump(schema, schema_file)
+
+        # a set aside copy without a partition is the last good one until the new partition is in place
+
+        previous = path + '.old'
+        if os.path.isdir(previous) and os.path.isdir(path):
+            shutil.rmtree(previous)
+        if os.path.isdir(path):
+            os.rename(path, previous)
+
+        os.rename(temporary, path)
+
+        if os.path.isdir(previous):
+            shutil.rmtree(previous)
+
+        return path
+
+    def read_arrays(self, deal, scenario, columns=None):
+        """ Reads the selected numeric columns of a partition without building a dataframe. 'npy' partitions are
+        memory mapped read only, so only the pages that are used are loaded.
+
+        :param columns: column names or fnmatch patterns, i.e. ['Cashflow_A*'], all numeric columns by default
+        :return: dict of column name to array, with the index under INDEX_COLUMN
+        """
+
+        path = self._stored(deal, scenario)
+        schema = self.schema(deal, scenario)
+        selected = self._select(schema, columns)
+
+        if schema['format'] == 'npy':
+            return dict((column, np.load(os.path.join(path, quote(column, safe='') + '.npy'), mmap_mode='r'))
+                        for column in [INDEX_COLUMN] + selected)
+
+        if pq is None:
+            raise ValueError('Reading parquet partitions needs pyarrow installed')
+
+        table = pq.read_table(os.path.join(path, PARQUET_FILE), columns=[INDEX_COLUMN] + selected, memory_map=True)
+        return dict((column, table.column(column).to_numpy()) for column in [INDEX_COLUMN] + selected)
+
+    def read(self, deal, scenario, columns=None, constants=False):
+        """ Reads the selected columns of a partition into a dataframe indexed like the written waterfall
+
+        :param columns: column names or fnmatch patterns, i.e. ['Cashflow_A', 'Cashflow_B'], all columns by default
+        :param constants: also return the text columns kept in the schema, like Bond_ and Type_
+        """
+
+        schema = self.schema(deal, scenario)
+        arrays = self.read_arrays(deal, scenario, columns)
+        index = pd.Index(arrays.pop(INDEX_COLUMN), name=schema['index_name'])
+
+        data = dict(arrays)
+        if constants:
+            for column, value in schema['constants'].items():
+                if columns is None or any(fnmatch.fnmatchcase(column, pattern) for pattern in columns):
+                    data[column] = value
+
+        return pd.DataFrame(data, index=index, columns=[column for column in schema['columns'] if column in data])
+
+    def scan(self, columns=None, deals=None, scenarios=None):
+        """ Reads the selected columns of many partitions one at a time, for analytics over the whole store
+
+        :param deals: deal names to read, all deals by default
+        :param scenarios: scenario names to read, all scenarios by default
+        :return: generator of (deal, scenario, dict of arrays) like read_arrays
+        """
+
+        for deal, scenario in self.partitions():
+            if (deals is None or deal in deals) and (scenarios is None or scenario in scenarios):
+                yield deal, scenario, self.read_arrays(deal, scenario, columns)
+
+    def schema(self, deal, scenario):
+        path = os.path.join(self._stored(deal, scenario), SCHEMA_FILE)
+        if not os.path.exists(path):
+            raise ValueError('No waterfall stored for deal {0}, scenario {1}'.format(deal, scenario))
+
+        with open(path) as schema_file:
+            return json.load(schema_file)
+
+    def partitions(self, deal=None):
+        """ Stored (deal, scenario) pairs, of one deal or of every deal """
+
+        deals = [deal] if deal is not None else sorted(unquote(name[len('deal='):])
+                                                      for name in os.listdir(self.directory)
+                                                      if name.startswith('deal='))
+        pairs = []
+        for name in deals:
+            folder = os.path.join(self.directory, 'deal=' + quote(str(name), safe=''))
+            if os.path.isdir(folder):
+                scenarios = set(scenario[:-len('.old')] if scenario.endswith('.old') else scenario
+                                for scenario in os.listdir(folder)
+                                if scenario.startswith('scenario=') and not scenario.endswith('.tmp'))
+                pairs += [(name, unquote(scenario[len('scenario='):])) for scenario in sorted(scenarios)]
+
+        return pairs
+
+    def delete(self, deal, scenario=None):
+        """ Removes one partition, or every scenario of a deal when scenario is None """
+
+        if scenario is None:
+            paths = [os.path.join(self.directory, 'deal=' + quote(str(deal), safe=''))]
+        else:
+            path = self._partition(deal, scenario)
+            paths = [path, path + '.old', path + '.tmp']
+
+        for path in paths:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+
+    def _partition(self, deal, scenario):
+        return os.path.join(self.directory, 'deal=' + quote(str(deal), safe=''),
+                            'scenario=' + quote(str(scenario), safe=''))
+
+    def _stored(self, deal, scenario):
+        """ Folder holding the partition, the set aside copy while a write is replacing it """
+
+        path = self._partition(deal, scenario)
+        if not os.path.isdir(path) and os.path.isdir(path + '.old'):
+            return path + '.old'
+
+        return path
+
+    @staticmethod
+    def _select(schema, columns):
+        numeric = [column for column in schema['columns'] if column not in schema['constants']]
+        if columns is None:
+            return numeric
+
+        selected = [column for column in numeric if any(fnmatch.fnmatchcase(column, pattern) for pattern in columns)]
+        missing = [pattern for pattern in columns if not any(fnmatch.fnmatchcase(column, pattern)
+                                                             for column in schema['columns'])]
+        if missing:
+            raise ValueError('No stored columns match {0}'.format(missing))
+
+        return selected
@@ -0,0 +1,116 @@
+""" Effective duration, convexity and key rate durations of CMO bonds from shocked yield curves.
+
+Every shocked curve is mapped to a prepayment speed, and the base and shocked scenarios are stacked into one
+(scenarios x months) run of the collateral and CMO waterfalls. The parsed CPR curve and the bond setup are shared by
+all scenarios; only the speeds and discount curves differ."""
+
+import numpy as np
+import pandas as pd
+
+import collateral_waterfall as cw
+import prepayment_calcs as pc
+from CMO_waterfall import sequential_pay_cash_flows, bond_coupons, _bond_type
+
+
+def psa_response(base_curve, base_speed=1.0, tenor=10., sensitivity=0.5, floor=0.1):
+    """ Rate to prepayment mapping that scales the base speed linearly with the change in the zero rate at tenor.
+
+    :param base_curve: YieldCurve the base speed applies to
+    :param base_speed: psa speed multiplier, a single speed or one per period
+    :param sensitivity: fractional change in speed per 100bp fall in the tenor rate
+    :param floor: lowest speed multiplier
+    :return: callable(curve) returning the psa speed multiplier for a shocked curve
+    """
+
+    base_rate = base_curve.zero_rates(tenor)
+
+    def speed(curve):
+        change = (curve.zero_rates(tenor) - base_rate) * 100.
+        return np.maximum(base_speed * (1. - sensitivity * change), floor)
+
+    return speed
+
+
+def calc_effective_risk(cmo, curve, prepayment_response=None, prices=None, shock_bps=25., key_rate_tenors=None):
+    """
+    :param cmo: CMO instance
+    :param curve: base YieldCurve
+    :param prepayment_response: callable(curve) returning a psa speed multiplier, scalar or per period. By default
+    psa_response(curve, cmo.psa_speed), so the base scenario runs at the deal's own speed
+    :param prices: dict of bond name to price as a percent of original balance. Each bond's spread over the curve is
+    fitted to its price in the base scenario and held in the shocked scenarios; by default the spread is zero
+    :param shock_bps: size of the parallel and key rate shocks
+    :param key_rate_tenors: knot maturities to shock for key rate durations, all curve knots by default
+    :return: dataframe indexed by bond with Price, Spread_bps, Effective_Duration, Effective_Convexity and a
+    KRD_<tenor> column per key rate
+    """
+
+    if cmo.collateral is not None:
+        raise ValueError('Shocked scenarios rebuild the collateral from the CMO terms, not a supplied collateral '
+                         'waterfall')
+
+    if prepayment_response is None:
+        prepayment_response = psa_response(curve, base_speed=cmo.psa_speed)
+
+    if key_rate_tenors is None:
+        key_rate_tenors = list(curve.maturities)
+
+    scenarios = [curve, curve.shifted(shock_bps), curve.shifted(-shock_bps)]
+    for tenor in key_rate_tenors:
+        scenarios += [curve.shifted(shock_bps, key_rate=tenor), curve.shifted(-shock_bps, key_rate=tenor)]
+
+    # shared setup: one parsed CPR curve and one set of bond arrays for every scenario
+
+    base_cpr = pc.cpr_curve_creator(cmo.cpr_description, periods=cmo.wam)
+    speeds = np.array([np.broadcast_to(np.asarray(prepayment_response(scenario), dtype=float), (cmo.wam,))
+                       for scenario in scenarios])
+
+    collateral = cw.collateral_cash_flows(cmo.original_balance, cmo.pass_thru_cpn, cmo.wac, cmo.wam,
+                                          pc.smm(base_cpr * speeds),
+                                          servicing_fee=0 if cmo.servicing is None else cmo.servicing,
+                                          mdr=cw.mdr_vector(cmo.cdr_description, cmo.sda_speed, cmo.wam),
+                                          severity=cmo.severity, recovery_lag=cmo.recovery_lag)
+
+    # floater indexes move with each scenario's one month forward rates
+
+    index_rates = None
+    if cmo.index_rates is not None:
+        base_forwards = curve.monthly_forward_rates(cmo.wam)
+        index_rates = np.asarray(cmo.index_rates, dtype=float)
+        index_rates = (index_rates[:cmo.wam] if index_rates.ndim else index_rates) + \
+            np.array([scenario.monthly_forward_rates(cmo.wam) - base_forwards for scenario in scenarios])
+
+    names = [bond['Bond'] for bond in cmo.bonds]
+    balances = np.array([bond['Balance'] for bond in cmo.bonds], dtype=float)
+    bonds = sequential_pay_cash_flows(collateral['net_interest'], collateral['total_principal'],
+                                      balances,
+                                      bond_coupons(cmo.bonds, index_rates),
+                                      [_bond_type(bond) == 'accrual' for bond in cmo.bonds],
+                                      losses=collateral['losses'])
+
+    # (scenarios x bonds x months) cash received
+
+    cash = np.swapaxes(bonds['interest_paid'] + bonds['principal_paid'], 1, 2)
+
+    if prices is None:
+        spread = np.zeros(len(names))
+    else:
+        spread = curve.spreads(cash[0], np.array([prices[name] for name in names], dtype=float) / 100. * balances)
+
+    times = np.arange(1, cmo.wam + 1) / 12.
+    discount = np.array([scenario.monthly_discount_factors(cmo.wam) for scenario in scenarios])
+    values = np.einsum('sbt,st,bt->sb', cash, discount, np.exp(-spread[:, np.newaxis] / 1e4 * times))
+
+    base, up, down = values[0], values[1], values[2]
+    shock = shock_bps / 1e4
+
+    columns = [('Price', base / balances * 100.),
+               ('Spread_bps', spread),
+               ('Effective_Duration', (down - up) / (2. * base * shock)),
+               ('Effective_Convexity', (up + down - 2. * base) / (base * shock ** 2))]
+
+    for i, tenor in enumerate(key_rate_tenors):
+        key_up, key_down = values[3 + 2 * i], values[4 + 2 * i]
+        columns.append(('KRD_{0:g}'.format(tenor), (key_down - key_up) / (2. * base * shock)))
+
+    return pd.DataFrame(dict(columns), index=pd.Index(names, name='Bond'), columns=[name for name, _ in columns])
@@ -1,8 +1,20 @@
 """ Functions for evaluating scenario environments """
 
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pandas as pd
 
+import collateral_waterfall as cw
+import default_calcs as dc
+from CMO_waterfall import sequential_pay_cash_flows, bond_coupons, _bond_type
+from yield_curve import monthly_yields
+
+COLLATERAL_PARAMETERS = ['original_balance', 'pass_thru_cpn', 'wac', 'wam', 'psa_speed', 'cpr_description', 'sda_speed',
+                         'cdr_description', 'severity', 'recovery_lag']
+
+
 def calc_reinvestments(interest_flows,
                        principal_flows,
                        reinvestment_rate,
@@ -21,3 +33,183 @@ def calc_reinvestments(interest_flows,
     principal_returns = principal_flows[first_period:last_period + 1] * returns
 
     return returns, interest_returns, principal_returns
+
+
+def horizon_total_returns(interest_flows, principal_flows, reinvestment_rates, horizons, prices, curve,
+                          spread_bps=0., annualize=False):
+    """ Horizon total return of every tranche in every reinvestment scenario and at every horizon in one pass.
+
+    Cash received in month t is reinvested to the horizon h at the scenario's monthly compounded reinvestment
+    rates, i.e. grows by G[h] / G[t] with G the cumulative product of (1 + rate / 12), so the reinvested value of all
+    cash is G[h] times a cumulative sum of cash / G. Cash flows after the horizon are priced at the horizon off the
+    scenario's curve, discounting month t by the curve's discount factor at t - h months.
+
+    :param interest_flows: (tranches x periods) interest received each month, months 1, 2, ...
+    :param principal_flows: (tranches x periods) principal received each month
+    :param reinvestment_rates: (scenarios x periods) annual reinvestment rates applying over each month
+    :param horizons: horizon months, 1 for the end of the first month
+    :param prices: purchase price of each tranche in the same units as the cash flows
+    :param curve: YieldCurve pricing the remaining cash flows at every horizon, or one YieldCurve per scenario
+    :param spread_bps: continuously compounded spread over the curve at the horizon, one spread or one per tranche
+    :param annualize: return annualized returns, (1 + return) ** (12 / horizon) - 1, instead of holding period returns
+    :return: (scenarios x tranches x horizons) total returns
+    """
+
+    cash = np.atleast_2d(np.asarray(interest_flows, dtype=float) + np.asarray(principal_flows, dtype=float))
+    rates = np.atleast_2d(np.asarray(reinvestment_rates, dtype=float))
+    horizons = np.asarray(horizons, dtype=int)
+    periods = cash.shape[-1]
+    prices = np.broadcast_to(np.asarray(prices, dtype=float), (len(cash),))
+
+    if rates.shape[-1] < periods:
+        raise ValueError('Reinvestment rates cover {0} months, the cash flows {1}'.format(rates.shape[-1], periods))
+    if np.any((horizons < 1) | (horizons > periods)):
+        raise ValueError('Horizons must be between 1 and {0} months'.format(periods))
+
+    curves = [curve] * len(rates) if not isinstance(curve, (list, tuple)) else list(curve)
+    if len(curves) != len(rates):
+        raise ValueError('Expected one curve or {0} curves, got {1}'.format(len(rates), len(curves)))
+
+    # reinvested value at the horizon, (scenarios x tranches x horizons)
+
+    growth = np.cumprod(1. + rates[:, :periods] / 12., axis=1)
+    discounted_cash = np.cumsum(cash[np.newaxis] / growth[:, np.newaxis], axis=-1)
+    reinvested = growth[:, np.newaxis, horizons - 1] * discounted_cash[..., horizons - 1]
+
+    # value at the horizon of the cash flows after it, with lag = t - h months
+
+    lag = np.arange(1, periods + 1) - horizons[:, np.newaxis]
+    discount = np.array([np.concatenate(([1.], scenario_curve.monthly_discount_factors(periods)))
+                         for scenario_curve in curves])[:, np.maximum(lag, 0)] * (lag > 0)
+
+    spread = np.asarray(spread_bps, dtype=float) / 1e4
+    spread_discount = np.exp(-np.multiply.outer(np.atleast_1d(spread), np.maximum(lag, 0) / 12.))
+    spread_discount = np.broadcast_to(spread_discount, (len(cash),) + lag.shape)
+
+    terminal = np.einsum('bt,sht,bht->sbh', cash, discount, spread_discount)
+
+    total_return = (reinvested + terminal) / prices[:, np.newaxis] - 1.
+
+    if annualize:
+        return (1. + total_return) ** (12. / horizons) - 1.
+
+    return total_return
+
+
+def run_scenario_grid(bonds, grid, collateral=None, prices=None, max_workers=None, chunksize=1, index_rates=None):
+    """ Runs a CMO bond structure over the Cartesian product of the grid values across a process pool.
+
+    Scenarios sharing the same collateral parameters are grouped so each collateral waterfall is computed once,
+    and workers only send back per-bond summary arrays.
+
+    :param bonds: CMO bond list, i.e. [{'Bond': 'A', 'Balance': 30e6, 'Coupon': 0.07}, ...]
+    :param grid: dict of parameter name to list of values. Names are any of COLLATERAL_PARAMETERS or
+    'Balance_<bond>' to vary a tranche size
+    :param collateral: dict of fixed collateral parameters, the CMO defaults are used for anything not given
+    :param prices: dict of bond name to price as a percent of balance for the yield calculation, par by default
+    :param max_workers: number of worker processes, 1 runs the grid in the current process
+    :param chunksize: number of collateral scenarios sent to a worker at a time
+    :param index_rates: index rate each month for floater and inverse floater bonds, at least as long as any wam, or
+    (paths x months) index paths, in which case WAL, Yield and Total_Cashflow are averages over the paths
+    :return: long format dataframe with one row per scenario and bond holding the grid values, WAL in years,
+    Yield (mortgage equivalent) and Total_Cashflow
+    """
+
+    names = list(grid.keys())
+    bond_names = [bond['Bond'] for bond in bonds]
+
+    for name in names:
+        if name not in COLLATERAL_PARAMETERS and name not in ['Balance_' + bond for bond in bond_names]:
+            raise ValueError('Unknown scenario grid parameter {0}'.format(name))
+
+    base = {'original_balance': 400e6, 'pass_thru_cpn': 0.055, 'wac': 0.06, 'wam': 358, 'psa_speed': 1.0,
+            'cpr_description': '.2 ramp 6 for 30, 6', 'sda_speed': 0., 'cdr_description': dc.SDA_DESCRIPTION,
+            'severity': 0.35, 'recovery_lag': 12}
+    base.update(collateral or {})
+
+    prices = prices or {}
+    price = np.array([prices.get(bond, 100.) for bond in bond_names], dtype=float)
+    if index_rates is not None and np.ndim(index_rates) > 0:
+        longest = max(int(wam) for wam in grid.get('wam', [base['wam']]))
+        index_rates = np.asarray(index_rates, dtype=float)[..., :longest]
+    coupons = bond_coupons(bonds, index_rates)
+    is_accrual = np.array([_bond_type(bond) == 'accrual' for bond in bonds])
+
+    scenarios = list(itertools.product(*[grid[name] for name in names]))
+
+    # group scenarios by collateral so each collateral waterfall is run once
+
+    collateral_groups = {}
+    for i, values in enumerate(scenarios):
+        params = dict(zip(names, values))
+        collateral_params = tuple((key, params.get(key, base[key])) for key in COLLATERAL_PARAMETERS)
+        balances = [params.get('Balance_' + bond['Bond'], bond['Balance']) for bond in bonds]
+        collateral_groups.setdefault(collateral_params, []).append((i, balances))
+
+    tasks = [(dict(collateral_params), coupons, is_accrual, price, group)
+             for collateral_params, group in collateral_groups.items()]
+
+    if max_workers == 1:
+        group_results = [_run_collateral_scenario(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            group_results = list(executor.map(_run_collateral_scenario, tasks, chunksize=chunksize))
+
+    summaries = {}
+    for group in group_results:
+        for i, wal, yields, total in group:
+            summaries[i] = (wal, yields, total)
+
+    rows = []
+    for i, values in enumerate(scenarios):
+        wal, yields, total = summaries[i]
+        for j, bond in enumerate(bond_names):
+            rows.append(tuple(values) + (bond, wal[j], yields[j], total[j]))
+
+    return pd.DataFrame(rows, columns=names + ['Bond', 'WAL', 'Yield', 'Total_Cashflow'])
+
+
+def _run_collateral_scenario(task):
+    """ Worker for run_scenario_grid. Runs one collateral waterfall and every tranche sizing that shares it.
+
+    :return: list of (scenario index, WAL, yield, total cash flow) with one array entry per bond
+    """
+
+    collateral, coupons, is_accrual, price, group = task
+
+    wam = int(collateral['wam'])
+    smm = cw.smm_vector(collateral['cpr_description'], collateral['psa_speed'], wam)
+    mdr = cw.mdr_vector(collateral['cdr_description'], collateral['sda_speed'], wam)
+    flows = cw.collateral_cash_flows(collateral['original_balance'], collateral['pass_thru_cpn'],
+                                     collateral['wac'], wam, smm, mdr=mdr, severity=collateral['severity'],
+                                     recovery_lag=collateral['recovery_lag'])
+
+    months = np.arange(1, wam + 1)
+
+    results = []
+    coupons = coupons[..., :wam, :] if coupons.ndim > 1 else coupons
+
+    for i, balances in group:
+        balances = np.asarray(balances, dtype=float)
+        bonds = sequential_pay_cash_flows(flows['net_interest'], flows['total_principal'], balances, coupons,
+                                          is_accrual, losses=flows['losses'])
+
+        # (..., bonds, months) with any index path axes in front, flattened to rows for the yield solver
+
+        cash = np.swapaxes(bonds['interest_paid'] + bonds['principal_paid'], -1, -2)
+        principal = np.swapaxes(bonds['principal_paid'], -1, -2)
+        rows = cash.shape[:-1]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            wal = (principal * months).sum(axis=-1) / principal.sum(axis=-1) / 12
+
+        guess = np.broadcast_to(np.mean(coupons, axis=-2) if coupons.ndim > 1 else coupons, rows) / 12
+        yields = monthly_yields(cash.reshape(-1, wam), np.broadcast_to(price / 100. * balances, rows).ravel(),
+                                guess.ravel()).reshape(rows) * 12
+
+        paths = int(np.prod(rows[:-1]))
+        results.append((i, wal.reshape(paths, -1).mean(axis=0), yields.reshape(paths, -1).mean(axis=0),
+                        cash.sum(axis=-1).reshape(paths, -1).mean(axis=0)))
+
+    return results
+
@@ -0,0 +1,375 @@
+""" Senior/subordinate credit structures for non-agency deals.
+
+Bonds carry a credit 'Type' of senior, mezzanine or subordinate and are listed in payment priority order. Each period
+interest is paid in priority order, principal is split between the senior and subordinate classes by the shifting
+interest senior prepayment percentage, excess interest and overcollateralization (OC) are managed toward an OC target,
+and losses not absorbed by OC write the bonds down in reverse priority. A cumulative loss trigger sends all principal
+to the seniors and holds the OC target at its initial level while it is failing.
+
+Tranche state lives in arrays of shape (..., bonds), so a deal runs every Monte Carlo loss path at once."""
+
+import numpy as np
+import pandas as pd
+
+import collateral_waterfall as cw
+from CMO_waterfall import CMO, BOND_COLUMNS, _bond_type
+
+CREDIT_TYPES = ['senior', 'mezzanine', 'subordinate']
+
+# (months, percentage) steps of the shifting interest schedule: the share of the subordinates' pro rata part of
+# unscheduled principal that is paid to the seniors instead, 0 after the last step
+
+SHIFTING_INTEREST = [(60, 1.), (12, .7), (12, .6), (12, .4), (12, .2)]
+
+DEAL_COLUMNS = ['senior_percentage', 'senior_prepayment_percentage', 'trigger_failed', 'overcollateralization',
+                'oc_target', 'residual']
+
+
+def shifting_interest_percentages(periods, schedule=SHIFTING_INTEREST):
+    """ Returns the shifting interest percentage for each of periods from (months, percentage) steps """
+
+    if not schedule:
+        return np.zeros(periods)
+
+    months, percentages = zip(*schedule)
+    steps = np.repeat(np.asarray(percentages, dtype=float), np.asarray(months, dtype=int))
+
+    return np.concatenate((steps, np.zeros(max(periods - len(steps), 0))))[:periods]
+
+
+def credit_types(bonds):
+    """ Credit type of each bond in a CMO bond list, senior when no type is given. Raises unless the bonds are
+    listed in priority order. """
+
+    types = [_bond_type(bond) or 'senior' for bond in bonds]
+
+    for bond, bond_type in zip(bonds, types):
+        if bond_type not in CREDIT_TYPES:
+            raise ValueError('Unknown credit type {0} for bond {1}, expected one of {2}'.format(
+                bond_type, bond['Bond'], CREDIT_TYPES))
+
+    ranks = [CREDIT_TYPES.index(bond_type) for bond_type in types]
+    if ranks != sorted(ranks):
+        raise ValueError('Bonds must be listed in priority order: senior, mezzanine, then subordinate')
+
+    return types
+
+
+def senior_subordinate_cash_flows(collateral, balances, coupons, types, shifting_interest=SHIFTING_INTEREST,
+                                  oc_target=None, oc_stepdown=None, stepdown_month=37, oc_floor=0.005,
+                                  cumulative_loss_trigger=None):
+    """ Senior/subordinate waterfall over collateral flows with optional leading path axes, i.e. (paths, periods).
+
+    :param collateral: dict or dataframe with the collateral_waterfall.collateral_cash_flows columns
+    beginning_balance, net_interest, scheduled_principal, prepayments, recoveries and losses
+    :param balances: original balance of each bond, in priority order
+    :param coupons: annual coupon of each bond, or (..., periods, bonds) coupons each period from
+    CMO_waterfall.bond_coupons whose leading path axes broadcast against the collateral flows
+    :param types: credit type of each bond, see credit_types
+    :param shifting_interest: (months, percentage) steps of the shifting interest schedule, None for pro rata
+    :param oc_target: OC target as a fraction of the original collateral balance. Excess interest pays principal to
+    build OC up to the target and principal above the target is released; None leaves excess interest and OC alone
+    :param oc_stepdown: OC target as a fraction of the current collateral balance from stepdown_month on while the
+    trigger passes, floored at oc_floor of the original collateral balance
+    :param cumulative_loss_trigger: cumulative loss as a fraction of the original collateral balance above which the
+    trigger fails, a single level or one per period
+    :return: dict of (..., periods, bonds) arrays 'balance', 'interest_due', 'interest_paid', 'interest_shortfall',
+    'principal_paid', 'writedown' and 'cashflow', and (..., periods) arrays keyed by DEAL_COLUMNS
+    """
+
+    def flow(column):
+        return np.asarray(collateral[column], dtype=float)
+
+    net_interest = flow('net_interest')
+    beginning_balance = np.broadcast_to(flow('beginning_balance'), net_interest.shape)
+    scheduled = np.broadcast_to(flow('scheduled_principal'), net_interest.shape)
+    unscheduled = np.broadcast_to(flow('prepayments') + flow('recoveries'), net_interest.shape)
+    losses = np.broadcast_to(flow('losses'), net_interest.shape)
+
+    coupons = np.asarray(coupons, dtype=float)
+    senior = np.array([bond_type == 'senior' for bond_type in types])
+    senior_index = np.flatnonzero(senior)
+
+    periods = net_interest.shape[-1]
+    nbonds = coupons.shape[-1]
+
+    if coupons.ndim > 1:
+        shape = np.broadcast(net_interest[..., 0], coupons[..., 0, 0]).shape + (periods,)
+        net_interest, beginning_balance, scheduled, unscheduled, losses = [
+            np.broadcast_to(values, shape) for values in (net_interest, beginning_balance, scheduled, unscheduled,
+                                                          losses)]
+        coupons = np.broadcast_to(coupons, shape + (nbonds,))
+
+    paths = net_interest.shape[:-1]
+
+    original_collateral = beginning_balance[..., 0]
+    shift = shifting_interest_percentages(periods, shifting_interest)
+
+    if cumulative_loss_trigger is None:
+        trigger_level = np.full(periods, np.inf)
+    else:
+        trigger_level = np.broadcast_to(np.asarray(cumulative_loss_trigger, dtype=float), (periods,))
+    cumulative_loss = np.cumsum(losses, axis=-1)
+
+    balance = np.empty(paths + (periods, nbonds))
+    interest_due = np.empty(paths + (periods, nbonds))
+    interest_paid = np.empty(paths + (periods, nbonds))
+    interest_shortfall = np.empty(paths + (periods, nbonds))
+    principal_paid = np.empty(paths + (periods, nbonds))
+    writedown = np.empty(paths + (periods, nbonds))
+    deal = {column: np.empty(paths + (periods,)) for column in DEAL_COLUMNS}
+
+    current_balance = np.broadcast_to(np.asarray(balances, dtype=float), paths + (nbonds,)).copy()
+    shortfall = np.zeros(paths + (nbonds,))
+
+    def pay_sequential(amount, paid, remaining_balance, index):
+        for i in index:
+            payment = np.clip(remaining_balance[..., i] - paid[..., i], 0, amount)
+            paid[..., i] += payment
+            amount = amount - payment
+        return amount
+
+    for period in range(periods):
+        collateral_balance = beginning_balance[..., period]
+        collections = scheduled[..., period] + unscheduled[..., period]
+        ending_collateral = collateral_balance - collections - losses[..., period]
+
+        # pay interest and any earlier shortfall in priority order
+
+        due = current_balance * ((coupons[..., period, :] if coupons.ndim > 1 else coupons) / 12) + shortfall
+        paid = np.empty_like(due)
+        excess = net_interest[..., period].copy()
+
+        for i in range(nbonds):
+            paid[..., i] = np.minimum(due[..., i], excess)
+            excess -= paid[..., i]
+
+        shortfall = due - paid
+
+        # trigger and shifting interest senior percentages
+
+        failed = cumulative_loss[..., period] > trigger_level[period] * original_collateral
+
+        senior_balance = current_balance[..., senior].sum(axis=-1)
+        subordinate_balance = current_balance.sum(axis=-1) - senior_balance
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            senior_percentage = np.where((subordinate_balance > 0) & (collateral_balance > 0),
+                                         np.clip(senior_balance / collateral_balance, 0, 1), 1.)
+
+        senior_prepayment_percentage = np.where(failed, 1.,
+                                                senior_percentage + shift[period] * (1 - senior_percentage))
+
+        # OC: release principal above the target or turbo principal with excess interest up to it
+
+        if oc_target is None:
+            target = np.full(paths, np.nan)
+            release = np.zeros(paths)
+            extra = np.zeros(paths)
+        else:
+            target = np.full(paths, oc_target) * original_collateral
+            if oc_stepdown is not None and period + 1 >= stepdown_month:
+                stepped = np.maximum(np.minimum(target, oc_stepdown * ending_collateral),
+                                     oc_floor * original_collateral)
+                target = np.where(failed, target, stepped)
+
+            oc_if_all_paid = ending_collateral - (current_balance.sum(axis=-1) - collections)
+            release = np.clip(oc_if_all_paid - target, 0, collections)
+            extra = np.minimum(excess, np.maximum(target - oc_if_all_paid, 0))
+            excess = excess - extra
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = np.where(collections > 0, (collections - release) / collections, 0.)
+
+        senior_amount = (senior_percentage * scheduled[..., period] +
+                         senior_prepayment_percentage * unscheduled[..., period]) * scale + extra
+        subordinate_amount = collections - release + extra - senior_amount
+
+        # write down the bonds in reverse priority for losses not covered by OC, before paying principal, so a
+        # junior bond only gets principal on the balance left after its losses
+
+        distributed = collections - release + extra
+        rem_loss = np.maximum(current_balance.sum(axis=-1) - distributed - ending_collateral, 0)
+        period_writedown = np.zeros(paths + (nbonds,))
+
+        for i in reversed(range(nbonds)):
+            period_writedown[..., i] = np.clip(current_balance[..., i], 0, rem_loss)
+            rem_loss = rem_loss - period_writedown[..., i]
+
+        after_loss = current_balance - period_writedown
+        subordinate_balance = (after_loss * ~senior).sum(axis=-1)
+
+        # seniors sequentially, subordinates pro rata, and anything a class can not absorb to the other class
+
+        paid_principal = np.zeros(paths + (nbonds,))
+        subordinate_amount = subordinate_amount + pay_sequential(senior_amount, paid_principal, after_loss,
+                                                                 senior_index)
+
+        subordinate_paid = np.minimum(subordinate_amount, subordinate_balance)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shares = np.where(subordinate_balance[..., np.newaxis] > 0,
+                              after_loss * ~senior / subordinate_balance[..., np.newaxis], 0.)
+        paid_principal += shares * subordinate_paid[..., np.newaxis]
+
+        unallocated = pay_sequential(subordinate_amount - subordinate_paid, paid_principal, after_loss, senior_index)
+
+        balance[..., period, :] = current_balance
+        interest_due[..., period, :] = due
+        interest_paid[..., period, :] = paid
+        interest_shortfall[..., period, :] = shortfall
+        principal_paid[..., period, :] = paid_principal
+        writedown[..., period, :] = period_writedown
+
+        current_balance = after_loss - paid_principal
+
+        deal['senior_percentage'][..., period] = senior_percentage
+        deal['senior_prepayment_percentage'][..., period] = senior_prepayment_percentage
+        deal['trigger_failed'][..., period] = failed
+        deal['overcollateralization'][..., period] = ending_collateral - current_balance.sum(axis=-1)
+        deal['oc_target'][..., period] = target
+        deal['residual'][..., period] = excess + release + unallocated
+
+    flows = {
+        'balance': balance,
+        'interest_due': interest_due,
+        'interest_paid': interest_paid,
+        'interest_shortfall': interest_shortfall,
+        'principal_paid': principal_paid,
+        'writedown': writedown,
+        'cashflow': interest_paid + principal_paid
+    }
+    flows.update(deal)
+
+    return flows
+
+
+class SeniorSubordinateCMO(CMO):
+    '''
+    CMO whose bonds are paid by senior_subordinate_cash_flows instead of the sequential pay waterfall. Bonds carry a
+    credit 'Type' of senior, mezzanine or subordinate, i.e. {'Bond': 'M1', 'Balance': 20e6, 'Coupon': 0.06,
+    'Type': 'mezzanine'}, and are listed in priority order.
+
+    run_loss_paths runs the same structure over many default paths at once, and run_index_paths over many index rate
+    paths for bonds with a floater or inverse floater 'Coupon_Type'.
+    '''
+
+    def __init__(self, bonds: list, shifting_interest=SHIFTING_INTEREST, oc_target=None, oc_stepdown=None,
+                 stepdown_month=37, oc_floor=0.005, cumulative_loss_trigger=None, **kwargs):
+        """ Takes the senior_subordinate_cash_flows structure arguments and the CMO arguments """
+
+        self.types = credit_types(bonds)
+        self.structure = {'shifting_interest': shifting_interest,
+                          'oc_target': oc_target,
+                          'oc_stepdown': oc_stepdown,
+                          'stepdown_month': stepdown_month,
+                          'oc_floor': oc_floor,
+                          'cumulative_loss_trigger': cumulative_loss_trigger}
+
+        super().__init__(bonds, **kwargs)
+
+    def _bond_flows(self, collateral, coupons=None):
+        return senior_subordinate_cash_flows(collateral,
+                                             [bond['Balance'] for bond in self.bonds],
+                                             self._coupons(self.index_rates) if coupons is None else coupons,
+                                             self.types,
+                                             **self.structure)
+
+    def _coupon_flows(self, coupons):
+        return self._bond_flows(self.collateral_waterfall, coupons)
+
+    @property
+    def _calc_seq_bond_cfs_directed_cash(self) -> object:
+        coupons = self._coupons(self.index_rates)
+        flows = self._bond_flows(self.collateral_waterfall, coupons)
+        if coupons.ndim > 1:
+            coupons = np.broadcast_to(coupons, flows['balance'].shape)
+
+        index = self.collateral_waterfall.index
+
+        self._bond_waterfalls = {}
+        for i, bond in enumerate(self.bonds):
+            current_bond = bond['Bond']
+            self._bond_waterfalls[current_bond] = pd.DataFrame({
+                'Bond_' + current_bond: current_bond,
+                'Coupon_' + current_bond: coupons[..., i],
+                'Balance_' + current_bond: flows['balance'][:, i],
+                'Principal_' + current_bond: flows['principal_paid'][:, i],
+                'Writedown_' + current_bond: flows['writedown'][:, i],
+                'Interest_Due_' + current_bond: flows['interest_due'][:, i],
+                'Interest_Paid_' + current_bond: flows['interest_paid'][:, i],
+                'Cashflow_' + current_bond: flows['cashflow'][:, i],
+                'Type_' + current_bond: self.types[i]},
+                index=index.values,
+                columns=[column + current_bond for column in BOND_COLUMNS])
+
+        final_df = pd.DataFrame({column: flows[column] for column in DEAL_COLUMNS}, index=index,
+                                columns=DEAL_COLUMNS)
+
+        return pd.concat([final_df] + [self._bond_waterfalls[bond['Bond']].set_index(index) for bond in self.bonds],
+                         axis=1)
+
+    def run_loss_paths(self, mdr, severity=None, recovery_lag=None):
+        """ Runs the structure over default paths, all at once
+
+        :param mdr: (paths x periods) monthly default rates, i.e. collateral_waterfall.mdr_vector output for a set of
+        sda speeds stacked together
+        :param severity: loss severity, a single value or one per path; the CMO severity by default
+        :param recovery_lag: months from default to liquidation; the CMO recovery lag by default
+        :return: senior_subordinate_cash_flows arrays with a leading paths axis
+        """
+
+        if self.collateral is not None:
+            raise ValueError('Loss paths rebuild the collateral from the CMO terms, not a supplied collateral '
+                             'waterfall')
+
+        severity = np.asarray(self.severity if severity is None else severity, dtype=float)
+        if severity.ndim:
+            severity = severity[:, np.newaxis]
+
+        smm = cw.smm_vector(self.cpr_description, self.psa_speed, self.wam)
+        collateral = cw.collateral_cash_flows(self.original_balance, self.pass_thru_cpn, self.wac, self.wam, smm,
+                                              mdr=np.asarray(mdr, dtype=float)[..., :self.wam], severity=severity,
+                                              recovery_lag=self.recovery_lag if recovery_lag is None else
+                                              recovery_lag)
+
+        return self._bond_flows(collateral)
+
+    def loss_path_summary(self, flows, confidence=0.95):
+        """ Per bond summary of run_loss_paths output
+
+        :return: dataframe indexed by bond with Type, Loss_Probability, Mean_Writedown and Writedown_<confidence> as
+        a percent of original balance, and Mean_WAL in years
+        """
+
+        balances = np.array([bond['Balance'] for bond in self.bonds], dtype=float)
+        written_down = flows['writedown'].sum(axis=-2) / balances * 100.
+
+        principal = flows['principal_paid']
+        months = np.arange(1, principal.shape[-2] + 1)[:, np.newaxis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            wal = (principal * months).sum(axis=-2) / principal.sum(axis=-2) / 12.
+
+        return pd.DataFrame({'Type': self.types,
+                             'Loss_Probability': (written_down > 0).mean(axis=0),
+                             'Mean_Writedown': written_down.mean(axis=0),
+                             'Writedown_{0:g}'.format(confidence): np.percentile(written_down, confidence * 100,
+                                                                                axis=0),
+                             'Mean_WAL': np.nanmean(wal, axis=0)},
+                            index=pd.Index([bond['Bond'] for bond in self.bonds], name='Bond'),
+                            columns=['Type', 'Loss_Probability', 'Mean_Writedown',
+                                     'Writedown_{0:g}'.format(confidence), 'Mean_WAL'])
+
+
+if __name__ == '__main__':
+    bonds = [{'Bond': 'A1', 'Balance': 250e6, 'Coupon': 0.05, 'Type': 'senior'},
+             {'Bond': 'A2', 'Balance': 100e6, 'Coupon': 0.055, 'Type': 'senior'},
+             {'Bond': 'M1', 'Balance': 25e6, 'Coupon': 0.06, 'Type': 'mezzanine'},
+             {'Bond': 'B1', 'Balance': 17e6, 'Coupon': 0.07, 'Type': 'subordinate'}]
+
+    deal = SeniorSubordinateCMO(bonds, oc_target=0.02, oc_stepdown=0.04, cumulative_loss_trigger=0.03,
+                                original_balance=400e6, wam=360, psa_speed=1.5, sda_speed=1.)
+
+    speeds = np.random.RandomState(0).lognormal(0., 0.75, 500)
+    paths = deal.run_loss_paths(cw.mdr_vector(deal.cdr_description, speeds[:, np.newaxis], deal.wam))
+
+    print(deal.loss_path_summary(paths))
@@ -0,0 +1,22 @@
+import numpy as np
+
+from CMO_waterfall import CMO
+
+BONDS = [{'Bond': 'A', 'Balance': 60e6, 'Coupon': 0.05},
+         {'Bond': 'B', 'Balance': 40e6, 'Coupon': 0.055}]
+
+
+def test_PAC_support_avg_life_covers_every_support():
+    cmo = CMO(BONDS, original_balance=100e6, psa_speed=1.5)
+    single = cmo.calc_PAC_and_support(cmo.collateral_waterfall)
+    pac_balance = single['PAC_balance'].iloc[0]
+
+    supports = [{'Bond': 'S1', 'Balance': 10e6}, {'Bond': 'S2', 'Balance': 100e6 - pac_balance - 10e6}]
+    waterfall = cmo.calc_PAC_and_support(cmo.collateral_waterfall, supports=supports)
+
+    pac, s1, s2 = CMO.return_PAC_Support_avg_life(waterfall)
+    periods = waterfall.index.values
+
+    assert np.isclose(s2, (periods * waterfall['S2_principal_paid']).sum() / waterfall['S2_principal_paid'].sum() / 12)
+    assert s1 < s2
+    assert np.isclose(pac, CMO.return_PAC_Support_avg_life(single)[0])
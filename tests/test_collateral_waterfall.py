@@ -0,0 +1,20 @@
+import numpy as np
+
+import collateral_waterfall as cw
+
+
+def test_arm_coupons_match_monthly_cap_loop():
+    coupons = cw.arm_coupons([None, 1.0, 5., 0.5, 4.], 1.75, .65, 5.1, 1)
+
+    assert np.allclose(coupons['Gross'].values, [5.1, 2.75, 3.75, 2.25, 3.25])
+    assert np.allclose(coupons['Net'].values, coupons['Gross'].values - .65)
+
+
+def test_arm_coupon_paths_first_reset_limits_each_direction():
+    rates = np.array([[0.01] * 3, [0.09] * 3])
+
+    coupons = cw.arm_coupon_paths(rates, 0.02, 0.05, first_reset=2, reset_frequency=1, periodic_cap=0.01,
+                                  initial_cap=0.02, initial_floor=0.005)
+
+    assert np.allclose(coupons[:, 1], [0.045, 0.07])
+    assert np.allclose(coupons[:, 2], [0.035, 0.08])
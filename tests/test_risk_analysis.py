@@ -0,0 +1,27 @@
+import numpy as np
+
+import risk_analysis as ra
+from CMO_waterfall import CMO
+from yield_curve import YieldCurve
+
+BONDS = [{'Bond': 'A', 'Balance': 60e6, 'Coupon': 0.05},
+         {'Bond': 'B', 'Balance': 40e6, 'Coupon': 0.055}]
+
+CURVE = YieldCurve([1., 5., 30.], [0.04, 0.045, 0.05])
+
+
+def test_effective_risk_with_per_period_speeds():
+    speeds = np.linspace(1., 2., 358)
+    cmo = CMO(BONDS, original_balance=100e6, psa_speed=speeds)
+
+    risk = ra.calc_effective_risk(cmo, CURVE, key_rate_tenors=[5.])
+
+    cash = cmo.waterfall[['Cashflow_A', 'Cashflow_B']].values.T
+    assert np.allclose(risk['Price'].values, CURVE.pv(cash) / np.array([60e6, 40e6]) * 100.)
+    assert np.all(np.isfinite(risk['Effective_Duration'].values))
+
+
+def test_psa_response_floors_each_period():
+    speed = ra.psa_response(CURVE, base_speed=np.array([0.05, 1., 2.]))
+
+    assert np.allclose(speed(CURVE), [0.1, 1., 2.])
@@ -0,0 +1,53 @@
+import numpy as np
+
+import collateral_waterfall as cw
+from subordination import SeniorSubordinateCMO
+
+BONDS = [{'Bond': 'A1', 'Balance': 250e6, 'Type': 'senior', 'Coupon_Type': 'floater', 'Margin': 0.005, 'Cap': 0.08},
+         {'Bond': 'A2', 'Balance': 100e6, 'Coupon': 0.055, 'Type': 'senior'},
+         {'Bond': 'M1', 'Balance': 25e6, 'Coupon': 0.06, 'Type': 'mezzanine'},
+         {'Bond': 'B1', 'Balance': 17e6, 'Coupon': 0.07, 'Type': 'subordinate'}]
+
+
+def index_paths(npaths=8, periods=360):
+    return 0.04 + np.cumsum(np.random.RandomState(0).normal(0., 0.002, (npaths, periods)), axis=-1)
+
+
+def test_run_index_paths_on_senior_subordinate_deal():
+    paths = index_paths()
+    deal = SeniorSubordinateCMO(BONDS, oc_target=0.02, original_balance=400e6, wam=360, sda_speed=1.,
+                                index_rates=paths[0])
+
+    flows = deal.run_index_paths(paths)
+
+    assert flows['balance'].shape == (8, 360, 4)
+    assert np.allclose(flows['interest_due'][0, :, 0], deal.waterfall['Interest_Due_A1'].values)
+    assert np.allclose(flows['cashflow'][3, :, 3],
+                       SeniorSubordinateCMO(BONDS, oc_target=0.02, original_balance=400e6, wam=360, sda_speed=1.,
+                                            index_rates=paths[3]).waterfall['Cashflow_B1'].values)
+
+
+def test_run_index_paths_with_fixed_coupons_repeats_the_deal():
+    bonds = [dict(BONDS[0], Coupon=0.05, Coupon_Type=None)] + BONDS[1:]
+    deal = SeniorSubordinateCMO(bonds, original_balance=400e6, wam=360)
+
+    flows = deal.run_index_paths(index_paths(3))
+
+    assert flows['cashflow'].shape == (3, 360, 4)
+    assert np.allclose(flows['cashflow'][2, :, 1], deal.waterfall['Cashflow_A2'].values)
+
+
+def test_losses_reach_seniors_only_after_juniors_stop_receiving_principal():
+    bonds = [dict(bond, Coupon=bond.get('Coupon', 0.05), Coupon_Type=None) for bond in BONDS]
+    deal = SeniorSubordinateCMO(bonds, oc_target=0.02, oc_stepdown=0.04, cumulative_loss_trigger=0.03,
+                                original_balance=400e6, wam=360, psa_speed=1.5, sda_speed=1.)
+
+    speeds = np.random.RandomState(0).lognormal(0., 0.75, 200) * 4.
+    flows = deal.run_loss_paths(cw.mdr_vector(deal.cdr_description, speeds[:, np.newaxis], deal.wam))
+
+    junior_paid = flows['principal_paid'][..., 2:].sum(axis=-1) > 0
+    senior_writedown = flows['writedown'][..., :2].sum(axis=-1)
+
+    assert np.any(senior_writedown > 0)
+    assert np.all(senior_writedown[junior_paid] == 0)
+    assert np.all(flows['principal_paid'] <= flows['balance'] - flows['writedown'] + 1e-6)
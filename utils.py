@@ -1,4 +1,5 @@
 """ General functions """
+import numpy as np
 
 
 def bey_from_mey(mey):
@@ -10,6 +11,18 @@ def bey_from_mey(mey):
 
     bey = 2 * ((1 + mey / 12) ** 6 - 1)
 
+    return bey
+
+
+def mey_from_bey(bey):
+    """
+
+    :param bey: bond equivalent yield
+    :return: monthly bond yield
+    """
+
+    return 12 * ((1 + bey / 2) ** (1 / 6) - 1)
+
 
 def macauley_duration(price, times, cash_flows, yld):
     return (1 / price) * ((times * cash_flows) /
@@ -36,13 +49,13 @@ def floater_rates(floater_size=.75,
     :param inverse_size: size of inverse floater bond principal
     :param available_coupon: coupon available from underlying collateral
     :param margin: floater margin to index rate, usually LIBOR or CMT
-    :param rate: rate of LIBOR or CMT to evaluate payment levels
-    :return: coupon payment levels for 'floater', and 'inverse floater'
+    :param rate: rate of LIBOR or CMT to evaluate payment levels, a scalar or an array of rates, i.e. (paths x periods)
+    :return: coupon payment levels for 'floater', and 'inverse floater', shaped like rate
     """
 
     leverage = floater_size / inverse_size
-    floater_rate = min(rate + margin, available_coupon + (1 / leverage * available_coupon))
+    floater_rate = np.minimum(np.asarray(rate) + margin, available_coupon + (1 / leverage * available_coupon))
 
-    inverse_rate = max((available_coupon + leverage * (available_coupon - floater_rate)), 0)
+    inverse_rate = np.maximum((available_coupon + leverage * (available_coupon - floater_rate)), 0)
 
     return floater_rate, inverse_rate
\ No newline at end of file
@@ -35,13 +35,8 @@ window = range(1, wam + 1)
 psa_figure = figure(title='CPR Rate', tools=['box_zoom', 'lasso_select', 'box_select', 'save', 'reset'])
 
 for mult in np.linspace(0.25, 3, num=12):
-    periods = []
-    psa_speed = []
-
-    for period in window:
-        periods.append(period)
-        psa_speed.append(pc.psa(period) * mult)
-    psa_figure.line(periods, psa_speed, name='PSA-{0:.2f}'.format(mult), alpha=0.65)
+    periods = np.arange(1, wam + 1)
+    psa_figure.line(periods, pc.psa(periods) * mult, name='PSA-{0:.2f}'.format(mult), alpha=0.65)
 
 psa_figure.yaxis.formatter = NumeralTickFormatter(format='0%')
 
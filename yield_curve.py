@@ -0,0 +1,183 @@
+""" Yield curve built from BondPricing spot rates with interpolation, cached monthly discount factors and bulk
+present values of (tranches x periods) cash flow matrices """
+
+import numpy as np
+from scipy.interpolate import PchipInterpolator
+
+INTERPOLATION_METHODS = ['linear_zero', 'monotone_cubic', 'log_linear_df']
+
+
+class YieldCurve:
+    '''
+    Continuously compounded zero curve. Rates between knots are interpolated linearly on the zero rate, with a
+    monotone cubic (PCHIP) on the zero rate, or linearly on the log discount factor; rates are held flat before the
+    first and after the last knot.
+
+    Monthly discount factors and forward rates are computed once per horizon and cached.
+    '''
+
+    def __init__(self, maturities, spot_rates, interpolation='linear_zero'):
+        """
+        :param maturities: knot maturities in years
+        :param spot_rates: continuously compounded zero rates in decimal at each maturity
+        :param interpolation: one of INTERPOLATION_METHODS
+        """
+
+        if interpolation not in INTERPOLATION_METHODS:
+            raise ValueError('Unknown interpolation {0}, expected one of {1}'.format(interpolation,
+                                                                                   INTERPOLATION_METHODS))
+
+        order = np.argsort(maturities)
+        self.maturities = np.asarray(maturities, dtype=float)[order]
+        self.spot_rates = np.asarray(spot_rates, dtype=float)[order]
+        self.interpolation = interpolation
+
+        if interpolation == 'monotone_cubic' and len(self.maturities) > 1:
+            self._cubic = PchipInterpolator(self.maturities, self.spot_rates, extrapolate=False)
+
+        self._monthly = {}
+
+    @classmethod
+    def from_bond_pricing(cls, bonds, interpolation='linear_zero'):
+        """ Curve from the bonds dataframe of a BondPricing instance (or the instance itself), whose spot_rate
+        column is continuously compounded in decimal """
+
+        bonds = getattr(bonds, 'bonds', bonds)
+        return cls(bonds['Maturity'].values, bonds['spot_rate'].values, interpolation)
+
+    @classmethod
+    def from_par_spots(cls, par_bonds, interpolation='linear_zero'):
+        """ Curve from BondPricing.spot_from_par output, indexed by maturity with annually compounded spot_rate in
+        percent """
+
+        return cls(np.asarray(par_bonds.index, dtype=float),
+                   np.log(1. + par_bonds['spot_rate'].values / 100.),
+                   interpolation)
+
+    def shifted(self, shift_bps, key_rate=None):
+        """ New curve with every knot shifted by shift_bps, or only the knot at maturity key_rate for key rate
+        shocks """
+
+        shift = np.full(len(self.maturities), shift_bps / 1e4)
+        if key_rate is not None:
+            shift[~np.isclose(self.maturities, key_rate)] = 0.
+
+        return YieldCurve(self.maturities, self.spot_rates + shift, self.interpolation)
+
+    def zero_rates(self, times):
+        """ Continuously compounded zero rates at times in years """
+
+        times = np.asarray(times, dtype=float)
+        clipped = np.clip(times, self.maturities[0], self.maturities[-1])
+
+        if self.interpolation == 'monotone_cubic' and len(self.maturities) > 1:
+            return self._cubic(clipped)
+
+        if self.interpolation == 'log_linear_df':
+            knots = np.concatenate(([0.], self.maturities))
+            log_discount = np.concatenate(([0.], -self.spot_rates * self.maturities))
+            inside = np.interp(times, knots, log_discount)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rates = np.where(times > 0, -inside / times, self.spot_rates[0])
+            return np.where(times > self.maturities[-1], self.spot_rates[-1], rates)
+
+        return np.interp(clipped, self.maturities, self.spot_rates)
+
+    def discount_factors(self, times):
+        times = np.asarray(times, dtype=float)
+        return np.exp(-self.zero_rates(times) * times)
+
+    def monthly_discount_factors(self, periods=360):
+        """ Cached discount factors for months 1 to periods """
+
+        if periods not in self._monthly:
+            discount = self.discount_factors(np.arange(1, periods + 1) / 12.)
+            discount.flags.writeable = False
+            self._monthly[periods] = discount
+
+        return self._monthly[periods]
+
+    def monthly_forward_rates(self, periods=360):
+        """ Continuously compounded one month forward rates for months 1 to periods """
+
+        discount = np.concatenate(([1.], self.monthly_discount_factors(periods)))
+        return np.log(discount[:-1] / discount[1:]) * 12.
+
+    def pv(self, cash_flows, spread_bps=0.):
+        """ Present value of monthly cash flows paid at months 1, 2, ...
+
+        :param cash_flows: (tranches x periods) matrix, or a single vector of cash flows
+        :param spread_bps: continuously compounded spread over the curve in basis points, a single spread or one per
+        tranche
+        :return: present value of each tranche
+        """
+
+        cash_flows = np.asarray(cash_flows, dtype=float)
+        periods = cash_flows.shape[-1]
+        discount = self.monthly_discount_factors(periods)
+        spread = np.asarray(spread_bps, dtype=float) / 1e4
+
+        if spread.ndim == 0:
+            return cash_flows.dot(discount * np.exp(-spread * np.arange(1, periods + 1) / 12.))
+
+        return (cash_flows * discount * np.exp(-spread[:, np.newaxis] * np.arange(1, periods + 1) / 12.)).sum(axis=1)
+
+    def spreads(self, cash_flows, prices, tolerance=1e-10, max_iterations=50):
+        """ Solves the spread over the curve in basis points that prices each row of a (tranches x periods) cash flow
+        matrix at its price, for all tranches at once with Newton's method.
+
+        :param prices: price of each tranche in the same units as the cash flows
+        """
+
+        cash_flows = np.atleast_2d(np.asarray(cash_flows, dtype=float))
+        times = np.arange(1, cash_flows.shape[1] + 1) / 12.
+        discounted = cash_flows * self.monthly_discount_factors(cash_flows.shape[1])
+        spread = np.zeros(len(cash_flows))
+
+        for _ in range(max_iterations):
+            weighted = discounted * np.exp(-spread[:, np.newaxis] * times)
+            step = (weighted.sum(axis=1) - prices) / -(weighted * times).sum(axis=1)
+            spread -= step
+
+            if np.all(np.abs(step) < tolerance):
+                break
+
+        return spread * 1e4
+
+    def yields(self, cash_flows, prices):
+        """ Monthly compounded yields of each row of a (tranches x periods) cash flow matrix at its price """
+
+        cash_flows = np.atleast_2d(np.asarray(cash_flows, dtype=float))
+        guess = self.zero_rates(cash_flows.shape[1] / 24.) / 12. * np.ones(len(cash_flows))
+
+        return monthly_yields(cash_flows, prices, guess) * 12.
+
+
+def monthly_yields(cash_flows, prices, guess, tolerance=1e-12, max_iterations=50):
+    """ Solves the monthly yield of each row of a (bonds x periods) cash flow matrix with Newton's method """
+
+    months = np.arange(1, cash_flows.shape[1] + 1)
+    rate = np.array(guess, dtype=float)
+
+    for _ in range(max_iterations):
+        discount = (1 + rate[:, np.newaxis]) ** -months
+        error = (cash_flows * discount).sum(axis=1) - prices
+        slope = -(cash_flows * months * discount / (1 + rate[:, np.newaxis])).sum(axis=1)
+        step = error / slope
+        rate -= step
+
+        if np.all(np.abs(step) < tolerance):
+            break
+
+    return rate
+
+
+if __name__ == '__main__':
+    from bond_pricing import BondPricing
+
+    curve = YieldCurve.from_par_spots(BondPricing.spot_from_par(), interpolation='monotone_cubic')
+
+    flows = np.array([np.full(360, 1.), np.concatenate((np.zeros(120), np.full(240, 2.)))])
+    prices = curve.pv(flows, spread_bps=50)
+
+    print(prices, curve.spreads(flows, prices), curve.yields(flows, prices))